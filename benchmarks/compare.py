@@ -0,0 +1,74 @@
+import sys
+import json
+import argparse
+
+
+def _get_key(result):
+    return result["task_type"], result["num_rows"], result["text_length"], result["stage"]
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """Compares the stage times of two benchmark results.
+
+    Args:
+        baseline (dict): The benchmark results to compare with.
+        current (dict): The new benchmark results.
+        threshold (float): The slowdown (e.g. 0.1 for 10%) reported as a regression.
+
+    Returns:
+        list: A row per stage measured by both, with the change of its time and memory.
+    """
+    baseline_results = {_get_key(result): result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        baseline_result = baseline_results.get(_get_key(result))
+        if baseline_result is None or not baseline_result["seconds"]:
+            continue
+        change = result["seconds"] / baseline_result["seconds"] - 1
+        rows.append({
+            "task_type": result["task_type"],
+            "num_rows": result["num_rows"],
+            "text_length": result["text_length"],
+            "stage": result["stage"],
+            "baseline_seconds": baseline_result["seconds"],
+            "seconds": result["seconds"],
+            "change": round(change, 4),
+            "baseline_peak_rss_delta_mb": baseline_result["peak_rss_delta_mb"],
+            "peak_rss_delta_mb": result["peak_rss_delta_mb"],
+            "regression": change > threshold,
+        })
+    return rows
+
+
+def print_comparison(rows):
+    print(f"[[Benchmark Comparison]]")
+    print(f"| Task | Rows    | Words | Stage    | Baseline |  Current | Change  | Memory (MB)     |")
+    print(f"| ---- | ------- | ----- | -------- | -------- | -------- | ------- | --------------- |")
+    for row in rows:
+        flag = " (regression)" if row["regression"] else ""
+        print(f"| {row['task_type']:<4} | {row['num_rows']:>7} | {row['text_length']:>5} | {row['stage']:<8} "
+              f"| {row['baseline_seconds']:>7.2f}s | {row['seconds']:>7.2f}s | {row['change']:>+7.1%} "
+              f"| {row['baseline_peak_rss_delta_mb']:>6.1f} -> {row['peak_rss_delta_mb']:>6.1f} |{flag}")
+    num_regressions = sum(1 for row in rows if row["regression"])
+    print(f"- Num of regressions: {num_regressions}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline_path", type=str, help="The benchmark results to compare with")
+    parser.add_argument("current_path", type=str, help="The new benchmark results")
+    parser.add_argument("--threshold", type=float, help="Slowdown over the baseline reported as a regression", default=0.1)
+    args = parser.parse_args()
+
+    with open(args.baseline_path, "r") as f:
+        baseline = json.load(f)
+    with open(args.current_path, "r") as f:
+        current = json.load(f)
+    rows = compare_results(baseline, current, args.threshold)
+    print_comparison(rows)
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
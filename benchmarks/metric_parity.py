@@ -0,0 +1,206 @@
+import sys
+import json
+import time
+import random
+import argparse
+
+from benchmarks.synthetic_data import get_text
+from lib import metrics
+
+# Alphabets of the random pairs, small enough for many matches (and one with non-ASCII characters)
+_ALPHABETS = ["ab", "abcd", "abcdefghij ", "가나다라 ab"]
+
+
+def get_kernels(include_dp=True):
+    """Returns the (edit distance, LCS length) functions of each kernel available here."""
+    kernels = {}
+    if include_dp:
+        kernels["dp"] = (metrics._dp_edit_distance, metrics._dp_lcs_length)
+    kernels["bit-parallel"] = (metrics._bit_parallel_edit_distance, metrics._bit_parallel_lcs_length)
+    if metrics._rapidfuzz_levenshtein is not None:
+        kernels["rapidfuzz"] = (metrics._edit_distance, metrics._lcs_length)
+    return kernels
+
+
+def get_kernel_inputs(prediction, reference):
+    """Returns the character sequences of CER and the token sequences of ROUGE-L that the kernels are applied to."""
+    return (
+        (metrics._MULTIPLE_SPACES_RE.sub(" ", prediction).strip(), metrics._MULTIPLE_SPACES_RE.sub(" ", reference).strip()),
+        (metrics._tokenize_rouge(reference), metrics._tokenize_rouge(prediction)),
+    )
+
+
+def perturb_text(rng, text, edit_rate):
+    """Returns the text with a fraction of its words deleted, replaced or followed by an inserted word."""
+    words = []
+    for word in text.split():
+        if rng.random() >= edit_rate:
+            words.append(word)
+            continue
+        edit = rng.choice(["delete", "replace", "insert"])
+        if edit == "replace":
+            words.append(get_text(rng, 1))
+        elif edit == "insert":
+            words.extend([word, get_text(rng, 1)])
+    return " ".join(words)
+
+
+def make_random_pairs(num_pairs, max_length, seed=0):
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(num_pairs):
+        alphabet = rng.choice(_ALPHABETS)
+        pairs.append(tuple(
+            "".join(rng.choice(alphabet) for _ in range(rng.randint(0, max_length)))
+            for _ in range(2)
+        ))
+    return pairs
+
+
+def make_text_pairs(num_pairs, num_words, edit_rate, seed=0):
+    """Returns (prediction, reference) pairs of synthetic texts, the prediction being an edited reference."""
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(num_pairs):
+        reference = get_text(rng, num_words)
+        pairs.append((perturb_text(rng, reference, edit_rate), reference))
+    return pairs
+
+
+def load_result_pairs(results_path, limit=None):
+    pairs = []
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            result = json.loads(line)
+            pairs.append((result["generated_response"], result["ground_truth"]))
+            if limit is not None and len(pairs) == limit:
+                break
+    return pairs
+
+
+def check_kernel_parity(pairs, max_dp_chars):
+    """Compares the edit distance and LCS length of each kernel to the dynamic program.
+
+    Pairs longer than `max_dp_chars` are compared to the first other kernel
+    instead, since the dynamic program is O(n·m).
+
+    Returns:
+        dict: The number of mismatches of each kernel, per kernel function.
+    """
+    mismatches = {"edit_distance": {}, "lcs_length": {}}
+    for prediction, reference in pairs:
+        include_dp = max(len(prediction), len(reference)) <= max_dp_chars
+        kernels = get_kernels(include_dp)
+        for index, (function, inputs) in enumerate(zip(mismatches, get_kernel_inputs(prediction, reference))):
+            values = {name: kernel[index](*inputs) for name, kernel in kernels.items()}
+            expected = next(iter(values.values()))
+            for name, value in values.items():
+                mismatches[function][name] = mismatches[function].get(name, 0) + (value != expected)
+    return mismatches
+
+
+def check_reference_parity(pairs):
+    """Compares the CER and ROUGE-L scores to `jiwer` and `rouge_score` (the libraries behind the `evaluate` metrics), if installed.
+
+    Returns:
+        dict: The max absolute difference of each score column, per library.
+    """
+    report = {}
+    # CER is undefined for an empty reference
+    pairs = [(prediction, reference) for prediction, reference in pairs if reference.strip()]
+    predictions = [prediction for prediction, _ in pairs]
+    references = [reference for _, reference in pairs]
+    scores = metrics.compute_scores(predictions, references, columns=["cer_score", "rouge_l_score"])
+    try:
+        import jiwer
+        from jiwer import transforms
+
+        cer_transform = transforms.Compose([
+            transforms.RemoveMultipleSpaces(),
+            transforms.Strip(),
+            transforms.ReduceToSingleSentence(""),
+            transforms.ReduceToListOfListOfChars(),
+        ])
+        expected = [
+            jiwer.cer(reference, prediction, reference_transform=cer_transform, hypothesis_transform=cer_transform)
+            for prediction, reference in pairs
+        ]
+        report["jiwer"] = {"cer_score": max((abs(a - b) for a, b in zip(scores["cer_score"], expected)), default=0.0)}
+    except ImportError:
+        pass
+    try:
+        from rouge_score import rouge_scorer
+
+        scorer = rouge_scorer.RougeScorer(["rougeL"])
+        expected = [scorer.score(reference, prediction)["rougeL"].fmeasure for prediction, reference in pairs]
+        report["rouge_score"] = {"rouge_l_score": max((abs(a - b) for a, b in zip(scores["rouge_l_score"], expected)), default=0.0)}
+    except ImportError:
+        pass
+    return report
+
+
+def measure_throughput(pairs, max_dp_chars):
+    """Returns the mean milliseconds per pair of the CER and ROUGE-L kernels of each kernel."""
+    include_dp = max(max(len(prediction), len(reference)) for prediction, reference in pairs) <= max_dp_chars
+    inputs = [get_kernel_inputs(prediction, reference) for prediction, reference in pairs]
+    rows = {}
+    for name, (edit_distance, lcs_length) in get_kernels(include_dp).items():
+        start_time = time.perf_counter()
+        for cer_inputs, _ in inputs:
+            edit_distance(*cer_inputs)
+        cer_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        for _, rouge_inputs in inputs:
+            lcs_length(*rouge_inputs)
+        rouge_time = time.perf_counter() - start_time
+        rows[name] = {"cer_ms": 1000 * cer_time / len(pairs), "rouge_ms": 1000 * rouge_time / len(pairs)}
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the edit distance and LCS kernels of the built-in metrics agree, and time them on long texts.")
+    parser.add_argument("--num_random", type=int, help="Random short pairs over small alphabets", default=2000)
+    parser.add_argument("--num_pairs", type=int, help="Synthetic text pairs of each length", default=20)
+    parser.add_argument("--text_lengths", type=int, nargs="+", help="Words of the synthetic references", default=[20, 200, 1000])
+    parser.add_argument("--edit_rate", type=float, help="Fraction of the words of a reference edited in its prediction", default=0.3)
+    parser.add_argument("--results_path", type=str, help="An `.eval_results.jsonl` file whose (response, ground truth) pairs are checked too", default=None)
+    parser.add_argument("--limit", type=int, help="Number of rows of the results file (default: all)", default=None)
+    parser.add_argument("--max_dp_chars", type=int, help="Longest text compared to (and timed with) the O(n·m) dynamic program", default=2000)
+    parser.add_argument("--seed", type=int, help="Seed of the random and synthetic pairs", default=0)
+    args = parser.parse_args()
+
+    text_pairs = {
+        num_words: make_text_pairs(args.num_pairs, num_words, args.edit_rate, args.seed + num_words)
+        for num_words in args.text_lengths
+    }
+    pairs = make_random_pairs(args.num_random, 100, args.seed)
+    for length_pairs in text_pairs.values():
+        pairs.extend(length_pairs)
+    if args.results_path is not None:
+        pairs.extend(load_result_pairs(args.results_path, args.limit))
+
+    print(f"[[Metric Parity]]")
+    print(f"- Num of pairs: {len(pairs)}")
+    print(f"- Kernels: {', '.join(get_kernels())}")
+    mismatches = check_kernel_parity(pairs, args.max_dp_chars)
+    for function, kernel_mismatches in mismatches.items():
+        print(f"- {function}: " + ", ".join(f"{name} {count} mismatches" for name, count in kernel_mismatches.items()))
+    reference_parity = check_reference_parity(pairs)
+    for library, diffs in reference_parity.items():
+        print(f"- {library}: " + ", ".join(f"{column} max abs diff {diff:.2e}" for column, diff in diffs.items()))
+
+    print(f"[[Kernel Throughput]]")
+    print(f"| Words | Chars  | Kernel       | CER (ms/pair) | ROUGE-L (ms/pair) |")
+    print(f"| ----- | ------ | ------------ | ------------- | ----------------- |")
+    for num_words, length_pairs in text_pairs.items():
+        num_chars = sum(len(reference) for _, reference in length_pairs) // len(length_pairs)
+        for name, row in measure_throughput(length_pairs, args.max_dp_chars).items():
+            print(f"| {num_words:>5} | {num_chars:>6} | {name:<12} | {row['cer_ms']:>13.3f} | {row['rouge_ms']:>17.3f} |")
+
+    num_mismatches = sum(sum(kernel_mismatches.values()) for kernel_mismatches in mismatches.values())
+    if num_mismatches or any(diff > 1e-9 for diffs in reference_parity.values() for diff in diffs.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
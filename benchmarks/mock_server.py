@@ -0,0 +1,332 @@
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import itertools
+import threading
+import subprocess
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockBackend:
+    """
+    The state and behavior of a mock OpenAI-compatible LLM server.
+
+    Each completion echoes the first words of the last message, padded to
+    `completion_tokens` words (one word per token). It arrives after
+    `latency` seconds plus one token every 1/`token_rate` seconds, and a
+    request fails with a 500 error with probability `error_rate`. With
+    `requests_per_minute`, requests over the limit are refused with a 429
+    and the `x-ratelimit-*` headers of the OpenAI API.
+    """
+    def __init__(self, latency=0.05, token_rate=0.0, error_rate=0.0, completion_tokens=16, requests_per_minute=None, batch_polls=2, seed=0):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.error_rate = error_rate
+        self.completion_tokens = completion_tokens
+        self.requests_per_minute = requests_per_minute
+        self.batch_polls = batch_polls
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_level = float(requests_per_minute or 0)
+        self.updated_at = time.monotonic()
+        self.files = {}
+        self.batches = {}
+        self.ids = itertools.count()
+
+    def get_completion_words(self, body):
+        words = body["messages"][-1]["content"].split()[:self.completion_tokens]
+        return words + ["token"] * (self.completion_tokens - len(words))
+
+    def get_completion(self, body):
+        words = self.get_completion_words(body)
+        return {
+            "id": f"chatcmpl-{next(self.ids)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+            "usage": self.get_usage(body, len(words)),
+        }
+
+    def get_usage(self, body, num_completion_tokens):
+        num_prompt_tokens = sum(len(message["content"].split()) for message in body["messages"])
+        return {
+            "prompt_tokens": num_prompt_tokens,
+            "completion_tokens": num_completion_tokens,
+            "total_tokens": num_prompt_tokens + num_completion_tokens,
+        }
+
+    def get_token_delay(self):
+        return 1 / self.token_rate if self.token_rate > 0 else 0.0
+
+    def is_error(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def take_request(self):
+        """Returns None if the request is within the requests-per-minute limit, or the seconds until it is."""
+        if not self.requests_per_minute:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            self.request_level = min(
+                self.requests_per_minute,
+                self.request_level + (now - self.updated_at) * self.requests_per_minute / 60,
+            )
+            self.updated_at = now
+            if self.request_level < 1:
+                return (1 - self.request_level) * 60 / self.requests_per_minute
+            self.request_level -= 1
+            return None
+
+    def get_rate_limit_headers(self):
+        if not self.requests_per_minute:
+            return {}
+        return {
+            "x-ratelimit-limit-requests": str(self.requests_per_minute),
+            "x-ratelimit-remaining-requests": str(max(0, int(self.request_level))),
+        }
+
+    def create_batch(self, request):
+        """Runs the requests of a batch input file, and returns the batch (completed after `batch_polls` polls)."""
+        lines = [json.loads(line) for line in self.files[request["input_file_id"]].decode("utf-8").splitlines() if line.strip()]
+        outputs, errors = [], []
+        for line in lines:
+            if self.is_error():
+                errors.append({
+                    "id": f"batch_req_{next(self.ids)}",
+                    "custom_id": line["custom_id"],
+                    "response": {"status_code": 500, "request_id": "", "body": {"error": {"message": "Mock server error"}}},
+                    "error": None,
+                })
+            else:
+                outputs.append({
+                    "id": f"batch_req_{next(self.ids)}",
+                    "custom_id": line["custom_id"],
+                    "response": {"status_code": 200, "request_id": "", "body": self.get_completion(line["body"])},
+                    "error": None,
+                })
+        batch_id = f"batch_{next(self.ids)}"
+        self.batches[batch_id] = {
+            "batch": {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": request["endpoint"],
+                "input_file_id": request["input_file_id"],
+                "completion_window": request["completion_window"],
+                "created_at": int(time.time()),
+                "status": "in_progress",
+                "output_file_id": None,
+                "error_file_id": None,
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            },
+            "num_polls": 0,
+            "output_file_id": self.create_file(outputs),
+            "error_file_id": self.create_file(errors) if errors else None,
+            "request_counts": {"total": len(lines), "completed": len(outputs), "failed": len(errors)},
+        }
+        return self.batches[batch_id]["batch"]
+
+    def create_file(self, records):
+        file_id = f"file-{next(self.ids)}"
+        self.files[file_id] = "\n".join(json.dumps(record) for record in records).encode("utf-8")
+        return file_id
+
+    def poll_batch(self, batch_id):
+        state = self.batches[batch_id]
+        state["num_polls"] += 1
+        if state["num_polls"] >= self.batch_polls:
+            state["batch"].update(
+                status="completed",
+                output_file_id=state["output_file_id"],
+                error_file_id=state["error_file_id"],
+                request_counts=state["request_counts"],
+            )
+        return state["batch"]
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def backend(self):
+        return self.server.backend
+
+    def send_json(self, body, status_code=200, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_bytes(self, data):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/chat/completions"):
+            return self.handle_completion(json.loads(data))
+        if self.path.endswith("/files"):
+            message = BytesParser().parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode("utf-8") + b"\r\n\r\n" + data
+            )
+            content = next(part for part in message.get_payload() if part.get_filename()).get_payload(decode=True)
+            file_id = f"file-{next(self.backend.ids)}"
+            self.backend.files[file_id] = content
+            return self.send_json({
+                "id": file_id, "object": "file", "bytes": len(content),
+                "created_at": int(time.time()), "filename": "batch_input.jsonl", "purpose": "batch",
+            })
+        if self.path.endswith("/batches"):
+            return self.send_json(self.backend.create_batch(json.loads(data)))
+        self.send_json({"error": {"message": f"Unknown path: {self.path}"}}, 404)
+
+    def do_GET(self):
+        if "/batches/" in self.path:
+            return self.send_json(self.backend.poll_batch(self.path.rsplit("/", 1)[1]))
+        if self.path.endswith("/content"):
+            return self.send_bytes(self.backend.files[self.path.split("/")[-2]])
+        self.send_json({"error": {"message": f"Unknown path: {self.path}"}}, 404)
+
+    def handle_completion(self, body):
+        retry_after = self.backend.take_request()
+        if retry_after is not None:
+            headers = {"retry-after-ms": str(int(retry_after * 1000)), **self.backend.get_rate_limit_headers()}
+            return self.send_json(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, 429, headers
+            )
+        time.sleep(self.backend.latency)
+        if self.backend.is_error():
+            return self.send_json({"error": {"message": "Mock server error"}}, 500)
+
+        if not body.get("stream"):
+            completion = self.backend.get_completion(body)
+            time.sleep(self.backend.get_token_delay() * completion["usage"]["completion_tokens"])
+            return self.send_json(completion, headers=self.backend.get_rate_limit_headers())
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = self.backend.get_completion_words(body)
+        chunk = {"id": f"chatcmpl-{next(self.backend.ids)}", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"]}
+        try:
+            for index, word in enumerate(words):
+                if index > 0:
+                    time.sleep(self.backend.get_token_delay())
+                delta = {"role": "assistant", "content": word} if index == 0 else {"content": f" {word}"}
+                self.send_event({**chunk, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+            self.send_event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self.send_event({**chunk, "choices": [], "usage": self.backend.get_usage(body, len(words))})
+            self.send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading (e.g. at its max-token budget)
+            self.close_connection = True
+
+    def send_event(self, event):
+        data = f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n".encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def serve(port, backend):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockRequestHandler)
+    server.daemon_threads = True
+    server.backend = backend
+    server.serve_forever()
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class MockServer:
+    """
+    Runs the mock server in a subprocess, so that it does not compete with the benchmarked code for the GIL.
+
+    Usable as a context manager; `base_url` is the OpenAI base URL of the server.
+    """
+    def __init__(self, port=None, **backend_kwargs):
+        self.port = port or get_free_port()
+        self.backend_kwargs = backend_kwargs
+        self.process = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self, timeout=10.0):
+        command = [sys.executable, "-m", "benchmarks.mock_server", "--port", str(self.port)]
+        for key, value in self.backend_kwargs.items():
+            if value is not None:
+                command += [f"--{key}", str(value)]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.1):
+                    return self
+            except OSError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError(f"The mock server did not start on port {self.port}.")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI-compatible server (chat completions, streaming, files and batches).")
+    parser.add_argument("--port", type=int, help="Port of the server", default=18000)
+    parser.add_argument("--latency", type=float, help="Seconds before the first token of each completion", default=0.05)
+    parser.add_argument("--token_rate", type=float, help="Completion tokens per second of each request (0: no delay)", default=0.0)
+    parser.add_argument("--error_rate", type=float, help="Fraction of requests that fail with a 500 error", default=0.0)
+    parser.add_argument("--completion_tokens", type=int, help="Completion tokens (words) of each response", default=16)
+    parser.add_argument("--requests_per_minute", type=int, help="Requests-per-minute limit, enforced with 429 errors (default: no limit)", default=None)
+    parser.add_argument("--batch_polls", type=int, help="Number of polls until a batch completes", default=2)
+    parser.add_argument("--seed", type=int, help="Seed of the simulated errors", default=0)
+    args = parser.parse_args()
+
+    backend = MockBackend(
+        latency=args.latency,
+        token_rate=args.token_rate,
+        error_rate=args.error_rate,
+        completion_tokens=args.completion_tokens,
+        requests_per_minute=args.requests_per_minute,
+        batch_polls=args.batch_polls,
+        seed=args.seed,
+    )
+    print(f"Serving a mock OpenAI API at http://127.0.0.1:{args.port}/v1")
+    serve(args.port, backend)
+
+
+if __name__ == "__main__":
+    main()
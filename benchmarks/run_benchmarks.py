@@ -0,0 +1,277 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import threading
+import subprocess
+from contextlib import ExitStack, redirect_stdout
+
+# The progress bars of the stages would flood the benchmark output
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+from benchmarks.mock_server import MockServer
+from benchmarks.synthetic_data import make_dataset
+from benchmarks.compare import compare_results, print_comparison
+from lib.data_loader import DataLoaderFactory
+from lib.payload_creator import PayloadCreatorFactory
+from lib.api_executor import APIExecutorFactory
+from lib.response_evaluator import ResponseEvaluatorFactory
+from lib.perf_report import get_perf_report
+
+STAGES = ["load", "payload", "fetch", "evaluate"]
+
+# Seconds between two memory samples of a stage
+MEMORY_SAMPLE_INTERVAL = 0.01
+
+
+def get_rss():
+    """Returns the resident memory of the process in bytes."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    import resource
+    # The peak resident memory, in KB on Linux (bytes on macOS)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+class MemorySampler:
+    """
+    Samples the resident memory of the process in a thread, to report the peak memory of a stage.
+    """
+    def __init__(self):
+        self.start_rss = get_rss()
+        self.peak_rss = self.start_rss
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(MEMORY_SAMPLE_INTERVAL):
+            self.peak_rss = max(self.peak_rss, get_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, get_rss())
+
+
+def measure(stage, num_rows, fn, verbose=False):
+    """Runs a stage and returns its result with its wall time, throughput and memory."""
+    output = None if verbose else io.StringIO()
+    with MemorySampler() as sampler:
+        start_time = time.perf_counter()
+        if verbose:
+            result = fn()
+        else:
+            with redirect_stdout(output):
+                result = fn()
+        seconds = time.perf_counter() - start_time
+    return result, {
+        "stage": stage,
+        "seconds": round(seconds, 4),
+        "rows_per_sec": round(num_rows / seconds, 2) if seconds > 0 else None,
+        "peak_rss_mb": round(sampler.peak_rss / 2 ** 20, 1),
+        "peak_rss_delta_mb": round((sampler.peak_rss - sampler.start_rss) / 2 ** 20, 1),
+    }
+
+
+def run_case(args, base_url, task_type, num_rows, text_length, work_dir):
+    """Runs the stages of the pipeline over a synthetic dataset, and returns the measurements of each stage."""
+    dataset_path = os.path.join(work_dir, "data", "raw", task_type)
+    payload_path = os.path.join(work_dir, "data", "processed", task_type)
+    system_prompt_path = os.path.join(work_dir, "prompts", f"{task_type}.txt")
+    response_path = os.path.join(work_dir, "results", f"{task_type}.output.jsonl")
+    results_path = os.path.join(work_dir, "results", f"{task_type}.eval_results.jsonl")
+    os.makedirs(os.path.dirname(system_prompt_path), exist_ok=True)
+    with open(system_prompt_path, "w") as f:
+        f.write("You are a helpful assistant for a benchmark.")
+    make_dataset(task_type, num_rows, text_length, args.num_unique_inputs, args.seed).save_to_disk(dataset_path)
+
+    case = {"task_type": task_type, "num_rows": num_rows, "text_length": text_length}
+    measurements = []
+
+    def load_dataset():
+        input_dataset = DataLoaderFactory.get_data_loader(
+            source="huggingface",
+            dataset_name="synthetic"
+        ).load_dataset(
+            dataset_path=dataset_path,
+            split="test",
+            reset=False
+        )
+        # The dataset is loaded lazily, so load its rows here
+        input_dataset.dataset
+        return input_dataset
+
+    input_dataset, measurement = measure("load", num_rows, load_dataset, args.verbose)
+    measurements.append(measurement)
+
+    input_payloads, measurement = measure("payload", num_rows, lambda: PayloadCreatorFactory.get_payload_creator(
+        task_type=task_type,
+        temperature=0.1,
+        system_prompt_path=system_prompt_path,
+        num_proc=args.payload_workers
+    ).create_payload(
+        input_dataset=input_dataset,
+        payload_path=payload_path,
+        reset=True
+    ), args.verbose)
+    measurements.append(measurement)
+
+    if "fetch" in args.stages or "evaluate" in args.stages:
+        api_executor = APIExecutorFactory.get_api_executor(
+            model="mock",
+            api_type=args.api_type,
+            api_key="mock",
+            concurrency=args.concurrency,
+            max_retries=args.max_retries,
+            base_url=base_url,
+            stream=args.stream_completions
+        )
+        response_list, measurement = measure("fetch", num_rows, lambda: api_executor.fetch_response(
+            input_payloads=input_payloads,
+            response_path=response_path,
+            reset=True
+        ), args.verbose)
+        perf_report = get_perf_report(response_list)
+        measurement.update(
+            num_responses=len(response_list),
+            # Payloads whose retries did not absorb the transient errors of the mock server
+            # (the failed payloads are left out of the response list)
+            num_failed=num_rows - len(response_list),
+            num_retries=api_executor.request_stats["num_retries"],
+            latency=perf_report["latency"],
+            ttft=perf_report["ttft"],
+        )
+        measurements.append(measurement)
+
+        evaluator = ResponseEvaluatorFactory.get_evaluator(
+            eval_type="reference_based",
+            batch_size=args.eval_batch_size,
+            num_workers=args.eval_workers
+        )
+        try:
+            _, measurement = measure("evaluate", len(response_list), lambda: evaluator.evaluate_response(
+                input_payloads=input_payloads,
+                response_list=response_list,
+                results_path=results_path,
+                reset=True
+            ), args.verbose)
+        finally:
+            evaluator.close()
+        measurements.append(measurement)
+
+    return [{**case, **measurement} for measurement in measurements if measurement["stage"] in args.stages]
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the evaluation pipeline on synthetic datasets and a mock LLM server.")
+    parser.add_argument("--task_types", type=str, nargs="+", help="Task types of the synthetic datasets", default=["QG"], choices=["QG", "SUM"])
+    parser.add_argument("--num_rows", type=int, nargs="+", help="Dataset sizes", default=[1000, 10000])
+    parser.add_argument("--text_lengths", type=int, nargs="+", help="Words of the paragraph/article of each row", default=[100, 500])
+    parser.add_argument("--num_unique_inputs", type=int, help="Distinct paragraphs/articles of each dataset (default: all distinct)", default=None)
+    parser.add_argument("--stages", type=str, nargs="+", help="Stages to report", default=STAGES, choices=STAGES)
+    parser.add_argument("--seed", type=int, help="Seed of the synthetic datasets", default=0)
+
+    parser.add_argument("--latency", type=float, help="Seconds before the first token of each mock completion", default=0.01)
+    parser.add_argument("--token_rate", type=float, help="Completion tokens per second of each mock request (0: no delay)", default=0.0)
+    parser.add_argument("--error_rate", type=float, help="Fraction of mock requests that fail with a 500 error", default=0.0)
+    parser.add_argument("--completion_tokens", type=int, help="Completion tokens of each mock response", default=16)
+
+    parser.add_argument("--num_servers", type=int, help="Mock servers, load-balanced by the ollama executor", default=1)
+    parser.add_argument("--api_type", type=str, help="API executor of the fetch stage", default="openai", choices=["openai", "ollama"])
+    parser.add_argument("--concurrency", type=int, help="Number of API requests in flight", default=8)
+    parser.add_argument("--max_retries", type=int, help="Max number of retries of a request", default=5)
+    parser.add_argument("--stream_completions", action="store_true", help="Stream the completions")
+    parser.add_argument("--payload_workers", type=int, help="Number of processes that build the payloads", default=1)
+    parser.add_argument("--eval_batch_size", type=int, help="Number of responses scored per batch", default=2000)
+    parser.add_argument("--eval_workers", type=int, help="Number of processes that score responses in parallel", default=1)
+
+    parser.add_argument("--output_path", type=str, help="Benchmark results file (default: benchmarks/results/{time}.json)", default=None)
+    parser.add_argument("--baseline", type=str, help="Benchmark results file to compare the results with", default=None)
+    parser.add_argument("--threshold", type=float, help="Slowdown over the baseline reported as a regression", default=0.1)
+    parser.add_argument("--verbose", action="store_true", help="Print the output of the stages")
+    return parser
+
+
+def main(args):
+    output_path = args.output_path or os.path.join("benchmarks", "results", f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    config = {key: value for key, value in vars(args).items() if key not in ("output_path", "baseline", "threshold", "verbose")}
+
+    print(f"[[Benchmarks]]")
+    results = []
+    with ExitStack() as stack:
+        servers = [stack.enter_context(MockServer(
+            latency=args.latency,
+            token_rate=args.token_rate,
+            error_rate=args.error_rate,
+            completion_tokens=args.completion_tokens,
+            seed=args.seed + index,
+        )) for index in range(args.num_servers)]
+        base_url = ",".join(server.base_url for server in servers)
+        for task_type in args.task_types:
+            for num_rows in args.num_rows:
+                for text_length in args.text_lengths:
+                    work_dir = tempfile.mkdtemp(prefix="iitp-benchmark-")
+                    try:
+                        case_results = run_case(args, base_url, task_type, num_rows, text_length, work_dir)
+                    finally:
+                        shutil.rmtree(work_dir, ignore_errors=True)
+                    for result in case_results:
+                        print(f"- {task_type} {num_rows} rows x {text_length} words | {result['stage']:<8} | "
+                              f"{result['seconds']:>8.2f}s | {result['rows_per_sec'] or 0:>10.1f} rows/sec | "
+                              f"peak {result['peak_rss_mb']:>7.1f} MB (+{result['peak_rss_delta_mb']:.1f} MB)")
+                        if result.get("num_failed"):
+                            print(f"  Dropped {result['num_failed']} of {result['num_rows']} payloads after their retries.")
+                    results.extend(case_results)
+
+    benchmark = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(benchmark, f, indent=2)
+    print(f"Saved the benchmark results to '{output_path}'.")
+
+    num_failed = sum(result.get("num_failed", 0) for result in results)
+    is_regression = num_failed > 0
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        rows = compare_results(baseline, benchmark, args.threshold)
+        print_comparison(rows)
+        is_regression = is_regression or any(row["regression"] for row in rows)
+    if is_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -0,0 +1,49 @@
+import random
+
+_VOCABULARY = (
+    "the of and to in is was for on that with as by at from his an were are which this be has "
+    "had it or first not their its new after but who they have two been one also other more time "
+    "students learning textbook digital project debate question answer lesson school teacher class "
+    "history science language world city year model data system group study result team game"
+).split()
+
+
+def get_text(rng, num_words):
+    return " ".join(rng.choice(_VOCABULARY) for _ in range(num_words))
+
+
+def make_rows(task_type, num_rows, text_length, num_unique_inputs=None, seed=0):
+    """Returns the rows of a synthetic dataset of a task type.
+
+    Args:
+        task_type (str): QG or SUM.
+        num_rows (int): The number of rows.
+        text_length (int): The number of words of the main input text (the paragraph or article).
+        num_unique_inputs (int): The number of distinct main input texts, to
+            simulate paragraphs shared by several rows (default: all distinct).
+        seed (int): The seed of the generated texts.
+
+    Returns:
+        list: The rows, as dicts.
+    """
+    rng = random.Random(seed)
+    num_unique_inputs = num_unique_inputs or num_rows
+    texts = [get_text(rng, text_length) for _ in range(min(num_unique_inputs, num_rows))]
+    rows = []
+    for index in range(num_rows):
+        text = texts[index % len(texts)]
+        if task_type == "QG":
+            answer = " ".join(rng.sample(text.split(), 3))
+            rows.append({"paragraph": text, "answer": answer, "question": f"what is {answer} {get_text(rng, 6)}"})
+        elif task_type == "SUM":
+            rows.append({"article": text, "summary": " ".join(text.split()[:max(8, text_length // 10)])})
+        else:
+            raise ValueError(f"Unsupported task type: {task_type}")
+    return rows
+
+
+def make_dataset(task_type, num_rows, text_length, num_unique_inputs=None, seed=0):
+    """Returns a synthetic `datasets.Dataset` of a task type (see `make_rows`)."""
+    import datasets
+
+    return datasets.Dataset.from_list(make_rows(task_type, num_rows, text_length, num_unique_inputs, seed))
@@ -1,7 +1,39 @@
 import os
+import json
+import time
+import asyncio
 import jsonlines
+from collections import deque
 from tqdm import tqdm
-from openai import OpenAI
+
+from lib.cache import get_cache_key
+from lib.completion_stream import CompletionStreamReader
+from lib.payload_dedup import PayloadDeduplicator, sort_by_prefix, get_shared_prefix_ratio
+from lib.load_balancer import EndpointPool
+from lib.rate_limiter import (
+    RateLimiter,
+    RetryPolicy,
+    CircuitOpenError,
+    get_retry_after,
+    is_rate_limit_error,
+    is_retryable_error,
+)
+from lib.utils import (
+    get_payload_hash,
+    load_keyed_records,
+    index_keyed_records,
+    read_record,
+    save_records,
+    ensure_trailing_newline,
+)
+
+# Max number of buffered responses in streaming mode, per unit of concurrency
+STREAM_WINDOW_SIZE = 4
+
+# Max number of requests in a batch input file of the OpenAI Batch API
+BATCH_MAX_REQUESTS = 50000
+BATCH_POLL_INTERVAL = 30
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
 
 class AbstractAPIExecutor:
@@ -28,9 +60,59 @@ class AbstractAPIExecutor:
     
     
 class OpenaiAPIExecutor(AbstractAPIExecutor):
-    def __init__(self, model, api_key):
+    """
+    Sends one chat completion request per payload to an OpenAI-compatible API.
+
+    With `stream`, each completion is streamed and read chunk by chunk, which
+    measures its time-to-first-token and inter-token latency and lets the
+    client stop reading at `max_completion_tokens` or a `stop` sequence.
+
+    With `dedup_payloads`, exact-duplicate payloads are fetched once (see
+    `PayloadDeduplicator`), and with `prefix_order`, the payloads are sent in
+    prompt prefix order so that the server reuses its prompt cache.
+    """
+    api_type = "openai"
+    
+    def __init__(self, model, api_key, concurrency=1, response_cache=None, rate_limiter=None, max_retries=5, base_url=None, stream=False, max_completion_tokens=None, stop=None, dedup_payloads=False, prefix_order=False):
         super().__init__(model, api_key, 0)
-        self.client = OpenAI(api_key=api_key)
+        self.concurrency = concurrency
+        self.response_cache = response_cache
+        self.stream = stream
+        self.max_completion_tokens = max_completion_tokens
+        self.stop = stop
+        self.deduplicator = PayloadDeduplicator() if dedup_payloads else None
+        self.prefix_order = prefix_order
+        # Retries are handled by the executor, so that they go through the rate limiter
+        self.client_kwargs = {"api_key": api_key, "max_retries": 0}
+        if base_url is not None:
+            self.client_kwargs["base_url"] = base_url
+        self._client = None
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.retry_policy = RetryPolicy(max_retries)
+        self.num_completion_tokens = 0
+        self.num_completions = 0
+        # Progress of the requests, read by the run monitor while the responses are fetched
+        self.num_in_flight = 0
+        self.num_saved_responses = 0
+        self.num_failed_responses = 0
+        self.request_stats = {
+            "num_requests": 0,
+            "num_retries": 0,
+            "num_rate_limited": 0,
+            "num_throttled": 0,
+            "throttle_time": 0.0,
+            "num_short_circuited": 0,
+            "num_deduplicated": 0,
+            "num_deduplicated_tokens": 0,
+        }
+    
+    @property
+    def client(self):
+        """The OpenAI client, created on first use so that a fully cached run never imports `openai`."""
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(**self.client_kwargs)
+        return self._client
     
     def fetch_response(self, **kwargs):
         input_payloads = kwargs['input_payloads']
@@ -39,91 +121,811 @@ class OpenaiAPIExecutor(AbstractAPIExecutor):
         print(f"[[Fetching responses]]")
         
         # Step 1: Check to cached response
-        response_list = []
-        if kwargs['reset'] is True:         # TODO: Fix this
-            pass
+        response_map = {}
+        if kwargs['reset'] is True:
+            if os.path.exists(kwargs['response_path']):
+                os.remove(kwargs['response_path'])
         else:
-            response_list = self.load_cached_response(kwargs['response_path'])
-            self.num_responses = len(response_list)
+            response_map = self.load_cached_response(kwargs['response_path'], input_payloads)
+            self.num_responses = len(response_map)
             
             print(f"- Num of payloads: {self.num_payloads}")
             print(f"- Num of responses: {self.num_responses}")
             
             if self.num_responses == self.num_payloads:
                 print(f"Successfully loaded the cached responses!")
-                return response_list 
+                return [response_map[payload["id"]] for payload in input_payloads]
             elif self.num_responses > 0:
                 print(f"Continuing from {self.num_responses} cached responses...")
             
-        # Step 2: Fetch the responses
-        for payload in tqdm(
-            input_payloads[self.num_responses:],
-            desc="Fetching responses",
-        ):
+        # Step 2: Fetch the missing or failed responses
+        missing_payloads = [payload for payload in input_payloads if payload["id"] not in response_map]
+        self._report_input_tokens(missing_payloads)
+        missing_payloads = self._prepare_payloads(missing_payloads)
+        start_time = time.perf_counter()
+        if self.concurrency > 1:
+            output_responses = asyncio.run(self._fetch_response_async(missing_payloads, kwargs['response_path']))
+        else:
+            output_responses = []
+            for payload in tqdm(
+                missing_payloads,
+                desc="Fetching responses",
+            ):
+                output_response = self._fetch_single_response(payload, kwargs['response_path'])
+                output_responses.append(output_response)
+                output_responses.extend(self._fan_out(output_response, kwargs['response_path']))
+        
+        num_fetched = 0
+        for output_response in output_responses:
+            if "error" not in output_response:
+                response_map[output_response["id"]] = output_response
+                num_fetched += "duplicate_of" not in output_response
+        self._report_throughput(num_fetched, time.perf_counter() - start_time)
+        
+        # Step 3: Compact the checkpoint file in payload order
+        response_list = [response_map[payload["id"]] for payload in input_payloads if payload["id"] in response_map]
+        save_records(response_list, kwargs['response_path'])
+        
+        num_failed = self.num_payloads - len(response_list)
+        if num_failed > 0:
+            print(f"- Num of failed responses: {num_failed} (re-run to fill them in)")
+            
+        return response_list
+    
+    def _fetch_single_response(self, payload, response_path):
+        output_response = self._get_cached_output_response(payload)
+        if output_response is None:
             try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=payload["messages"],
-                    temperature=payload["temperature"],
-                )
-                output_response = {
-                    "generated_response": response.choices[0].message.content,
-                }
-                self.save_response(output_response, kwargs['response_path'])
-                
-                response_list.append(output_response)
-                
+                response, request_metrics = self._create_completion(payload)
+                output_response = self._get_output_response(payload, response, request_metrics)
+            except Exception as e:
+                print(f"Error during fetching response: {e}")
+                output_response = self._get_error_response(payload, e)
+        self.save_response(output_response, response_path)
+        return output_response
+    
+    async def _fetch_response_async(self, input_payloads, response_path):
+        """Fetch the responses with up to `self.concurrency` requests in flight.
+
+        Each response is appended to the checkpoint file as soon as it completes.
+        Responses are keyed by payload id, so the completion order does not matter.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        output_responses = []
+        async with self._create_async_client() as client:
+            tasks = [self._fetch_single_response_async(payload, client, semaphore) for payload in input_payloads]
+            for task in tqdm(
+                asyncio.as_completed(tasks),
+                total=len(tasks),
+                desc=f"Fetching responses (concurrency={self.concurrency})",
+            ):
+                output_response = await task
+                self.save_response(output_response, response_path)
+                output_responses.append(output_response)
+                output_responses.extend(self._fan_out(output_response, response_path))
+                    
+        return output_responses
+    
+    async def _fetch_single_response_async(self, payload, client, semaphore):
+        output_response = self._get_cached_output_response(payload)
+        if output_response is not None:
+            return output_response
+        
+        async with semaphore:
+            try:
+                response, request_metrics = await self._create_completion_async(payload, client)
+                return self._get_output_response(payload, response, request_metrics)
             except Exception as e:
                 print(f"Error during fetching response: {e}")
+                return self._get_error_response(payload, e)
+    
+    def _prepare_payloads(self, payloads):
+        """Drops the duplicate payloads and orders the others by prompt prefix, as configured."""
+        if self.deduplicator is not None:
+            payloads = self.deduplicator.dedup(payloads)
+            self._update_dedup_stats()
+        if self.prefix_order:
+            shared_prefix_ratio = get_shared_prefix_ratio(payloads)
+            payloads = sort_by_prefix(payloads)
+            self.request_stats["shared_prefix_ratio"] = round(get_shared_prefix_ratio(payloads), 4)
+            print(f"- Shared prompt prefixes: {shared_prefix_ratio:.1%} -> {self.request_stats['shared_prefix_ratio']:.1%} "
+                  f"of the prompt characters (ordered by prefix)")
+        return payloads
+    
+    def _fan_out(self, output_response, response_path):
+        """Saves and returns the copies of an output response for the duplicates of its payload."""
+        if self.deduplicator is None:
+            return []
+        duplicate_responses = self.deduplicator.fan_out(output_response)
+        for duplicate_response in duplicate_responses:
+            self.save_response(duplicate_response, response_path)
+        return duplicate_responses
+    
+    def _update_dedup_stats(self):
+        self.request_stats["num_deduplicated"] = self.deduplicator.num_duplicates
+        self.request_stats["num_deduplicated_tokens"] = self.deduplicator.num_saved_tokens
+    
+    def _create_completion(self, payload):
+        """Sends the chat completion request of a payload, throttled by the rate limiter.
+
+        Transient errors (rate limits, timeouts, connection and server errors)
+        are retried with jittered exponential backoff; any other error, or the
+        last failed attempt, is raised.
+
+        Returns:
+            tuple: The parsed response and the metrics of the request.
+        """
+        num_tokens = self._estimate_num_tokens(payload)
+        start_time = time.perf_counter()
+        for attempt in range(self.retry_policy.max_retries + 1):
+            time.sleep(self._get_throttle_delay(num_tokens))
+            try:
+                self.num_in_flight += 1
+                try:
+                    raw_response = self._send_request(payload)
+                finally:
+                    self.num_in_flight -= 1
+            except Exception as e:
+                retry_delay = self._get_retry_delay(e, attempt, num_tokens)
+                if retry_delay is None:
+                    raise
+                time.sleep(retry_delay)
+                continue
+            return self._parse_raw_response(raw_response, num_tokens), self._get_request_metrics(raw_response, start_time, attempt)
+    
+    async def _create_completion_async(self, payload, client):
+        num_tokens = self._estimate_num_tokens(payload)
+        start_time = time.perf_counter()
+        for attempt in range(self.retry_policy.max_retries + 1):
+            await asyncio.sleep(self._get_throttle_delay(num_tokens))
+            try:
+                self.num_in_flight += 1
+                try:
+                    raw_response = await self._send_request_async(payload, client)
+                finally:
+                    self.num_in_flight -= 1
+            except Exception as e:
+                retry_delay = self._get_retry_delay(e, attempt, num_tokens)
+                if retry_delay is None:
+                    raise
+                await asyncio.sleep(retry_delay)
+                continue
+            return self._parse_raw_response(raw_response, num_tokens), self._get_request_metrics(raw_response, start_time, attempt)
+    
+    def _create_async_client(self):
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(**self.client_kwargs)
+    
+    def _send_request(self, payload):
+        return self._request_completion(self.client, payload)
+    
+    async def _send_request_async(self, payload, client):
+        return await self._request_completion_async(client, payload)
+    
+    def _request_completion(self, client, payload):
+        if not self.stream:
+            return client.chat.completions.with_raw_response.create(**self._get_request_kwargs(payload))
+        
+        stream_reader = self._create_stream_reader(payload)
+        raw_response = client.chat.completions.with_raw_response.create(**self._get_request_kwargs(payload))
+        stream = raw_response.parse()
+        try:
+            for chunk in stream:
+                if stream_reader.add_chunk(chunk):
+                    break
+        finally:
+            # Closing the connection early stops the generation on the server
+            stream.close()
+        return stream_reader.get_response(raw_response)
+    
+    async def _request_completion_async(self, client, payload):
+        if not self.stream:
+            return await client.chat.completions.with_raw_response.create(**self._get_request_kwargs(payload))
+        
+        stream_reader = self._create_stream_reader(payload)
+        raw_response = await client.chat.completions.with_raw_response.create(**self._get_request_kwargs(payload))
+        stream = raw_response.parse()
+        try:
+            async for chunk in stream:
+                if stream_reader.add_chunk(chunk):
+                    break
+        finally:
+            await stream.close()
+        return stream_reader.get_response(raw_response)
+    
+    def _get_request_kwargs(self, payload):
+        request_kwargs = {
+            "model": self.model,
+            "messages": payload["messages"],
+            "temperature": payload["temperature"],
+        }
+        if self.stream:
+            request_kwargs["stream"] = True
+            request_kwargs["stream_options"] = {"include_usage": True}
+        return request_kwargs
+    
+    def _create_stream_reader(self, payload):
+        return CompletionStreamReader(self.max_completion_tokens, self.stop, payload.get("num_input_tokens"))
+    
+    def _estimate_num_tokens(self, payload):
+        """Returns an estimate of the prompt and completion tokens of a payload, for the tokens-per-minute limit.
+
+        The prompt tokens are the input tokens counted when the payload was
+        created, or a rough estimate from its length.
+        """
+        num_prompt_tokens = payload.get("num_input_tokens")
+        if num_prompt_tokens is None:
+            num_prompt_tokens = sum(len(message["content"]) for message in payload["messages"]) // 4
+        num_completion_tokens = self.num_completion_tokens // self.num_completions if self.num_completions > 0 else 0
+        return num_prompt_tokens + num_completion_tokens
+    
+    def _report_input_tokens(self, payloads):
+        """Prints the input tokens of the payloads to send, and the least time they take under the tokens-per-minute limit."""
+        if not payloads or "num_input_tokens" not in payloads[0]:
+            return
+        num_input_tokens = sum(payload["num_input_tokens"] for payload in payloads)
+        message = f"- Num of input tokens to send: {num_input_tokens}"
+        if self.rate_limiter.token_bucket is not None:
+            limit = self.rate_limiter.token_bucket.limit
+            message += f" (at least {num_input_tokens / limit:.1f} min at {limit} tokens/min)"
+        print(message)
+    
+    def _get_throttle_delay(self, num_tokens):
+        """Reserves a request in the rate limiter and returns the seconds to wait before sending it."""
+        delay = self.rate_limiter.reserve(num_tokens)
+        self.request_stats["num_requests"] += 1
+        if delay > 0:
+            self.request_stats["num_throttled"] += 1
+            self.request_stats["throttle_time"] = round(self.request_stats["throttle_time"] + delay, 3)
+        return delay
+    
+    def _get_retry_delay(self, error, attempt, num_tokens):
+        """Returns the seconds to wait before retrying a failed request, or None if it should not be retried."""
+        # A failed request does not count toward the tokens-per-minute limit
+        self.rate_limiter.correct_tokens(-num_tokens)
+        if getattr(error, "response", None) is not None:
+            self.rate_limiter.update_from_headers(error.response.headers)
+        
+        if not is_retryable_error(error) or attempt >= self.retry_policy.max_retries:
+            return None
+        
+        delay = self.retry_policy.get_delay(attempt, get_retry_after(error))
+        if is_rate_limit_error(error):
+            # Hold back every request, not only this one, until the limit resets
+            self.rate_limiter.pause(delay)
+            self.request_stats["num_rate_limited"] += 1
+        self.request_stats["num_retries"] += 1
+        return delay
+    
+    def _parse_raw_response(self, raw_response, num_tokens):
+        self.rate_limiter.update_from_headers(raw_response.headers)
+        response = raw_response.parse()
+        if response.usage is not None:
+            self.rate_limiter.correct_tokens(response.usage.total_tokens - num_tokens)
+        return response
+    
+    def _get_request_metrics(self, raw_response, start_time, num_retries):
+        """Returns the metrics of a request that succeeded after `num_retries` retries.
+
+        `latency` is the time of the successful HTTP request, and `total_time`
+        also includes the throttling, the failed attempts and the backoff.
+        """
+        url = raw_response.http_request.url
+        request_metrics = {
+            "latency": round(raw_response.elapsed.total_seconds(), 4),
+            "total_time": round(time.perf_counter() - start_time, 4),
+            "num_retries": num_retries,
+            "endpoint": f"{url.scheme}://{url.netloc.decode('ascii')}",
+        }
+        # Streamed responses also time their first token and the tokens after it
+        request_metrics.update(getattr(raw_response, "stream_metrics", {}))
+        return request_metrics
+    
+    def iter_response(self, **kwargs):
+        """Yields a (payload, response) pair for each payload, in payload order.
+
+        Unlike `fetch_response`, the payloads may be any iterable and neither the
+        payloads nor the responses are kept in memory. Cached responses are read
+        back through a byte-offset index of the checkpoint file, and each fetched
+        response is appended to it as soon as it is yielded. A failed response
+        is yielded as its error record.
+        """
+        response_path = kwargs['response_path']
+        
+        print(f"[[Fetching responses (streaming)]]")
+        
+        # Step 1: Index the cached responses
+        offsets = {}
+        if kwargs['reset'] is True:
+            if os.path.exists(response_path):
+                os.remove(response_path)
+        elif os.path.exists(response_path):
+            print(f"Indexing cached responses at '{response_path}'...")
+            offsets, _ = index_keyed_records(response_path)
+            ensure_trailing_newline(response_path)
+            print(f"- Num of cached response records: {len(offsets)}")
+        
+        # Step 2: Yield the cached responses and fetch the missing or failed ones
+        cached_file = open(response_path, "rb") if offsets else None
+        
+        num_cached = 0
+        
+        def get_cached_response(payload):
+            nonlocal num_cached
+            if payload["id"] not in offsets:
+                return None
+            response = read_record(cached_file, offsets[payload["id"]])
+            if not self._is_valid_cached_response(payload, response):
+                return None
+            num_cached += 1
+            return response
+        
+        def fetch_single_response(payload):
+            response = self._get_duplicate_response(payload, response_path)
+            if response is None:
+                response = self._fetch_single_response(payload, response_path)
+                self._add_recent_response(payload, response)
+            return response
+        
+        num_responses = 0
+        start_time = time.perf_counter()
+        try:
+            if self.concurrency > 1:
+                response_iter = self._iter_response_async(kwargs['input_payloads'], get_cached_response, response_path)
+            else:
+                response_iter = (
+                    (payload, get_cached_response(payload) or fetch_single_response(payload))
+                    for payload in kwargs['input_payloads']
+                )
+            for payload, response in response_iter:
+                num_responses += 1
+                yield payload, response
+        finally:
+            if cached_file is not None:
+                cached_file.close()
+            num_deduplicated = 0
+            if self.deduplicator is not None:
+                self._update_dedup_stats()
+                num_deduplicated = self.deduplicator.num_duplicates
+            self._report_throughput(num_responses - num_cached - num_deduplicated, time.perf_counter() - start_time)
+    
+    def _get_duplicate_response(self, payload, response_path):
+        """Returns a copy of the recent response of a duplicate of the payload in streaming mode, or None."""
+        if self.deduplicator is None:
+            return None
+        response = self.deduplicator.get_recent_response(payload)
+        if response is None or isinstance(response, asyncio.Task):
+            return response
+        response = self.deduplicator.copy_response(response, payload)
+        self.save_response(response, response_path)
+        return response
+    
+    def _add_recent_response(self, payload, response):
+        """Keeps a fetched response (or the pending task of the request) to answer the duplicates of the payload."""
+        if self.deduplicator is None or (isinstance(response, dict) and "error" in response):
+            return
+        self.deduplicator.add_recent_response(payload, response)
+    
+    def _iter_response_async(self, input_payloads, get_cached_response, response_path):
+        """Yields the (payload, response) pairs in order, keeping up to `self.concurrency` requests in flight.
+
+        The pending requests form a sliding window over the payloads. Waiting on
+        the oldest one runs the event loop, so the rest of the window keeps
+        making progress in the meantime.
+        """
+        loop = asyncio.new_event_loop()
+        client = self._create_async_client()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        window = deque()
+        num_in_flight = 0
+        
+        def pop_response():
+            nonlocal num_in_flight
+            payload, response = window.popleft()
+            if isinstance(response, asyncio.Task):
+                response = loop.run_until_complete(response)
+                if response["id"] == payload["id"]:
+                    num_in_flight -= 1
+                else:
+                    # The task of an earlier duplicate of the payload
+                    response = self.deduplicator.copy_response(response, payload)
+                self.save_response(response, response_path)
+            return payload, response
+        
+        try:
+            for payload in input_payloads:
+                response = get_cached_response(payload)
+                if response is None:
+                    response = self._get_duplicate_response(payload, response_path)
+                if response is None:
+                    response = loop.create_task(self._fetch_single_response_async(payload, client, semaphore))
+                    self._add_recent_response(payload, response)
+                    num_in_flight += 1
+                window.append((payload, response))
+                
+                while num_in_flight >= self.concurrency or len(window) > STREAM_WINDOW_SIZE * self.concurrency:
+                    yield pop_response()
             
-        return response_list
+            while window:
+                yield pop_response()
+        finally:
+            pending_tasks = [response for _, response in window if isinstance(response, asyncio.Task)]
+            for task in pending_tasks:
+                task.cancel()
+            if pending_tasks:
+                loop.run_until_complete(asyncio.wait(pending_tasks))
+            loop.run_until_complete(client.close())
+            loop.close()
+    
+    def _get_output_response(self, payload, response, request_metrics=None):
+        """Returns the output record of a fetched response, with the request metrics and token usage under `metrics`."""
+        metrics = dict(request_metrics or {})
+        if response.usage is not None:
+            self.num_completion_tokens += response.usage.completion_tokens
+            self.num_completions += 1
+            metrics["prompt_tokens"] = response.usage.prompt_tokens
+            metrics["completion_tokens"] = response.usage.completion_tokens
+        output_response = {
+            "id": payload["id"],
+            "payload_hash": get_payload_hash(payload),
+            "generated_response": response.choices[0].message.content,
+        }
+        if metrics:
+            output_response["metrics"] = metrics
+        # A completion cut short by the client-side budget is not shared with runs without it
+        if self.response_cache is not None and "stopped_early" not in metrics:
+            self.response_cache.put(
+                self._get_response_cache_key(payload),
+                {"generated_response": output_response["generated_response"]},
+            )
+        return output_response
+    
+    def _get_cached_output_response(self, payload):
+        """Returns the output response from the shared response cache, or None on a miss."""
+        if self.response_cache is None:
+            return None
+        cached_response = self.response_cache.get(self._get_response_cache_key(payload))
+        if cached_response is None:
+            return None
+        return {
+            "id": payload["id"],
+            "payload_hash": get_payload_hash(payload),
+            "generated_response": cached_response["generated_response"],
+        }
+    
+    def _get_response_cache_key(self, payload):
+        return get_cache_key(self.api_type, self.model, payload["messages"], payload["temperature"])
+    
+    def _get_error_response(self, payload, error):
+        return {
+            "id": payload["id"],
+            "payload_hash": get_payload_hash(payload),
+            "error": str(error),
+        }
+    
+    def _report_throughput(self, num_requests, elapsed_time):
+        if self.deduplicator is not None:
+            self.deduplicator.report()
+        if self.response_cache is not None:
+            print(f"- Response cache: {self.response_cache.num_hits} hits, {self.response_cache.num_misses} misses")
+        if self.request_stats["num_requests"] > 0:
+            print(f"- Requests: {self.request_stats['num_requests']} sent, "
+                  f"{self.request_stats['num_retries']} retried ({self.request_stats['num_rate_limited']} rate limited), "
+                  f"{self.request_stats['num_throttled']} throttled ({self.request_stats['throttle_time']:.1f}s), "
+                  f"{self.request_stats['num_short_circuited']} short-circuited")
+        if num_requests == 0 or elapsed_time == 0:
+            return
+        print(f"- Num of fetched responses: {num_requests} ({elapsed_time:.1f}s)")
+        print(f"- Throughput: {num_requests / elapsed_time:.2f} requests/sec, "
+              f"{self.num_completion_tokens / elapsed_time:.2f} tokens/sec")
     
     def save_response(self, response, response_path):
+        self.num_saved_responses += 1
+        self.num_failed_responses += "error" in response
         os.makedirs(os.path.dirname(response_path), exist_ok=True)
         with jsonlines.open(response_path, mode="a") as writer:
             writer.write(response)
     
-    def load_cached_response(self, response_path):
+    def load_cached_response(self, response_path, input_payloads):
+        """Returns the cached responses that are still valid, keyed by payload id.
+
+        A cached response is dropped if it recorded an error or if its payload
+        hash no longer matches the payload (e.g. the prompt has changed).
+        """
         print(f"Checking for cached responses...")
         
         if os.path.exists(response_path):
             print(f"Response already exists at '{response_path}'.")
-            response_list = []
-            with jsonlines.open(response_path, mode="r") as reader:
-                for line in reader:
-                    response_list.append(line)
-            return response_list
+            cached_responses, num_lines = load_keyed_records(response_path)
+            response_map = {}
+            for payload in input_payloads:
+                response = cached_responses.get(payload["id"])
+                if response is not None and self._is_valid_cached_response(payload, response):
+                    response_map[payload["id"]] = response
+            
+            # Drop stale, failed or truncated lines before appending new responses
+            if num_lines != len(response_map):
+                save_records(list(response_map.values()), response_path)
+            return response_map
         else:
             print(f"No cached responses found.")
-            return []
+            return {}
+    
+    def _is_valid_cached_response(self, payload, response):
+        if "error" in response:
+            return False
+        return "payload_hash" not in response or response["payload_hash"] == get_payload_hash(payload)
         
 
 class OllamaAPIExecutor(OpenaiAPIExecutor):
-    def __init__(self, model, api_key):
-        super().__init__(model, api_key)
-        self.client = OpenAI(
-            base_url="http://localhost:11434/v1",
-            api_key="ollama",
+    """
+    Sends the requests to one or more Ollama servers serving the same model.
+
+    `base_url` may list several servers separated by commas; the requests are
+    then load-balanced over them. A server that keeps failing is ejected for
+    a while; once every server is ejected, the requests wait until the first
+    one may be probed again and are retried then, each wait counting as a
+    retry.
+    """
+    api_type = "ollama"
+    
+    def __init__(self, model, api_key, concurrency=1, response_cache=None, rate_limiter=None, max_retries=5, base_url=None, stream=False, max_completion_tokens=None, stop=None, dedup_payloads=False, prefix_order=False):
+        super().__init__(model, api_key, concurrency, response_cache, rate_limiter, max_retries, None, stream, max_completion_tokens, stop, dedup_payloads, prefix_order)
+        base_urls = (base_url or "http://localhost:11434/v1").split(",")
+        self.endpoint_pool = EndpointPool([url.strip() for url in base_urls], api_key="ollama")
+        self.client_kwargs = self.endpoint_pool.endpoints[0].client_kwargs
+    
+    def _create_async_client(self):
+        return self.endpoint_pool.create_async_clients()
+    
+    def _send_request(self, payload):
+        endpoint = self._acquire_endpoint()
+        start_time = time.perf_counter()
+        try:
+            raw_response = self._request_completion(endpoint.client, payload)
+        except Exception as e:
+            self.endpoint_pool.release(endpoint, start_time, e)
+            raise
+        self.endpoint_pool.release(endpoint, start_time)
+        return raw_response
+    
+    async def _send_request_async(self, payload, client):
+        endpoint = self._acquire_endpoint()
+        start_time = time.perf_counter()
+        try:
+            raw_response = await self._request_completion_async(client[endpoint], payload)
+        except Exception as e:
+            self.endpoint_pool.release(endpoint, start_time, e)
+            raise
+        self.endpoint_pool.release(endpoint, start_time)
+        return raw_response
+    
+    def _acquire_endpoint(self):
+        try:
+            return self.endpoint_pool.acquire()
+        except CircuitOpenError:
+            self.request_stats["num_short_circuited"] += 1
+            raise
+    
+    def _report_throughput(self, num_requests, elapsed_time):
+        super()._report_throughput(num_requests, elapsed_time)
+        if len(self.endpoint_pool.endpoints) > 1 or self.endpoint_pool.endpoints[0].num_failures > 0:
+            self.endpoint_pool.report()
+    
+    
+class BatchAPIExecutor(OpenaiAPIExecutor):
+    """
+    Fetches the responses through the OpenAI Batch API instead of one request per payload.
+
+    The missing payloads are uploaded as batch input files, and the batch
+    results are mapped back to their payloads by `custom_id` into the usual
+    output records. The ids of the submitted batches are kept next to the
+    response file, so an interrupted run resumes polling them instead of
+    submitting (and paying for) the payloads again.
+    """
+    api_type = "openai_batch"
+    
+    def fetch_response(self, **kwargs):
+        input_payloads = kwargs['input_payloads']
+        response_path = kwargs['response_path']
+        batch_state_path = f"{response_path}.batches.json"
+        self.num_payloads = len(input_payloads)
+        
+        print(f"[[Fetching responses (batch)]]")
+        
+        # Step 1: Check to cached response
+        response_map = {}
+        if kwargs['reset'] is True:
+            for path in (response_path, batch_state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        else:
+            response_map = self.load_cached_response(response_path, input_payloads)
+            self.num_responses = len(response_map)
+            
+            print(f"- Num of payloads: {self.num_payloads}")
+            print(f"- Num of responses: {self.num_responses}")
+            
+            if self.num_responses == self.num_payloads:
+                print(f"Successfully loaded the cached responses!")
+                return [response_map[payload["id"]] for payload in input_payloads]
+        
+        # Step 2: Submit the missing payloads, unless their batches are already running
+        missing_payloads = []
+        for payload in input_payloads:
+            if payload["id"] in response_map:
+                continue
+            output_response = self._get_cached_output_response(payload)
+            if output_response is not None:
+                self.save_response(output_response, response_path)
+                response_map[payload["id"]] = output_response
+            else:
+                missing_payloads.append(payload)
+        missing_payloads = self._prepare_payloads(missing_payloads)
+        
+        start_time = time.perf_counter()
+        if os.path.exists(batch_state_path):
+            with open(batch_state_path, "r") as f:
+                batch_ids = json.load(f)["batch_ids"]
+            print(f"Resuming {len(batch_ids)} submitted batches...")
+        else:
+            batch_ids = self._submit_batches(missing_payloads, response_path) if missing_payloads else []
+            with open(batch_state_path, "w") as f:
+                json.dump({"batch_ids": batch_ids}, f)
+        
+        # Step 3: Wait for the batches and map their results back to the payloads
+        payload_map = {self._get_custom_id(payload): payload for payload in missing_payloads}
+        num_fetched = 0
+        for batch_id in batch_ids:
+            batch = self._wait_for_batch(batch_id)
+            for output_response in self._iter_batch_results(batch, payload_map):
+                self.save_response(output_response, response_path)
+                if "error" not in output_response:
+                    num_fetched += 1
+                for response in [output_response] + self._fan_out(output_response, response_path):
+                    if "error" not in response:
+                        response_map[response["id"]] = response
+        os.remove(batch_state_path)
+        self._report_throughput(num_fetched, time.perf_counter() - start_time)
+        
+        # Step 4: Compact the checkpoint file in payload order
+        response_list = [response_map[payload["id"]] for payload in input_payloads if payload["id"] in response_map]
+        save_records(response_list, response_path)
+        
+        num_failed = self.num_payloads - len(response_list)
+        if num_failed > 0:
+            print(f"- Num of failed responses: {num_failed} (re-run to fill them in)")
+            
+        return response_list
+    
+    def iter_response(self, **kwargs):
+        """Yields a (payload, response) pair for each payload, in payload order.
+
+        A batch only completes as a whole, so the payloads are collected and
+        fetched with `fetch_response` first. A payload without a response is
+        yielded with an error record.
+        """
+        input_payloads = list(kwargs['input_payloads'])
+        response_list = self.fetch_response(
+            input_payloads=input_payloads,
+            response_path=kwargs['response_path'],
+            reset=kwargs['reset']
         )
+        response_map = {response["id"]: response for response in response_list}
+        for payload in input_payloads:
+            response = response_map.get(payload["id"])
+            yield payload, response or self._get_error_response(payload, "No response in the batch results.")
     
+    def _submit_batches(self, input_payloads, response_path):
+        """Uploads the payloads as batch input files and returns the ids of the created batches."""
+        batch_client = self.client.with_options(max_retries=self.retry_policy.max_retries)
+        input_path = f"{response_path}.batch_input.jsonl"
+        
+        batch_ids = []
+        for start in range(0, len(input_payloads), BATCH_MAX_REQUESTS):
+            with jsonlines.open(input_path, mode="w") as writer:
+                for payload in input_payloads[start:start + BATCH_MAX_REQUESTS]:
+                    writer.write({
+                        "custom_id": self._get_custom_id(payload),
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {
+                            "model": self.model,
+                            "messages": payload["messages"],
+                            "temperature": payload["temperature"],
+                        },
+                    })
+            with open(input_path, "rb") as f:
+                input_file = batch_client.files.create(file=f, purpose="batch")
+            batch = batch_client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+            batch_ids.append(batch.id)
+            print(f"- Submitted batch '{batch.id}' ({min(BATCH_MAX_REQUESTS, len(input_payloads) - start)} requests)")
+        
+        os.remove(input_path)
+        return batch_ids
     
+    def _wait_for_batch(self, batch_id):
+        batch_client = self.client.with_options(max_retries=self.retry_policy.max_retries)
+        with tqdm(desc=f"Waiting for batch '{batch_id}'") as progress:
+            while True:
+                batch = batch_client.batches.retrieve(batch_id)
+                if batch.request_counts is not None:
+                    progress.total = batch.request_counts.total
+                    progress.n = batch.request_counts.completed + batch.request_counts.failed
+                    progress.refresh()
+                if batch.status in BATCH_FINAL_STATUSES:
+                    break
+                time.sleep(BATCH_POLL_INTERVAL)
+        
+        print(f"- Batch '{batch_id}' {batch.status}")
+        return batch
+    
+    def _iter_batch_results(self, batch, payload_map):
+        """Yields the output records of a finished batch, for the results that match a current payload.
+
+        The results of a payload that has changed since it was submitted are
+        skipped, since its custom id no longer matches.
+        """
+        from openai.types.chat import ChatCompletion
+        
+        batch_client = self.client.with_options(max_retries=self.retry_policy.max_retries)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            for line in batch_client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                payload = payload_map.get(result["custom_id"])
+                if payload is None:
+                    continue
+                response = result.get("response")
+                if response is not None and response["status_code"] == 200:
+                    yield self._get_output_response(payload, ChatCompletion.model_validate(response["body"]))
+                else:
+                    error = result.get("error") or (response or {}).get("body", {}).get("error")
+                    yield self._get_error_response(payload, error)
+    
+    def _get_custom_id(self, payload):
+        return f"{payload['id']}-{get_payload_hash(payload)}"
+
+
 class APIExecutorFactory:
     """
     A factory class to specify API executor based on the API type.
     """
     @staticmethod
-    def get_api_executor(model, api_type, api_key):
+    def get_api_executor(model, api_type, api_key, concurrency=1, response_cache=None, rate_limiter=None, max_retries=5, base_url=None, stream=False, max_completion_tokens=None, stop=None, dedup_payloads=False, prefix_order=False):
         """Return an API executor based on the specified API type.
         
         Args:
             model (str): The model name.
             api_type (str): The API type.
             api_key (str): The API key.
+            concurrency (int): The number of requests to keep in flight.
+            response_cache (SqliteCache): The response cache shared across runs, if any.
+            rate_limiter (RateLimiter): The rate limiter of the requests (default: limits learned from the response headers).
+            max_retries (int): The max number of retries of a request on transient errors.
+            base_url (str): The base URL of the API, to override the default endpoint (e.g. a mock server).
+            stream (bool): Whether to stream the completions, to time their tokens.
+            max_completion_tokens (int): The completion token budget of a streamed completion, enforced client-side.
+            stop (list): The stop sequences of a streamed completion, enforced client-side.
+            dedup_payloads (bool): Whether to fetch exact-duplicate payloads once and fan out their response.
+            prefix_order (bool): Whether to send the payloads in prompt prefix order, to reuse the prompt cache of the server.
         """
         if api_type == 'openai':
-            return OpenaiAPIExecutor(model, api_key)
+            return OpenaiAPIExecutor(model, api_key, concurrency, response_cache, rate_limiter, max_retries, base_url, stream, max_completion_tokens, stop, dedup_payloads, prefix_order)
+        if api_type == 'openai_batch':
+            if stream:
+                raise ValueError("The Batch API does not stream completions.")
+            return BatchAPIExecutor(model, api_key, concurrency, response_cache, rate_limiter, max_retries, base_url, dedup_payloads=dedup_payloads)
         if api_type == 'ollama':
-            return OllamaAPIExecutor(model, api_key)
+            return OllamaAPIExecutor(model, api_key, concurrency, response_cache, rate_limiter, max_retries, base_url, stream, max_completion_tokens, stop, dedup_payloads, prefix_order)
         else:
             raise ValueError(f"Unsupported API type: {api_type}.")
         
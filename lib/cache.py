@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+def get_cache_key(*parts):
+    """Returns a content hash of the given JSON-serializable parts.
+
+    Args:
+        *parts: The values that together determine the cached value.
+
+    Returns:
+        str: The SHA-256 hex digest of the parts.
+    """
+    content = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class SqliteCache:
+    """
+    A persistent key-value cache stored in a SQLite table, shared across runs.
+
+    Values are JSON-serialized. Entries older than `max_age_days` are evicted,
+    and beyond `max_entries` the least recently used entries are evicted.
+    The cache may be shared by several threads, and by several processes as
+    long as the filesystem supports file locks: the rollback journal is used
+    instead of WAL, which needs shared memory between the processes, and the
+    access time of a hit is committed right away so that reads never hold the
+    write lock.
+    """
+    def __init__(self, cache_path, table_name, max_entries=None, max_age_days=None):
+        self.cache_path = cache_path
+        self.table_name = table_name
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.num_hits = 0
+        self.num_misses = 0
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table_name} ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {table_name}_accessed_at ON {table_name} (accessed_at)"
+        )
+        self.connection.commit()
+        self.evict()
+
+    def get(self, key):
+        """Returns the cached value of the key, or None on a miss."""
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT value FROM {self.table_name} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.num_misses += 1
+                return None
+
+            self.num_hits += 1
+            self.connection.execute(
+                f"UPDATE {self.table_name} SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+            self.connection.commit()
+            return json.loads(row[0])
+
+    def get_many(self, keys):
+        """Returns the cached values of the keys that are present, keyed by key."""
+        with self.lock:
+            values = {}
+            unique_keys = list(dict.fromkeys(keys))
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for key, value in self.connection.execute(
+                    f"SELECT key, value FROM {self.table_name} WHERE key IN ({placeholders})", chunk
+                ):
+                    values[key] = json.loads(value)
+                self.connection.execute(
+                    f"UPDATE {self.table_name} SET accessed_at = ? WHERE key IN ({placeholders})",
+                    (time.time(), *chunk),
+                )
+            self.connection.commit()
+            self.num_hits += sum(1 for key in keys if key in values)
+            self.num_misses += sum(1 for key in keys if key not in values)
+            return values
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        with self.lock:
+            now = time.time()
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table_name} (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False), now, now) for key, value in items],
+            )
+            self.connection.commit()
+
+    def evict(self):
+        """Evicts the expired entries, then the least recently used ones beyond `max_entries`."""
+        with self.lock:
+            num_evicted = 0
+            if self.max_age_days is not None:
+                cursor = self.connection.execute(
+                    f"DELETE FROM {self.table_name} WHERE created_at < ?",
+                    (time.time() - self.max_age_days * 86400,),
+                )
+                num_evicted += cursor.rowcount
+            if self.max_entries is not None:
+                cursor = self.connection.execute(
+                    f"DELETE FROM {self.table_name} WHERE key IN ("
+                    f"SELECT key FROM {self.table_name} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+                num_evicted += cursor.rowcount
+            self.connection.commit()
+            return num_evicted
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(f"SELECT COUNT(*) FROM {self.table_name}").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.evict()
+            self.connection.close()
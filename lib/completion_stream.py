@@ -0,0 +1,126 @@
+import time
+from datetime import timedelta
+
+
+class StreamedResponse:
+    """
+    A streamed chat completion, read to the end (or to the client-side budget).
+
+    It stands in for the raw response of a non-streamed request: `parse()`
+    returns the assembled `ChatCompletion`, and `stream_metrics` holds the
+    time-to-first-token and inter-token latency of the stream.
+    """
+    def __init__(self, raw_response, completion, elapsed, stream_metrics):
+        self.headers = raw_response.headers
+        self.http_request = raw_response.http_request
+        self.completion = completion
+        self.elapsed = elapsed
+        self.stream_metrics = stream_metrics
+
+    def parse(self):
+        return self.completion
+
+
+class CompletionStreamReader:
+    """
+    Assembles the chunks of a streamed chat completion, and times them.
+
+    Each content chunk counts as one completion token (OpenAI and Ollama
+    stream one token per chunk). The stream is cut short once
+    `max_completion_tokens` chunks were read or a `stop` sequence appears in
+    the text; the text is then cut before the stop sequence, as a server
+    would.
+    """
+    def __init__(self, max_completion_tokens=None, stop=None, num_prompt_tokens=None):
+        self.max_completion_tokens = max_completion_tokens
+        self.stop = [sequence for sequence in (stop or []) if sequence]
+        self.num_prompt_tokens = num_prompt_tokens
+        self.start_time = time.perf_counter()
+        self.last_token_time = None
+        self.first_token_time = None
+        self.text = ""
+        self.num_chunks = 0
+        self.finish_reason = None
+        self.stopped_early = False
+        self.usage = None
+        self.model = None
+        self.completion_id = None
+
+    def add_chunk(self, chunk):
+        """Adds a chunk of the stream, and returns True once the client-side budget is reached."""
+        now = time.perf_counter()
+        self.model = chunk.model
+        self.completion_id = chunk.id
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return False
+        choice = chunk.choices[0]
+        if choice.finish_reason is not None:
+            self.finish_reason = choice.finish_reason
+        content = choice.delta.content
+        if not content:
+            return False
+
+        if self.first_token_time is None:
+            self.first_token_time = now
+        self.last_token_time = now
+        self.num_chunks += 1
+        # A stop sequence may start in an earlier chunk
+        search_start = max(0, len(self.text) - max((len(sequence) for sequence in self.stop), default=0) + 1)
+        self.text += content
+        for sequence in self.stop:
+            position = self.text.find(sequence, search_start)
+            if position != -1:
+                self.text = self.text[:position]
+                return self._stop_early("stop")
+        if self.max_completion_tokens is not None and self.num_chunks >= self.max_completion_tokens:
+            return self._stop_early("length")
+        return False
+
+    def _stop_early(self, finish_reason):
+        self.finish_reason = finish_reason
+        self.stopped_early = True
+        return True
+
+    def get_response(self, raw_response):
+        """Returns the streamed response of the chunks read so far."""
+        from openai.types.chat import ChatCompletion, ChatCompletionMessage
+        from openai.types.chat.chat_completion import Choice
+        from openai.types.completion_usage import CompletionUsage
+
+        end_time = self.last_token_time or time.perf_counter()
+        usage = self.usage
+        if usage is None:
+            # A stream cut short (or a server without `stream_options`) reports no usage
+            num_prompt_tokens = self.num_prompt_tokens or 0
+            usage = CompletionUsage(
+                prompt_tokens=num_prompt_tokens,
+                completion_tokens=self.num_chunks,
+                total_tokens=num_prompt_tokens + self.num_chunks,
+            )
+        completion = ChatCompletion(
+            id=self.completion_id or "",
+            object="chat.completion",
+            created=int(time.time()),
+            model=self.model or "",
+            choices=[Choice(
+                index=0,
+                finish_reason=self.finish_reason or "stop",
+                message=ChatCompletionMessage(role="assistant", content=self.text),
+            )],
+            usage=usage,
+        )
+        return StreamedResponse(raw_response, completion, timedelta(seconds=end_time - self.start_time), self.get_stream_metrics())
+
+    def get_stream_metrics(self):
+        stream_metrics = {}
+        if self.first_token_time is not None:
+            stream_metrics["ttft"] = round(self.first_token_time - self.start_time, 4)
+        if self.num_chunks > 1:
+            stream_metrics["inter_token_latency"] = round(
+                (self.last_token_time - self.first_token_time) / (self.num_chunks - 1), 4
+            )
+        if self.stopped_early:
+            stream_metrics["stopped_early"] = self.finish_reason
+        return stream_metrics
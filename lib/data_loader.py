@@ -1,14 +1,61 @@
 import os
-import datasets
+import json
+import shutil
+import hashlib
+
+# Name of the file that records the loader config of a saved dataset
+FINGERPRINT_FILE = "fingerprint.json"
+
+# Rows buffered by the approximate shuffle of a streamed dataset
+SHUFFLE_BUFFER_SIZE = 10000
+
+
+def get_loader_fingerprint(loader_config):
+    """Returns a short hash of the loader config (dataset, split and selected rows) of a saved dataset."""
+    content = json.dumps(loader_config, sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+def read_fingerprint(dataset_path):
+    fingerprint_path = os.path.join(dataset_path, FINGERPRINT_FILE)
+    if not os.path.exists(fingerprint_path):
+        return None
+    with open(fingerprint_path, "r") as f:
+        return json.load(f)
+
+
+def _read_dataset_state(dataset_path):
+    """Returns the `datasets` fingerprint and the columns of a dataset saved with `save_to_disk`, or None."""
+    try:
+        with open(os.path.join(dataset_path, "state.json"), "r") as f:
+            state = json.load(f)
+        with open(os.path.join(dataset_path, "dataset_info.json"), "r") as f:
+            dataset_info = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not all(os.path.exists(os.path.join(dataset_path, data_file["filename"])) for data_file in state["_data_files"]):
+        return None
+    return {"dataset_fingerprint": state["_fingerprint"], "columns": list(dataset_info.get("features") or {})}
+
+
+def _iter_rows(dataset):
+    """Yields the rows of a streamed dataset (the generator of `datasets.Dataset.from_generator`)."""
+    yield from dataset
 
 
 class AbstractDataLoader:
     """
     An abstract class for data loaders.
+
+    A loader selects the rows to evaluate: the `shard` (index, number of
+    shards) of the split, its first `limit` rows, and only the `columns` the
+    payloads are built from (default: every column).
     """
-    def __init__(self, dataset_name, dataset_size=100):
+    def __init__(self, dataset_name, limit=None, shard=None, columns=None):
         self.dataset_name = dataset_name
-        self.dataset_size = dataset_size
+        self.limit = limit
+        self.shard = shard
+        self.columns = columns
     
     def load_dataset(self):
         """
@@ -23,44 +70,223 @@ class AbstractDataLoader:
         raise NotImplementedError("Subclasses must implement this method.")
     
 
+class LazyDataset:
+    """
+    A dataset saved with `save_to_disk`, loaded with `datasets` only once its rows are accessed.
+
+    Its length is read from the fingerprint file or the Arrow files of the
+    dataset, so a run whose payloads are all cached never imports `datasets`.
+    Any other attribute is that of the loaded `datasets.Dataset`.
+    """
+    def __init__(self, dataset_path):
+        self.dataset_path = dataset_path
+        self._dataset = None
+        self._num_rows = None
+    
+    @property
+    def fingerprint(self):
+        """The hash of the loader config the dataset was saved with, or None for an unrecorded dataset."""
+        fingerprint = read_fingerprint(self.dataset_path)
+        return fingerprint["fingerprint"] if fingerprint is not None else None
+    
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            import datasets
+            self._dataset = datasets.load_from_disk(self.dataset_path)
+        return self._dataset
+    
+    def __len__(self):
+        if self._dataset is not None:
+            return len(self._dataset)
+        if self._num_rows is None:
+            self._num_rows = self._count_rows()
+        return self._num_rows
+    
+    def _count_rows(self):
+        import pyarrow as pa
+        
+        fingerprint = read_fingerprint(self.dataset_path)
+        if fingerprint is not None and "num_rows" in fingerprint:
+            return fingerprint["num_rows"]
+        with open(os.path.join(self.dataset_path, "state.json"), "r") as f:
+            state = json.load(f)
+        num_rows = 0
+        for data_file in state["_data_files"]:
+            with pa.memory_map(os.path.join(self.dataset_path, data_file["filename"])) as source:
+                num_rows += pa.ipc.open_stream(source).read_all().num_rows
+        return num_rows
+    
+    def __getitem__(self, key):
+        return self.dataset[key]
+    
+    def __iter__(self):
+        return iter(self.dataset)
+    
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+    
+
 class HuggingFaceDataLoader(AbstractDataLoader):
-    def __init__(self, dataset_name):
-        super().__init__(dataset_name)
+    """
+    Loads a split of a Hugging Face dataset and saves the selected rows to disk.
+
+    The whole split is downloaded, unless `streaming` is set: the rows are
+    then streamed and only the selected ones are stored, so a node that
+    evaluates one shard of a large corpus reads only its shard (or, when the
+    files of the split cannot be divided among the shards, every `num_shards`-th
+    row). With `sample_seed`, the `limit` rows are sampled from the shuffled
+    shard instead of taken from its start (a streamed shard is shuffled
+    through a buffer of `SHUFFLE_BUFFER_SIZE` rows).
+
+    The saved dataset is reused only if its fingerprint file records the same
+    loader config, the data files `datasets` saved, and at least the
+    selected columns.
+    """
+    def __init__(self, dataset_name, streaming=False, limit=None, shard=None, columns=None, sample_seed=None):
+        super().__init__(dataset_name, limit, shard, columns)
+        self.streaming = streaming
+        self.sample_seed = sample_seed
+    
+    def get_loader_config(self, split):
+        """The fields that determine the rows of the saved dataset (the columns are checked separately)."""
+        loader_config = {"dataset_name": self.dataset_name, "split": split}
+        if self.shard is not None:
+            loader_config.update(shard=list(self.shard), streaming=self.streaming)
+        if self.sample_seed is not None:
+            loader_config.update(sample_seed=self.sample_seed, streaming=self.streaming)
+        if self.limit is not None:
+            loader_config["limit"] = self.limit
+        return loader_config
     
     def load_dataset(self, **kwargs):
         print("[[Loading dataset]]")
+        dataset_path = kwargs['dataset_path']
+        loader_config = self.get_loader_config(kwargs['split'])
+        if self.shard is not None:
+            print(f"- Shard: {self.shard[0]}/{self.shard[1]}")
+        if self.limit is not None:
+            print(f"- Limit: {self.limit} rows" + (f" (sampled with seed {self.sample_seed})" if self.sample_seed is not None else ""))
             
         # Step 1. Check to cached dataset
-        if kwargs['reset'] is True:         # TODO: Fix this
-            pass
+        if kwargs['reset'] is True:
+            print(f"Removing the cached dataset...")
         else:
-            input_dataset = self.load_cached_dataset(kwargs['dataset_path'])
-            if len(input_dataset) > 0:      # TODO: Fix this
+            input_dataset = self.load_cached_dataset(dataset_path, loader_config)
+            if input_dataset is not None:
                 print(f"Successfully loaded the cached dataset!")
-                return input_dataset            
+                return input_dataset
             
         # Step 2. Download the dataset
-        print(f"Downloading the dataset from HuggingFace...")
-        downloaded_dataset = datasets.load_dataset(self.dataset_name, split=kwargs['split'])
+        import datasets
+        
+        if self.streaming:
+            print(f"Streaming the dataset from HuggingFace...")
+        else:
+            print(f"Downloading the dataset from HuggingFace...")
+        downloaded_dataset = self.select_rows(
+            datasets.load_dataset(self.dataset_name, split=kwargs['split'], streaming=self.streaming)
+        )
         
         # Step 3. Save the dataset to the specified file path
-        self.save_dataset(downloaded_dataset, kwargs['dataset_path'])
-        print(f"Saved dataset to '{kwargs['dataset_path']}'.")
-        return datasets.load_from_disk(kwargs['dataset_path'])
+        self.save_dataset(downloaded_dataset, dataset_path, loader_config)
+        print(f"Saved dataset to '{dataset_path}'.")
+        return LazyDataset(dataset_path)
     
-    def save_dataset(self, dataset, dataset_path):
+    def select_rows(self, dataset):
+        """Selects the columns, shard and limit of a downloaded or streamed split."""
+        if self.columns is not None:
+            dataset = dataset.select_columns(self.columns)
+        if self.streaming:
+            from datasets.distributed import split_dataset_by_node
+            
+            if self.shard is not None:
+                dataset = split_dataset_by_node(dataset, rank=self.shard[0], world_size=self.shard[1])
+            if self.sample_seed is not None:
+                dataset = dataset.shuffle(seed=self.sample_seed, buffer_size=SHUFFLE_BUFFER_SIZE)
+            if self.limit is not None:
+                dataset = dataset.take(self.limit)
+        else:
+            if self.shard is not None:
+                dataset = dataset.shard(num_shards=self.shard[1], index=self.shard[0], contiguous=True)
+            if self.sample_seed is not None:
+                dataset = dataset.shuffle(seed=self.sample_seed)
+            if self.limit is not None:
+                dataset = dataset.select(range(min(self.limit, len(dataset))))
+        return dataset
+    
+    def save_dataset(self, dataset, dataset_path, loader_config=None):
+        """Saves the dataset and its fingerprint file, replacing the saved dataset only once both are written."""
+        import datasets
+        
+        tmp_path = f"{dataset_path}.tmp"
+        cache_dir = f"{dataset_path}.cache"
         os.makedirs(os.path.dirname(dataset_path), exist_ok=True)
-        dataset.save_to_disk(dataset_path)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            if isinstance(dataset, datasets.IterableDataset):
+                # The streamed rows are written to Arrow files in batches, not kept in memory
+                dataset = datasets.Dataset.from_generator(
+                    _iter_rows,
+                    features=dataset.features,
+                    gen_kwargs={"dataset": dataset},
+                    cache_dir=cache_dir
+                )
+            dataset.save_to_disk(tmp_path)
+            if loader_config is not None:
+                self.save_fingerprint(tmp_path, loader_config, len(dataset))
+            shutil.rmtree(dataset_path, ignore_errors=True)
+            os.replace(tmp_path, dataset_path)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            shutil.rmtree(tmp_path, ignore_errors=True)
     
-    def load_cached_dataset(self, dataset_path):
+    def save_fingerprint(self, dataset_path, loader_config, num_rows):
+        dataset_state = _read_dataset_state(dataset_path)
+        with open(os.path.join(dataset_path, FINGERPRINT_FILE), "w") as f:
+            json.dump({
+                "fingerprint": get_loader_fingerprint(loader_config),
+                "loader_config": loader_config,
+                "dataset_fingerprint": dataset_state["dataset_fingerprint"],
+                "num_rows": num_rows,
+            }, f)
+    
+    def load_cached_dataset(self, dataset_path, loader_config):
+        """Returns the saved dataset if it was saved with the same loader config and is complete, or None."""
         print(f"Checking for cached '{self.dataset_name}' dataset...")
         
-        if os.path.exists(dataset_path):
-            print(f"Dataset already exists at '{dataset_path}'.")
-            return datasets.load_from_disk(dataset_path)
-        else:
+        if not os.path.exists(dataset_path):
             print(f"Dataset does not exist at '{dataset_path}'.")
-            return []
+            return None
+        
+        dataset_state = _read_dataset_state(dataset_path)
+        if dataset_state is None:
+            print(f"The dataset at '{dataset_path}' is incomplete.")
+            return None
+        
+        fingerprint = read_fingerprint(dataset_path)
+        if fingerprint is None:
+            # A dataset saved before fingerprints were recorded holds the whole split
+            if set(loader_config) != {"dataset_name", "split"}:
+                print(f"The dataset at '{dataset_path}' has no fingerprint.")
+                return None
+            self.save_fingerprint(dataset_path, loader_config, len(LazyDataset(dataset_path)))
+        elif fingerprint["fingerprint"] != get_loader_fingerprint(loader_config):
+            print(f"The dataset at '{dataset_path}' was loaded with a different config: {json.dumps(fingerprint['loader_config'])}")
+            return None
+        elif fingerprint["dataset_fingerprint"] != dataset_state["dataset_fingerprint"]:
+            print(f"The dataset at '{dataset_path}' changed since its fingerprint was recorded.")
+            return None
+        
+        missing_columns = [column for column in self.columns or [] if column not in dataset_state["columns"]]
+        if missing_columns:
+            print(f"The dataset at '{dataset_path}' has no {', '.join(missing_columns)} columns.")
+            return None
+        
+        print(f"Dataset already exists at '{dataset_path}'.")
+        return LazyDataset(dataset_path)
     
 
 class DataLoaderFactory:
@@ -68,11 +294,18 @@ class DataLoaderFactory:
     A factory class to specify the data loader based on the source.
     """
     @staticmethod
-    def get_data_loader(source, dataset_name):
+    def get_data_loader(source, dataset_name, streaming=False, limit=None, shard=None, columns=None, sample_seed=None):
         """
         Returns an instance of the data loader based on the specified source.
+
+        Args:
+            streaming (bool): Stream the split and store only the selected rows.
+            limit (int): The number of rows to load (default: every row of the shard).
+            shard (tuple): The (shard index, number of shards) of the split to load.
+            columns (list): The columns to load (default: every column).
+            sample_seed (int): Sample the `limit` rows with this seed instead of taking the first ones.
         """
         if source == "huggingface":
-            return HuggingFaceDataLoader(dataset_name)
+            return HuggingFaceDataLoader(dataset_name, streaming, limit, shard, columns, sample_seed)
         else:
             raise ValueError(f"Unknown data source: {source}")
\ No newline at end of file
@@ -0,0 +1,356 @@
+import os
+import json
+import math
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+from lib.result_store import SCORE_COLUMNS
+from lib.utils import load_keyed_records
+
+# The summary name of each score column
+METRIC_NAMES = {"bleu_4_score": "bleu", "cer_score": "cer", "rouge_l_score": "rouge"}
+
+NUM_RESAMPLES = 10000
+CONFIDENCE = 0.95
+
+# Resamples drawn per matrix product; small chunks keep the weights in cache
+BOOTSTRAP_CHUNK_SIZE = 8
+PERMUTATION_CHUNK_SIZE = 128
+
+# Below this many rows, rows are resampled by index instead of with Poisson weights
+POISSON_MIN_ROWS = 100
+
+
+def _get_poisson_table(num_bits=16):
+    """Maps each `num_bits`-bit random integer to a Poisson(1) count (inverse CDF sampling)."""
+    cdf = np.cumsum([math.exp(-1) / math.factorial(count) for count in range(16)])
+    quantiles = (np.arange(2 ** num_bits) + 0.5) / 2 ** num_bits
+    return np.searchsorted(cdf, quantiles).astype(np.float32)
+
+
+_POISSON_TABLE = _get_poisson_table()
+
+
+def get_score_matrix(eval_results):
+    """Returns the payload ids and the (rows x metrics) score matrix of evaluation results."""
+    ids = np.array([result["id"] for result in eval_results], dtype=np.int64)
+    scores = np.array([[result[column] for column in SCORE_COLUMNS] for result in eval_results], dtype=np.float64)
+    return ids, scores.reshape(len(eval_results), len(SCORE_COLUMNS))
+
+
+def load_scores(results_path):
+    """Loads the payload ids and score matrix of a `.eval_results.jsonl` or `.eval_results.parquet` file.
+
+    Only the id and score columns of a Parquet file are read from disk.
+    """
+    if results_path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(results_path, columns=["id"] + SCORE_COLUMNS)
+        ids = table["id"].to_numpy()
+        scores = np.column_stack([table[column].to_numpy().astype(np.float64) for column in SCORE_COLUMNS])
+        return ids, scores.reshape(table.num_rows, len(SCORE_COLUMNS))
+    eval_results, _ = load_keyed_records(results_path)
+    return get_score_matrix(list(eval_results.values()))
+
+
+def bootstrap_means(scores, num_resamples=NUM_RESAMPLES, rng=None):
+    """Returns the means of `num_resamples` bootstrap resamples of the rows of a score matrix.
+
+    All the metric columns are resampled together. Instead of drawing row
+    indices, each resample weights every row with a Poisson(1) count (the
+    Poisson bootstrap, which matches the multinomial counts of resampling
+    with replacement for more than a few rows): the counts are looked up
+    from 16 random bits per row, and a single matrix product computes the
+    weighted sums and the resample sizes of a chunk of resamples.
+
+    Args:
+        scores (np.ndarray): The (rows x metrics) score matrix.
+        num_resamples (int): The number of bootstrap resamples.
+        rng (np.random.Generator): The random generator (default: seeded with 0).
+
+    Returns:
+        np.ndarray: The (resamples x metrics) resample means.
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    num_rows, num_metrics = scores.shape
+    if num_rows < POISSON_MIN_ROWS:
+        indices = rng.integers(0, num_rows, size=(num_resamples, num_rows))
+        return scores[indices].mean(axis=1)
+
+    # The last column sums the weights, i.e. the size of each resample
+    weighted_scores = np.hstack([scores, np.ones((num_rows, 1))]).astype(np.float32)
+    means = np.empty((num_resamples, num_metrics))
+    for start in range(0, num_resamples, BOOTSTRAP_CHUNK_SIZE):
+        chunk_size = min(BOOTSTRAP_CHUNK_SIZE, num_resamples - start)
+        num_draws = chunk_size * num_rows
+        draws = rng.bit_generator.random_raw(-(-num_draws // 4)).view(np.uint16)[:num_draws]
+        sums = np.take(_POISSON_TABLE, draws).reshape(chunk_size, num_rows) @ weighted_scores
+        means[start:start + chunk_size] = sums[:, :-1] / sums[:, -1:]
+    return means
+
+
+def get_percentile_interval(resampled_means, confidence=CONFIDENCE):
+    """Returns the (lower, upper) percentile interval of each column of the resample means."""
+    alpha = (1 - confidence) / 2
+    return np.quantile(resampled_means, [alpha, 1 - alpha], axis=0)
+
+
+def bootstrap_ci(scores, num_resamples=NUM_RESAMPLES, confidence=CONFIDENCE, seed=0):
+    """Returns the percentile bootstrap confidence interval of the mean of each metric column.
+
+    Returns:
+        np.ndarray: The (2 x metrics) lower and upper bounds.
+    """
+    return get_percentile_interval(bootstrap_means(scores, num_resamples, np.random.default_rng(seed)), confidence)
+
+
+def paired_permutation_test(scores_a, scores_b, num_resamples=NUM_RESAMPLES, seed=0):
+    """Returns the two-sided p-value of the difference of the mean of each metric column between two runs.
+
+    The rows are paired (row i of both runs scores the same payload). Under
+    the null hypothesis the two scores of a pair are exchangeable, so each
+    permutation flips the sign of a random subset of the paired differences.
+    The flips are unpacked from random bytes, and a matrix product computes
+    the flipped sums of a chunk of permutations.
+
+    Args:
+        scores_a (np.ndarray): The (rows x metrics) score matrix of the first run.
+        scores_b (np.ndarray): The (rows x metrics) score matrix of the second run, in the same row order.
+        num_resamples (int): The number of random permutations.
+        seed (int): The seed of the permutations.
+
+    Returns:
+        np.ndarray: The p-value of each metric column.
+    """
+    rng = np.random.default_rng(seed)
+    diffs = scores_a - scores_b
+    num_rows = diffs.shape[0]
+    observed = diffs.sum(axis=0)
+    # Flipped sums within rounding error of the observed sum count as extreme
+    tolerance = 1e-9 * max(1.0, np.abs(diffs).sum())
+    num_extreme = np.zeros(diffs.shape[1], dtype=np.int64)
+    num_bytes = -(-num_rows // 8)
+    for start in range(0, num_resamples, PERMUTATION_CHUNK_SIZE):
+        chunk_size = min(PERMUTATION_CHUNK_SIZE, num_resamples - start)
+        random_bytes = rng.bit_generator.random_raw(-(-chunk_size * num_bytes // 8)).view(np.uint8)
+        flips = np.unpackbits(random_bytes[:chunk_size * num_bytes].reshape(chunk_size, num_bytes), axis=1, count=num_rows)
+        # Flipping the sign of a difference subtracts it twice from the sum
+        permuted = observed - 2 * (flips.astype(np.float64) @ diffs)
+        num_extreme += (np.abs(permuted) >= np.abs(observed) - tolerance).sum(axis=0)
+    return (num_extreme + 1) / (num_resamples + 1)
+
+
+def get_confidence_intervals(scores, num_resamples=NUM_RESAMPLES, confidence=CONFIDENCE, seed=0):
+    """Returns the bootstrap confidence interval of each metric, as stored in `.eval_summary.json`."""
+    confidence_intervals = {"confidence": confidence, "num_resamples": num_resamples}
+    if scores.shape[0] == 0:
+        return confidence_intervals
+    lower, upper = bootstrap_ci(scores, num_resamples, confidence, seed)
+    for index, column in enumerate(SCORE_COLUMNS):
+        confidence_intervals[METRIC_NAMES[column]] = [round(float(lower[index]), 4), round(float(upper[index]), 4)]
+    return confidence_intervals
+
+
+def compare_runs(results_a, results_b, num_resamples=NUM_RESAMPLES, confidence=CONFIDENCE, seed=0):
+    """Compares the scores of two runs over the payloads scored by both.
+
+    Args:
+        results_a (tuple): The payload ids and score matrix of the first run (see `load_scores`).
+        results_b (tuple): The payload ids and score matrix of the second run.
+
+    Returns:
+        dict: The number of paired rows and, for each metric, the mean of each
+        run, their difference (b - a) with its paired bootstrap confidence
+        interval, and the p-value of the paired permutation test.
+    """
+    ids_a, scores_a = results_a
+    ids_b, scores_b = results_b
+    common_ids, index_a, index_b = np.intersect1d(ids_a, ids_b, assume_unique=True, return_indices=True)
+    scores_a, scores_b = scores_a[index_a], scores_b[index_b]
+    comparison = {"num_pairs": len(common_ids), "confidence": confidence, "num_resamples": num_resamples}
+    if len(common_ids) == 0:
+        return comparison
+
+    diffs = scores_b - scores_a
+    lower, upper = bootstrap_ci(diffs, num_resamples, confidence, seed)
+    p_values = paired_permutation_test(scores_a, scores_b, num_resamples, seed)
+    for index, column in enumerate(SCORE_COLUMNS):
+        comparison[METRIC_NAMES[column]] = {
+            "mean_a": round(float(scores_a[:, index].mean()), 4),
+            "mean_b": round(float(scores_b[:, index].mean()), 4),
+            "diff": round(float(diffs[:, index].mean()), 4),
+            "diff_ci": [round(float(lower[index]), 4), round(float(upper[index]), 4)],
+            "p_value": round(float(p_values[index]), 4),
+        }
+    return comparison
+
+
+def get_run_name(results_path):
+    return os.path.basename(results_path).replace(".eval_results.jsonl", "").replace(".eval_results.parquet", "")
+
+
+def parse_run_name(results_path):
+    """Splits a `{domain_type}-{task_type}-{model}` run name into its domain type, task type and model."""
+    domain_type, task_type, model = (get_run_name(results_path).split("-", 2) + ["", ""])[:3]
+    return {"domain": domain_type, "task": task_type, "model": model}
+
+
+def _summarize_scores(scores, resampled_means, confidence):
+    lower, upper = get_percentile_interval(resampled_means, confidence)
+    summary = {"num_responses": int(scores.shape[0])}
+    for index, column in enumerate(SCORE_COLUMNS):
+        name = METRIC_NAMES[column]
+        summary[f"avg_{name}"] = round(float(scores[:, index].mean()), 4)
+        summary[f"{name}_ci"] = [round(float(lower[index]), 4), round(float(upper[index]), 4)]
+    return summary
+
+
+def get_stratified_summary(results_paths, by="domain", num_resamples=NUM_RESAMPLES, confidence=CONFIDENCE, seed=0):
+    """Summarizes the runs of several results files, stratified by domain type or task type.
+
+    The results files are grouped by the other parts of their run names, e.g.
+    `DT-QG-gpt-4o` and `DP-QG-gpt-4o` are the two domain strata of the
+    `QG-gpt-4o` group. The rows of each stratum are resampled separately,
+    so the confidence intervals of the group also hold when the strata have
+    different sizes.
+
+    Args:
+        results_paths (list): The `.eval_results.jsonl` or `.eval_results.parquet` file paths.
+        by (str): The stratum of each file, "domain" or "task".
+
+    Returns:
+        dict: For each group, the summary of each stratum, the `overall`
+        summary (strata weighted by their number of rows), and the `macro`
+        average of the strata means.
+    """
+    rng = np.random.default_rng(seed)
+    groups = defaultdict(dict)
+    for results_path in results_paths:
+        run = parse_run_name(results_path)
+        group_name = "-".join(value for key, value in run.items() if key != by)
+        groups[group_name][run[by]] = load_scores(results_path)[1]
+
+    stratified_summary = {}
+    for group_name, strata in groups.items():
+        group_summary = {"strata": {}}
+        strata_means = []
+        for stratum, scores in strata.items():
+            resampled_means = bootstrap_means(scores, num_resamples, rng)
+            strata_means.append((scores, resampled_means))
+            group_summary["strata"][stratum] = _summarize_scores(scores, resampled_means, confidence)
+
+        num_rows = sum(scores.shape[0] for scores, _ in strata_means)
+        overall_means = sum(resampled_means * scores.shape[0] / num_rows for scores, resampled_means in strata_means)
+        group_summary["overall"] = _summarize_scores(
+            np.vstack([scores for scores, _ in strata_means]), overall_means, confidence
+        )
+        macro_means = sum(resampled_means for _, resampled_means in strata_means) / len(strata_means)
+        group_summary["macro"] = {
+            f"avg_{METRIC_NAMES[column]}": round(float(np.mean([scores[:, index].mean() for scores, _ in strata_means])), 4)
+            for index, column in enumerate(SCORE_COLUMNS)
+        }
+        lower, upper = get_percentile_interval(macro_means, confidence)
+        for index, column in enumerate(SCORE_COLUMNS):
+            group_summary["macro"][f"{METRIC_NAMES[column]}_ci"] = [round(float(lower[index]), 4), round(float(upper[index]), 4)]
+        stratified_summary[group_name] = group_summary
+    return stratified_summary
+
+
+def get_eval_summary_path(results_path):
+    """Returns the `.eval_summary.json` file path of a results file."""
+    return os.path.join(os.path.dirname(results_path), f"{get_run_name(results_path)}.eval_summary.json")
+
+
+def print_comparison(comparison, run_a, run_b):
+    confidence = f"{comparison['confidence']:.0%} CI"
+    print(f"[[Comparison]] {run_b} vs. {run_a} ({comparison['num_pairs']} paired responses)")
+    print(f"| {'Metric':<6} | {'A':>7} | {'B':>7} | {'B - A':>8} | {confidence:>18} | {'p-value':>7} |")
+    print(f"| {'-' * 6} | {'-' * 7} | {'-' * 7} | {'-' * 8} | {'-' * 18} | {'-' * 7} |")
+    for name in METRIC_NAMES.values():
+        if name not in comparison:
+            continue
+        row = comparison[name]
+        print(f"| {name:<6} | {row['mean_a']:>7.4f} | {row['mean_b']:>7.4f} | {row['diff']:>+8.4f} "
+              f"| [{row['diff_ci'][0]:+.4f}, {row['diff_ci'][1]:+.4f}] | {row['p_value']:>7.4f} |")
+
+
+def print_stratified_summary(stratified_summary, by):
+    print(f"[[Stratified Summary]] (by {by})")
+    print(f"| {'Group':<40} | {'Stratum':<8} | {'N':>6} | {'BLEU':>24} | {'CER':>24} | {'ROUGE':>24} |")
+    print(f"| {'-' * 40} | {'-' * 8} | {'-' * 6} | {'-' * 24} | {'-' * 24} | {'-' * 24} |")
+    for group_name, group_summary in stratified_summary.items():
+        rows = list(group_summary["strata"].items()) + [("overall", group_summary["overall"]), ("macro", group_summary["macro"])]
+        for stratum, summary in rows:
+            cells = [
+                f"{summary[f'avg_{name}']:.4f} [{summary[f'{name}_ci'][0]:.4f}, {summary[f'{name}_ci'][1]:.4f}]"
+                for name in METRIC_NAMES.values()
+            ]
+            num_responses = summary.get("num_responses", "")
+            print(f"| {group_name:<40} | {stratum:<8} | {num_responses:>6} | {cells[0]:>24} | {cells[1]:>24} | {cells[2]:>24} |")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confidence intervals and significance tests of evaluation results files.")
+    parser.add_argument("--num_resamples", type=int, help="Number of bootstrap resamples and permutations", default=NUM_RESAMPLES)
+    parser.add_argument("--confidence", type=float, help="Confidence level of the intervals", default=CONFIDENCE)
+    parser.add_argument("--seed", type=int, help="Seed of the resampling", default=0)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ci = subparsers.add_parser("ci", help="Add bootstrap confidence intervals to the .eval_summary.json of results files")
+    ci.add_argument("results_paths", nargs="+")
+
+    compare = subparsers.add_parser("compare", help="Paired bootstrap and permutation test between two runs")
+    compare.add_argument("results_path_a", help="The results file of the baseline run")
+    compare.add_argument("results_path_b", help="The results file of the compared run")
+    compare.add_argument("--save", action="store_true", help="Add the comparison to the .eval_summary.json of the compared run")
+
+    summarize = subparsers.add_parser("summarize", help="Summarize results files stratified by domain or task type")
+    summarize.add_argument("results_paths", nargs="+")
+    summarize.add_argument("--by", type=str, help="The stratum of each results file", default="domain", choices=["domain", "task"])
+    summarize.add_argument("--output_path", type=str, help="JSON file to save the stratified summary to", default=None)
+
+    args = parser.parse_args()
+    if args.command == "ci":
+        for results_path in args.results_paths:
+            _, scores = load_scores(results_path)
+            confidence_intervals = get_confidence_intervals(scores, args.num_resamples, args.confidence, args.seed)
+            eval_summary_path = get_eval_summary_path(results_path)
+            if os.path.exists(eval_summary_path):
+                with open(eval_summary_path, "r") as f:
+                    eval_summary = json.load(f)
+                eval_summary["confidence_intervals"] = confidence_intervals
+                with open(eval_summary_path, "w") as f:
+                    json.dump(eval_summary, f)
+            print(f"- {get_run_name(results_path)}: {json.dumps(confidence_intervals)}")
+    elif args.command == "compare":
+        comparison = compare_runs(
+            load_scores(args.results_path_a),
+            load_scores(args.results_path_b),
+            args.num_resamples,
+            args.confidence,
+            args.seed
+        )
+        run_a, run_b = get_run_name(args.results_path_a), get_run_name(args.results_path_b)
+        print_comparison(comparison, run_a, run_b)
+        if args.save:
+            eval_summary_path = get_eval_summary_path(args.results_path_b)
+            with open(eval_summary_path, "r") as f:
+                eval_summary = json.load(f)
+            eval_summary.setdefault("comparisons", {})[run_a] = comparison
+            with open(eval_summary_path, "w") as f:
+                json.dump(eval_summary, f)
+            print(f"Saved the comparison to '{eval_summary_path}'.")
+    else:
+        stratified_summary = get_stratified_summary(args.results_paths, args.by, args.num_resamples, args.confidence, args.seed)
+        print_stratified_summary(stratified_summary, args.by)
+        if args.output_path is not None:
+            with open(args.output_path, "w") as f:
+                json.dump(stratified_summary, f, indent=2)
+            print(f"Saved the stratified summary to '{args.output_path}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import time
+
+from lib.rate_limiter import CircuitBreaker, CircuitOpenError, is_retryable_error
+
+# Weight of the latest request in the moving average of the latency of an endpoint
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class Endpoint:
+    """
+    An API server of an endpoint pool, with its request statistics and health.
+
+    The endpoint is ejected from the pool while its circuit breaker is open
+    (an endpoint without a breaker is never ejected).
+    """
+    def __init__(self, base_url, api_key, failure_threshold=3, reset_timeout=30.0):
+        self.base_url = base_url
+        self.client_kwargs = {"base_url": base_url, "api_key": api_key, "max_retries": 0}
+        self._client = None
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout) if failure_threshold is not None else None
+        self.num_outstanding = 0
+        self.num_requests = 0
+        self.num_failures = 0
+        self.num_ejections = 0
+        self.latency = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(**self.client_kwargs)
+        return self._client
+
+    @property
+    def is_healthy(self):
+        return self.circuit_breaker is None or not self.circuit_breaker.is_open
+
+    def record_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * self.latency
+
+
+class EndpointPool:
+    """
+    Distributes the requests over several servers serving the same model.
+
+    Each request goes to the healthy endpoint with the fewest outstanding
+    requests, ties broken by the lowest moving-average latency. An endpoint
+    failing `failure_threshold` times in a row is ejected for `reset_timeout`
+    seconds, then re-admitted if a probe request succeeds; its retried
+    requests go to the remaining endpoints in the meantime. A single endpoint
+    is never ejected, since there is no other endpoint to send its requests
+    to: they are only retried with backoff.
+    """
+    def __init__(self, base_urls, api_key, failure_threshold=3, reset_timeout=30.0):
+        if len(base_urls) == 1:
+            failure_threshold = None
+        self.endpoints = [
+            Endpoint(base_url, api_key, failure_threshold, reset_timeout) for base_url in base_urls
+        ]
+
+    def acquire(self):
+        """Returns the endpoint of the next request, counting it as outstanding."""
+        healthy_endpoints = [endpoint for endpoint in self.endpoints if endpoint.is_healthy]
+        if not healthy_endpoints:
+            raise CircuitOpenError(
+                f"All {len(self.endpoints)} endpoints are ejected after consecutive failures.",
+                retry_after=min(endpoint.circuit_breaker.get_retry_after() for endpoint in self.endpoints)
+            )
+
+        endpoint = min(
+            healthy_endpoints,
+            key=lambda endpoint: (endpoint.num_outstanding, endpoint.latency or 0.0),
+        )
+        if endpoint.circuit_breaker is not None:
+            endpoint.circuit_breaker.check()
+        endpoint.num_outstanding += 1
+        endpoint.num_requests += 1
+        return endpoint
+
+    def release(self, endpoint, start_time, error=None):
+        """Records the outcome of a request sent to the endpoint at `start_time`.
+
+        Only errors of the server itself (e.g. connection and server errors)
+        count toward its ejection. A client error (e.g. a bad request) says
+        nothing of the health or latency of the server, so it is recorded as
+        neither a success nor a failure.
+        """
+        endpoint.num_outstanding -= 1
+        circuit_breaker = endpoint.circuit_breaker
+        if error is None:
+            endpoint.record_latency(time.perf_counter() - start_time)
+            if circuit_breaker is not None:
+                circuit_breaker.record_success()
+            return
+        if not is_retryable_error(error):
+            if circuit_breaker is not None:
+                circuit_breaker.cancel_probe()
+            return
+
+        endpoint.num_failures += 1
+        if circuit_breaker is None:
+            return
+        was_healthy = endpoint.is_healthy
+        circuit_breaker.record_failure()
+        if was_healthy and not endpoint.is_healthy:
+            endpoint.num_ejections += 1
+            print(f"Ejected endpoint '{endpoint.base_url}' after {circuit_breaker.num_failures} consecutive failures.")
+
+    def create_async_clients(self):
+        return AsyncClientPool(self.endpoints)
+
+    def report(self):
+        for endpoint in self.endpoints:
+            latency = f"{endpoint.latency:.2f}s" if endpoint.latency is not None else "-"
+            print(f"- Endpoint '{endpoint.base_url}': {endpoint.num_requests} requests, "
+                  f"{endpoint.num_failures} failures, {endpoint.num_ejections} ejections, avg latency {latency}")
+
+
+class AsyncClientPool:
+    """
+    The async clients of the endpoints of a pool, bound to the running event loop.
+    """
+    def __init__(self, endpoints):
+        from openai import AsyncOpenAI
+        self.clients = {endpoint.base_url: AsyncOpenAI(**endpoint.client_kwargs) for endpoint in endpoints}
+
+    def __getitem__(self, endpoint):
+        return self.clients[endpoint.base_url]
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
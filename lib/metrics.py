@@ -0,0 +1,363 @@
+import re
+import sys
+import json
+import math
+import time
+import argparse
+import subprocess
+from collections import Counter
+
+try:
+    from rapidfuzz.distance import Levenshtein as _rapidfuzz_levenshtein, LCSseq as _rapidfuzz_lcsseq
+except ImportError:
+    _rapidfuzz_levenshtein = _rapidfuzz_lcsseq = None
+
+
+class Tokenizer13a:
+    """
+    The default BLEU tokenizer of `evaluate` (the mteval-v13a tokenizer of sacrebleu).
+    """
+    def __init__(self):
+        self._re = [
+            (re.compile(r"([\{-\~\[-\` -\&\(-\+\:-\@\/])"), r" \1 "),
+            (re.compile(r"([^0-9])([\.,])"), r"\1 \2 "),
+            (re.compile(r"([\.,])([^0-9])"), r" \1 \2"),
+            (re.compile(r"([0-9])(-)"), r"\1 \2 "),
+        ]
+
+    def __call__(self, line):
+        line = line.replace("<skipped>", "")
+        line = line.replace("-\n", "")
+        line = line.replace("\n", " ")
+        if "&" in line:
+            line = line.replace("&quot;", '"')
+            line = line.replace("&amp;", "&")
+            line = line.replace("&lt;", "<")
+            line = line.replace("&gt;", ">")
+        line = f" {line} "
+        for _re, repl in self._re:
+            line = _re.sub(repl, line)
+        return line.split()
+
+
+_TOKENIZER_13A = Tokenizer13a()
+_MULTIPLE_SPACES_RE = re.compile(r"\s\s+")
+_NON_ALPHANUM_RE = re.compile(r"[^a-z0-9]+")
+_VALID_TOKEN_RE = re.compile(r"^[a-z0-9]+$")
+
+
+def compute_bleu(prediction, reference, max_order=4):
+    """Returns the sentence-level BLEU score of a single prediction.
+
+    Matches `evaluate.load("bleu").compute(predictions=[prediction],
+    references=[[reference]], max_order=max_order)['bleu']`, except that an
+    empty prediction scores 0.0 instead of raising ZeroDivisionError.
+    """
+    translation = _TOKENIZER_13A(prediction)
+    reference = _TOKENIZER_13A(reference)
+    if not translation:
+        return 0.0
+
+    reference_counts = _get_ngrams(reference, max_order)
+    translation_counts = _get_ngrams(translation, max_order)
+    matches_by_order = [0] * max_order
+    for ngram, count in (translation_counts & reference_counts).items():
+        matches_by_order[len(ngram) - 1] += count
+
+    precisions = [0.0] * max_order
+    for i in range(max_order):
+        possible_matches = len(translation) - i
+        if possible_matches > 0:
+            precisions[i] = float(matches_by_order[i]) / possible_matches
+
+    if min(precisions) > 0:
+        p_log_sum = sum((1. / max_order) * math.log(p) for p in precisions)
+        geo_mean = math.exp(p_log_sum)
+    else:
+        geo_mean = 0
+
+    ratio = float(len(translation)) / len(reference)
+    bp = 1. if ratio > 1.0 else math.exp(1 - 1. / ratio)
+    return geo_mean * bp
+
+
+def compute_cer(prediction, reference):
+    """Returns the character error rate of a single prediction.
+
+    Matches `evaluate.load("cer").compute(predictions=[prediction],
+    references=[reference])`.
+    """
+    prediction = _MULTIPLE_SPACES_RE.sub(" ", prediction).strip()
+    reference = _MULTIPLE_SPACES_RE.sub(" ", reference).strip()
+    if not reference:
+        raise ValueError("CER is undefined for an empty reference.")
+    return _edit_distance(prediction, reference) / len(reference)
+
+
+def compute_rouge_l(prediction, reference):
+    """Returns the ROUGE-L F-measure of a single prediction.
+
+    Matches `evaluate.load("rouge").compute(predictions=[prediction],
+    references=[reference])['rougeL']`.
+    """
+    prediction_tokens = _tokenize_rouge(prediction)
+    target_tokens = _tokenize_rouge(reference)
+    if not target_tokens or not prediction_tokens:
+        return 0.0
+
+    lcs_length = _lcs_length(target_tokens, prediction_tokens)
+    precision = lcs_length / len(prediction_tokens)
+    recall = lcs_length / len(target_tokens)
+    if precision + recall > 0:
+        return 2 * precision * recall / (precision + recall)
+    return 0.0
+
+
+def compute_scores(predictions, references, bleu_n=1, columns=None):
+    """Returns the per-row BLEU, CER and ROUGE-L scores of a batch.
+
+    Args:
+        predictions (list): The generated responses.
+        references (list): The ground truths, one per prediction.
+        bleu_n (int): The maximum n-gram order of BLEU.
+        columns (list): The score columns to compute (default: all).
+
+    Returns:
+        dict: The score columns, each a list aligned with the predictions.
+    """
+    scorers = {
+        "bleu_4_score": lambda p, r: compute_bleu(p, r, bleu_n),
+        "cer_score": compute_cer,
+        "rouge_l_score": compute_rouge_l,
+    }
+    return {
+        column: [scorers[column](p, r) for p, r in zip(predictions, references)]
+        for column in (scorers if columns is None else columns)
+    }
+
+
+def validate_scores(results_path, bleu_n=1, limit=None, use_evaluate=False):
+    """Compares the built-in scores of an `.eval_results.jsonl` file to its stored scores.
+
+    The stored scores are those of the `evaluate` scorers when the file was
+    scored with them. With `use_evaluate`, the scores are also recomputed
+    with the `evaluate` scorers.
+
+    Returns:
+        dict: The number of rows, and the max absolute difference and the
+        number of mismatching rows of each score column.
+    """
+    results = []
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            results.append(json.loads(line))
+            if limit is not None and len(results) == limit:
+                break
+    predictions = [result["generated_response"] for result in results]
+    references = [result["ground_truth"] for result in results]
+
+    builtin_scores = compute_scores(predictions, references, bleu_n)
+    expected_scores = {column: [result[column] for result in results] for column in builtin_scores}
+    if use_evaluate:
+        expected_scores = _compute_evaluate_scores(predictions, references, bleu_n)
+
+    report = {"num_rows": len(results)}
+    for column, scores in builtin_scores.items():
+        diffs = [abs(a - b) for a, b in zip(scores, expected_scores[column])]
+        report[column] = {
+            "max_abs_diff": max(diffs, default=0.0),
+            "num_mismatches": sum(diff > 1e-9 for diff in diffs),
+        }
+    return report
+
+
+def measure_cold_start(metric_backend):
+    """Returns the seconds from a fresh interpreter to the first scored row of a metric backend, or None if it fails."""
+    if metric_backend == "builtin":
+        code = "from lib.metrics import compute_scores; compute_scores(['a b c'], ['a b d'])"
+    else:
+        code = "from lib.metrics import _compute_evaluate_scores; _compute_evaluate_scores(['a b c'], ['a b d'])"
+    start_time = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", code], capture_output=True)
+    if process.returncode != 0:
+        return None
+    return time.perf_counter() - start_time
+
+
+def _compute_evaluate_scores(predictions, references, bleu_n=1):
+    from evaluate import load
+
+    bleu_scorer, cer_scorer, rouge_scorer = load("bleu"), load("cer"), load("rouge")
+    scores = {"bleu_4_score": [], "cer_score": [], "rouge_l_score": []}
+    for prediction, reference in zip(predictions, references):
+        scores["bleu_4_score"].append(bleu_scorer.compute(predictions=[prediction], references=[[reference]], max_order=bleu_n)["bleu"])
+        scores["cer_score"].append(cer_scorer.compute(predictions=[prediction], references=[reference]))
+        scores["rouge_l_score"].append(rouge_scorer.compute(predictions=[prediction], references=[reference])["rougeL"])
+    return scores
+
+
+def _get_ngrams(segment, max_order):
+    ngram_counts = Counter()
+    for order in range(1, max_order + 1):
+        for i in range(0, len(segment) - order + 1):
+            ngram_counts[tuple(segment[i:i + order])] += 1
+    return ngram_counts
+
+
+def _tokenize_rouge(text):
+    text = _NON_ALPHANUM_RE.sub(" ", text.lower())
+    return [token for token in text.split() if _VALID_TOKEN_RE.match(token)]
+
+
+def _encode_tokens(a, b):
+    """Maps the tokens of two sequences to small ints, shared by both sequences."""
+    vocabulary = {}
+    return (
+        [vocabulary.setdefault(token, len(vocabulary)) for token in a],
+        [vocabulary.setdefault(token, len(vocabulary)) for token in b],
+    )
+
+
+def _get_match_masks(pattern):
+    """Returns the bit mask of the positions of each symbol in the pattern."""
+    match_masks = {}
+    for index, symbol in enumerate(pattern):
+        match_masks[symbol] = match_masks.get(symbol, 0) | (1 << index)
+    return match_masks
+
+
+def _edit_distance(a, b):
+    """Returns the Levenshtein distance between two sequences."""
+    if _rapidfuzz_levenshtein is not None:
+        return _rapidfuzz_levenshtein.distance(a, b)
+    return _bit_parallel_edit_distance(a, b)
+
+
+def _lcs_length(a, b):
+    """Returns the length of the longest common subsequence of two sequences."""
+    if _rapidfuzz_lcsseq is not None:
+        # The tokens are mapped to ints, so that they are compared exactly instead of by hash
+        return _rapidfuzz_lcsseq.similarity(*_encode_tokens(a, b))
+    return _bit_parallel_lcs_length(a, b)
+
+
+def _bit_parallel_edit_distance(a, b):
+    """Returns the Levenshtein distance between two sequences with Myers' bit-vector algorithm.
+
+    Each column of the dynamic programming matrix is held as the vertical
+    deltas of a Python int, so the loop runs once per symbol of the shorter
+    sequence instead of once per cell (Hyyrö's formulation of Myers, 1999).
+    """
+    # The common prefix and suffix never contribute to the distance
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end_a, end_b = len(a), len(b)
+    while end_a > start and end_b > start and a[end_a - 1] == b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+    a, b = a[start:end_a], b[start:end_b]
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+
+    match_masks = _get_match_masks(a)
+    mask = (1 << len(a)) - 1
+    last_bit = 1 << (len(a) - 1)
+    positive_vertical, negative_vertical = mask, 0
+    distance = len(a)
+    for symbol in b:
+        matches = match_masks.get(symbol, 0)
+        vertical = matches | negative_vertical
+        horizontal = (((matches & positive_vertical) + positive_vertical) ^ positive_vertical) | matches
+        positive_horizontal = (negative_vertical | ~(horizontal | positive_vertical)) & mask
+        negative_horizontal = positive_vertical & horizontal
+        if positive_horizontal & last_bit:
+            distance += 1
+        elif negative_horizontal & last_bit:
+            distance -= 1
+        positive_horizontal = (positive_horizontal << 1) | 1
+        negative_horizontal <<= 1
+        positive_vertical = (negative_horizontal | ~(vertical | positive_horizontal)) & mask
+        negative_vertical = positive_horizontal & vertical
+    return distance
+
+
+def _bit_parallel_lcs_length(a, b):
+    """Returns the length of the longest common subsequence of two sequences with a bit-vector algorithm.
+
+    The row of the dynamic programming matrix is held as the unset bits of a
+    Python int, updated once per symbol of the shorter sequence (Hyyrö, 2004).
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return 0
+
+    match_masks = _get_match_masks(a)
+    mask = (1 << len(a)) - 1
+    row = mask
+    for symbol in b:
+        matches = row & match_masks.get(symbol, 0)
+        row = ((row + matches) | (row - matches)) & mask
+    return len(a) - bin(row).count("1")
+
+
+def _dp_edit_distance(a, b):
+    """Returns the Levenshtein distance between two sequences with the O(n·m) dynamic program (the parity reference)."""
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            current.append(previous[j - 1] if x == y else min(previous[j - 1], previous[j], current[j - 1]) + 1)
+        previous = current
+    return previous[-1]
+
+
+def _dp_lcs_length(a, b):
+    """Returns the length of the longest common subsequence with the O(n·m) dynamic program (the parity reference)."""
+    previous = [0] * (len(b) + 1)
+    for x in a:
+        current = [0]
+        for j, y in enumerate(b, 1):
+            current.append(previous[j - 1] + 1 if x == y else max(previous[j], current[j - 1]))
+        previous = current
+    return previous[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the built-in metrics against the `evaluate` scorers.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    validate_parser = subparsers.add_parser("validate", help="Compare the built-in scores to the scores of a results file")
+    validate_parser.add_argument("results_path", type=str, help="An `.eval_results.jsonl` file scored with the `evaluate` scorers")
+    validate_parser.add_argument("--bleu_n", type=int, help="The maximum n-gram order of BLEU the file was scored with", default=1)
+    validate_parser.add_argument("--limit", type=int, help="Number of rows to compare (default: all)", default=None)
+    validate_parser.add_argument("--evaluate", action="store_true", help="Recompute the expected scores with the `evaluate` scorers")
+    args = parser.parse_args()
+
+    if args.command == "validate":
+        print(f"[[Metric Validation]]")
+        start_time = time.perf_counter()
+        report = validate_scores(args.results_path, args.bleu_n, args.limit, args.evaluate)
+        print(f"- Num of rows: {report['num_rows']} ({time.perf_counter() - start_time:.1f}s)")
+        print(f"- Edit distance/LCS kernels: {'rapidfuzz' if _rapidfuzz_levenshtein is not None else 'bit-parallel (pure Python)'}")
+        for column in ("bleu_4_score", "cer_score", "rouge_l_score"):
+            print(f"- {column}: max abs diff {report[column]['max_abs_diff']:.2e}, "
+                  f"{report[column]['num_mismatches']} mismatches")
+
+        print(f"[[Cold Start]]")
+        for metric_backend in ("builtin", "evaluate"):
+            cold_start_time = measure_cold_start(metric_backend)
+            if cold_start_time is None:
+                print(f"- {metric_backend}: unavailable (the `evaluate` metric scripts could not be loaded)")
+            else:
+                print(f"- {metric_backend}: {cold_start_time:.2f}s")
+
+        if any(report[column]["num_mismatches"] for column in ("bleu_4_score", "cer_score", "rouge_l_score")):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
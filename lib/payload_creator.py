@@ -1,185 +1,265 @@
 import os
-import jsonlines
-from tqdm import tqdm
+import json
+from string import Formatter
+
+from lib.payload_store import PAYLOAD_BUFFER_SIZE, PayloadStore, PayloadStoreWriter, decode_payload, remove_payload_store
+from lib.token_budget import PromptBudget, get_tokenizer
 
 
 class AbstractPayloadCreator:
     """
     An abstract class for payload creators.
+
+    Payloads are stored in a payload store (see `lib.payload_store`): the
+    system prompt and the user message template are stored once, and each
+    row only holds the template fields and the ground truth of a dataset row.
+    Subclasses set the user message template and the ground truth column.
+
+    The input tokens of each payload are counted with `tokenizer_name`, and
+    payloads over `max_input_tokens` are truncated to fit (see `PromptBudget`).
+    The store also records the fingerprint of the loaded dataset, if any, so
+    that the payloads of another subset of the dataset are never reused.
     """
-    def __init__(self, temperature, num_examples, system_prompt_path):
+    user_template = None
+    ground_truth_field = None
+    
+    def __init__(self, temperature, num_examples, system_prompt_path, num_proc=1, tokenizer_name="approx", max_input_tokens=None):
         self.temperature = temperature
         self.num_examples = num_examples
+        self.num_proc = num_proc
+        self.tokenizer_name = tokenizer_name
+        self.max_input_tokens = max_input_tokens
         self.num_payloads = 0
+        self.dataset_fingerprint = None
+        self._prompt_budget = None
         if system_prompt_path:
             self.system_prompt = self._get_prompt_txt(system_prompt_path)
     
-    def create_payload(self, **kwargs):
-        """
-        Abstract method to create a payload for an API request.
-        """
-        raise NotImplementedError("Subclasses must implement this method.")
+    @property
+    def template_fields(self):
+        """The dataset columns referenced by the user message template."""
+        return [field for _, field, _, _ in Formatter().parse(self.user_template) if field]
     
-    def save_payload(self, api_request_list):
-        """
-        Save the payloads to the specified file path.
-        """
-        raise NotImplementedError("Subclasses must implement this method.")
+    @property
+    def input_columns(self):
+        """The dataset columns the payloads are built from."""
+        return self.template_fields + [self.ground_truth_field]
     
-    def _get_prompt_txt(self, system_prompt_path):
-        """Returns the system prompt text from the specified file path.
+    def get_store_header(self):
+        header = {
+            "messages": [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "template": self.user_template},
+            ],
+            "token_budget": {"tokenizer": self.tokenizer_name, "max_input_tokens": self.max_input_tokens},
+            "defaults": {"temperature": self.temperature},
+        }
+        if self.dataset_fingerprint is not None:
+            header["dataset"] = self.dataset_fingerprint
+        return header
+    
+    @property
+    def prompt_budget(self):
+        if self._prompt_budget is None:
+            self._prompt_budget = PromptBudget(
+                get_tokenizer(self.tokenizer_name), self.get_store_header()["messages"], self.max_input_tokens
+            )
+        return self._prompt_budget
+    
+    def create_payload(self, **kwargs):
+        """Creates the payloads of the dataset rows, resuming from the cached ones.
 
-        Args:
-            system_prompt_path (str): The file path to the system prompt text.
+        The rows are built by a batched `datasets.map` over `num_proc`
+        processes, into an in-memory Arrow column of encoded rows that is
+        written to the payload store in bulk.
 
         Returns:
-            str: The system prompt text.
+            PayloadStore: The payloads, decoded from the payload store on access.
         """
-        system_prompt = ""
-        if system_prompt_path and os.path.isfile(system_prompt_path):
-            with open(system_prompt_path, "r") as f:
-                system_prompt = f.read()
-        return system_prompt
-
-
-class QuestionGenerationPayloadCreator(AbstractPayloadCreator):
-    def __init__(self, temperature, system_prompt_path):
-        super().__init__(temperature, 0, system_prompt_path)
-
-    def create_payload(self, **kwargs):
         input_dataset = kwargs['input_dataset']
+        payload_path = kwargs['payload_path']
         self.num_examples = len(input_dataset)
+        self.dataset_fingerprint = getattr(input_dataset, "fingerprint", None)
         
         print(f"[[Creating payloads]]")
-               
+        
         # Step 1: Check to cached payloads
-        api_request_list = []
-        if kwargs['reset'] is True:         # TODO: Fix this
-            pass
-        else:
-            api_request_list = self.load_cached_payload(kwargs['payload_path'])
-            self.num_payloads = len(api_request_list)
-            
+        writer = self.open_payload_store(payload_path, kwargs['reset'])
+        self.num_payloads = min(writer.num_rows, self.num_examples)
+        if kwargs['reset'] is not True:
             print(f"- Num of examples: {self.num_examples}")
             print(f"- Num of payloads: {self.num_payloads}")
             
             if self.num_payloads == self.num_examples:
                 print(f"Successfully loaded the cached payloads!")
-                return api_request_list
             elif self.num_payloads > 0:
                 print(f"Continuing from {self.num_payloads} cached payloads...")
+        
+        # Step 2: Create the remaining payloads
+        with writer:
+            if self.num_payloads == self.num_examples:
+                return PayloadStore(payload_path, num_rows=self.num_examples)
             
-        # Step 2: Create the payloads
-        for input_data in tqdm(
-            input_dataset.select(range(self.num_payloads, self.num_examples)),
-            desc="Creating payloads",
+            # The tokenizer is loaded once and shipped to the workers with the creator
+            self.prompt_budget
+            remaining_dataset = input_dataset.select(range(self.num_payloads, self.num_examples))
+            encoded_rows = remaining_dataset.map(
+                self.encode_rows,
+                batched=True,
+                with_indices=True,
+                fn_kwargs={"start": self.num_payloads},
+                input_columns=self.input_columns,
+                remove_columns=remaining_dataset.column_names,
+                num_proc=self.num_proc if self.num_proc > 1 else None,
+                keep_in_memory=True,
+                desc="Creating payloads",
+            )
+            for batch in encoded_rows.iter(batch_size=PAYLOAD_BUFFER_SIZE):
+                writer.write_encoded(batch["payload_row"])
+            self.num_payloads = self.num_examples
+            self._report_input_tokens(encoded_rows["num_input_tokens"], encoded_rows["num_truncated_tokens"])
+        
+        return PayloadStore(payload_path, num_rows=self.num_examples)
+    
+    def encode_rows(self, *columns, start=0):
+        """Encodes the stored rows of a batch of dataset rows (a batched `datasets.map` function).
+
+        Args:
+            *columns: The template field columns and the ground truth column of
+                the batch, followed by the batch indices.
+            start (int): The dataset index of the first row of the mapped dataset.
+
+        Returns:
+            dict: The `payload_row` column, the JSON encoding of each row, and
+            the input tokens and truncated tokens of each payload.
+        """
+        *field_columns, ground_truths, indices = columns
+        field_columns, num_input_tokens, num_truncated_tokens = self.prompt_budget.fit(
+            dict(zip(self.template_fields, field_columns))
+        )
+        payload_rows = []
+        for index, ground_truth, num_tokens, num_truncated, *values in zip(
+            indices, ground_truths, num_input_tokens, num_truncated_tokens, *field_columns.values()
         ):
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {
-                    "role": "user", 
-                    "content": f"Paragraph: {input_data['paragraph']}\nAnswer: {input_data['answer']}"
-                },
-            ]
-            payload = {
-                "messages": messages,
-                "temperature": self.temperature,
-                "ground_truth": input_data["question"],
+            row = {
+                "id": start + index,
+                "fields": dict(zip(field_columns, values)),
+                "ground_truth": ground_truth,
+                "num_input_tokens": num_tokens,
             }
-            self.save_payload(payload, kwargs['payload_path'])
-
-            api_request_list.append(payload)
-            
-        return api_request_list
+            if num_truncated > 0:
+                row["num_truncated_tokens"] = num_truncated
+            payload_rows.append(json.dumps(row, ensure_ascii=False))
+        return {
+            "payload_row": payload_rows,
+            "num_input_tokens": num_input_tokens,
+            "num_truncated_tokens": num_truncated_tokens,
+        }
     
-    def save_payload(self, payload, payload_path):
-        os.makedirs(os.path.dirname(payload_path), exist_ok=True)
-        with jsonlines.open(payload_path, mode="a") as writer:
-            writer.write(payload)
-
-    def load_cached_payload(self, payloads_path):
-        print(f"Checking for cached payloads...")
-        
-        if os.path.exists(payloads_path):
-            print(f"Payloads already exists at '{payloads_path}'.")
-            api_request_list = []
-            with jsonlines.open(payloads_path, mode="r") as reader:
-                for line in reader:
-                    api_request_list.append(line)
-            return api_request_list
+    def build_payload(self, index, input_data):
+        """Returns the API request payload of a single dataset row."""
+        columns = [[input_data[field]] for field in self.input_columns]
+        encoded_row = self.encode_rows(*columns, [index])["payload_row"][0]
+        return decode_payload(self.get_store_header(), json.loads(encoded_row))
+    
+    def open_payload_store(self, payload_path, reset=False):
+        if reset is True:
+            remove_payload_store(payload_path)
         else:
-            print(f"No cached payloads found.")
-            return []
-        
-
-class SummarizationPayloadCreator(AbstractPayloadCreator):
-    def __init__(self, temperature, system_prompt_path):
-        super().__init__(temperature, 0, system_prompt_path)
+            print(f"Checking for cached payloads...")
+            if os.path.isdir(payload_path):
+                print(f"Payloads already exists at '{payload_path}'.")
+            else:
+                print(f"No cached payloads found.")
+        return PayloadStoreWriter(payload_path, self.get_store_header())
+    
+    def _report_input_tokens(self, num_input_tokens, num_truncated_tokens):
+        print(f"- Num of input tokens: {sum(num_input_tokens)} (max {max(num_input_tokens, default=0)} per payload, {self.tokenizer_name} tokenizer)")
+        num_truncated = sum(1 for num_tokens in num_truncated_tokens if num_tokens > 0)
+        if num_truncated > 0:
+            print(f"- Truncated {num_truncated} payloads to {self.max_input_tokens} input tokens ({sum(num_truncated_tokens)} tokens dropped)")
+    
+    def iter_payload(self, **kwargs):
+        """Yields the payloads one by one without keeping them in memory.
 
-    def create_payload(self, **kwargs):
+        Cached payloads are streamed from the payload store, and the remaining
+        ones are built from the dataset one batch at a time and appended to it
+        as they are yielded.
+        """
         input_dataset = kwargs['input_dataset']
+        payload_path = kwargs['payload_path']
         self.num_examples = len(input_dataset)
+        self.dataset_fingerprint = getattr(input_dataset, "fingerprint", None)
         
-        print(f"[[Creating payloads]]")
-               
-        # Step 1: Check to cached payloads
-        api_request_list = []
-        if kwargs['reset'] is True:         # TODO: Fix this
-            pass
-        else:
-            api_request_list = self.load_cached_payload(kwargs['payload_path'])
-            self.num_payloads = len(api_request_list)
-            
-            print(f"- Num of examples: {self.num_examples}")
-            print(f"- Num of payloads: {self.num_payloads}")
+        print(f"[[Creating payloads (streaming)]]")
+        
+        with self.open_payload_store(payload_path, kwargs['reset']) as writer:
+            # Step 1: Stream the cached payloads
+            self.num_payloads = 0
+            if writer.num_rows > 0:
+                print(f"Streaming cached payloads from '{payload_path}'...")
+                for payload in PayloadStore(payload_path, num_rows=self.num_examples):
+                    self.num_payloads += 1
+                    yield payload
             
+            # Step 2: Build the remaining payloads
             if self.num_payloads == self.num_examples:
-                print(f"Successfully loaded the cached payloads!")
-                return api_request_list
-            elif self.num_payloads > 0:
-                print(f"Continuing from {self.num_payloads} cached payloads...")
-            
-        # Step 2: Create the payloads
-        for input_data in tqdm(
-            input_dataset.select(range(self.num_payloads, self.num_examples)),
-            desc="Creating payloads",
-        ):
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {
-                    "role": "user", 
-                    "content": input_data['article']
-                },
-            ]
-            payload = {
-                "messages": messages,
-                "temperature": self.temperature,
-                "ground_truth": input_data["summary"],
-            }
-            self.save_payload(payload, kwargs['payload_path'])
+                return
+            header = self.get_store_header()
+            remaining_dataset = input_dataset.select(range(self.num_payloads, self.num_examples))
+            for batch in remaining_dataset.iter(batch_size=PAYLOAD_BUFFER_SIZE):
+                columns = [batch[field] for field in self.input_columns]
+                indices = range(len(columns[-1]))
+                encoded_rows = self.encode_rows(*columns, indices, start=self.num_payloads)["payload_row"]
+                writer.write_encoded(encoded_rows)
+                for encoded_row in encoded_rows:
+                    self.num_payloads += 1
+                    yield decode_payload(header, json.loads(encoded_row))
+    
+    def _get_prompt_txt(self, system_prompt_path):
+        """Returns the system prompt text from the specified file path.
 
-            api_request_list.append(payload)
-            
-        return api_request_list
+        Args:
+            system_prompt_path (str): The file path to the system prompt text.
+
+        Returns:
+            str: The system prompt text.
+        """
+        system_prompt = ""
+        if system_prompt_path and os.path.isfile(system_prompt_path):
+            with open(system_prompt_path, "r") as f:
+                system_prompt = f.read()
+        return system_prompt
+
+
+class TemplatePayloadCreator(AbstractPayloadCreator):
+    """
+    Creates the payloads of any task from a user message template.
+
+    The template references dataset columns as `{column}` placeholders (e.g.
+    "Paragraph: {paragraph}\\nAnswer: {answer}"), and the ground truth is
+    read from `ground_truth_field`.
+    """
+    def __init__(self, temperature, system_prompt_path, user_template, ground_truth_field, num_proc=1, tokenizer_name="approx", max_input_tokens=None):
+        super().__init__(temperature, 0, system_prompt_path, num_proc, tokenizer_name, max_input_tokens)
+        self.user_template = user_template
+        self.ground_truth_field = ground_truth_field
+
+
+class QuestionGenerationPayloadCreator(AbstractPayloadCreator):
+    user_template = "Paragraph: {paragraph}\nAnswer: {answer}"
+    ground_truth_field = "question"
     
-    def save_payload(self, payload, payload_path):
-        os.makedirs(os.path.dirname(payload_path), exist_ok=True)
-        with jsonlines.open(payload_path, mode="a") as writer:
-            writer.write(payload)
+    def __init__(self, temperature, system_prompt_path, num_proc=1, tokenizer_name="approx", max_input_tokens=None):
+        super().__init__(temperature, 0, system_prompt_path, num_proc, tokenizer_name, max_input_tokens)
 
-    def load_cached_payload(self, payloads_path):
-        print(f"Checking for cached payloads...")
-        
-        if os.path.exists(payloads_path):
-            print(f"Payloads already exists at '{payloads_path}'.")
-            api_request_list = []
-            with jsonlines.open(payloads_path, mode="r") as reader:
-                for line in reader:
-                    api_request_list.append(line)
-            return api_request_list
-        else:
-            print(f"No cached payloads found.")
-            return []
+
+class SummarizationPayloadCreator(AbstractPayloadCreator):
+    user_template = "{article}"
+    ground_truth_field = "summary"
+    
+    def __init__(self, temperature, system_prompt_path, num_proc=1, tokenizer_name="approx", max_input_tokens=None):
+        super().__init__(temperature, 0, system_prompt_path, num_proc, tokenizer_name, max_input_tokens)
 
 
 class PayloadCreatorFactory:
@@ -187,16 +267,25 @@ class PayloadCreatorFactory:
     A factory class to specify payload creator based on the type of task.
     """
     @staticmethod
-    def get_payload_creator(task_type, temperature, system_prompt_path):
+    def get_payload_creator(task_type, temperature, system_prompt_path, user_template=None, ground_truth_field=None, num_proc=1, tokenizer_name="approx", max_input_tokens=None):
         """Returns an instance of the payload creator based on the specified task type.
-        
+
         Args:
             task_type (str): The type of task for which the payload creator is needed.
+            user_template (str): A user message template with `{column}` placeholders,
+                which builds the payloads of any task type (default: the template of the task type).
+            ground_truth_field (str): The ground truth column, required with `user_template`.
+            num_proc (int): The number of processes that build the payloads.
+            tokenizer_name (str): The tokenizer that counts the input tokens of the payloads.
+            max_input_tokens (int): The input token budget of each payload (default: no budget).
         """
-        if task_type == "QG":
-            return QuestionGenerationPayloadCreator(temperature, system_prompt_path)
+        if user_template is not None:
+            if ground_truth_field is None:
+                raise ValueError("A ground truth field is required with a user message template.")
+            return TemplatePayloadCreator(temperature, system_prompt_path, user_template, ground_truth_field, num_proc, tokenizer_name, max_input_tokens)
+        elif task_type == "QG":
+            return QuestionGenerationPayloadCreator(temperature, system_prompt_path, num_proc, tokenizer_name, max_input_tokens)
         elif task_type == "SUM":
-            return SummarizationPayloadCreator(temperature, system_prompt_path)
+            return SummarizationPayloadCreator(temperature, system_prompt_path, num_proc, tokenizer_name, max_input_tokens)
         else:
-            raise ValueError(f"Unsupported task type: {task_type}")
-        
\ No newline at end of file
+            raise ValueError(f"Unsupported task type: {task_type} (pass a user message template to create its payloads)")
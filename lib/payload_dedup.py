@@ -0,0 +1,106 @@
+import os
+from collections import OrderedDict
+
+from lib.token_budget import APPROX_CHARS_PER_TOKEN
+from lib.utils import get_payload_hash
+
+# Max number of recent responses kept to answer duplicates in streaming mode
+DEDUP_WINDOW_SIZE = 1000
+
+
+def get_prompt_text(payload):
+    return "\n".join(message["content"] for message in payload["messages"])
+
+
+def sort_by_prefix(payloads):
+    """Orders the payloads so that payloads sharing a prompt prefix are sent one after another.
+
+    Sorting by the message texts puts the payloads of the same system prompt
+    and paragraph next to each other, so that the prompt (KV) cache of the
+    server is reused by the next request instead of being evicted.
+    """
+    return sorted(payloads, key=lambda payload: [message["content"] for message in payload["messages"]])
+
+
+def get_shared_prefix_ratio(payloads):
+    """Returns the fraction of the prompt characters shared with the previous payload, in order."""
+    num_chars = 0
+    num_shared_chars = 0
+    previous_text = ""
+    for payload in payloads:
+        text = get_prompt_text(payload)
+        num_chars += len(text)
+        num_shared_chars += len(os.path.commonprefix([previous_text, text]))
+        previous_text = text
+    return num_shared_chars / num_chars if num_chars > 0 else 0.0
+
+
+def _get_num_input_tokens(payload):
+    num_input_tokens = payload.get("num_input_tokens")
+    if num_input_tokens is None:
+        num_input_tokens = len(get_prompt_text(payload)) // APPROX_CHARS_PER_TOKEN
+    return num_input_tokens
+
+
+class PayloadDeduplicator:
+    """
+    Fetches the exact-duplicate payloads of a run once.
+
+    Payloads are duplicates when their payload hashes (messages and
+    temperature) match. The response of the first one is fanned out to the
+    others as a copy marked with `duplicate_of`; the copies carry no request
+    metrics, so the performance report only counts the requests actually sent.
+    """
+    def __init__(self):
+        self.duplicates = {}
+        self.recent_responses = OrderedDict()
+        self.num_duplicates = 0
+        self.num_saved_tokens = 0
+
+    def dedup(self, payloads):
+        """Returns the first payload of each group of duplicates, and keeps the others to fan out."""
+        unique_payloads = {}
+        for payload in payloads:
+            payload_hash = get_payload_hash(payload)
+            if payload_hash in unique_payloads:
+                self.duplicates.setdefault(unique_payloads[payload_hash]["id"], []).append(payload)
+                self._count_duplicate(payload)
+            else:
+                unique_payloads[payload_hash] = payload
+        return list(unique_payloads.values())
+
+    def fan_out(self, output_response):
+        """Returns the copies of an output response for the duplicates of its payload."""
+        return [
+            self.copy_response(output_response, payload)
+            for payload in self.duplicates.pop(output_response["id"], [])
+        ]
+
+    def copy_response(self, output_response, payload):
+        response = {key: value for key, value in output_response.items() if key != "metrics"}
+        response["id"] = payload["id"]
+        if "error" not in response:
+            response["duplicate_of"] = output_response["id"]
+        return response
+
+    def get_recent_response(self, payload):
+        """Returns the recent response (or pending task) of a duplicate of the payload, in streaming mode."""
+        payload_hash = get_payload_hash(payload)
+        response = self.recent_responses.get(payload_hash)
+        if response is not None:
+            self.recent_responses.move_to_end(payload_hash)
+            self._count_duplicate(payload)
+        return response
+
+    def add_recent_response(self, payload, response):
+        self.recent_responses[get_payload_hash(payload)] = response
+        if len(self.recent_responses) > DEDUP_WINDOW_SIZE:
+            self.recent_responses.popitem(last=False)
+
+    def _count_duplicate(self, payload):
+        self.num_duplicates += 1
+        self.num_saved_tokens += _get_num_input_tokens(payload)
+
+    def report(self):
+        if self.num_duplicates > 0:
+            print(f"- Deduplicated payloads: {self.num_duplicates} ({self.num_saved_tokens} input tokens saved)")
@@ -0,0 +1,233 @@
+import os
+import json
+import mmap
+import shutil
+from array import array
+
+# Number of rows buffered in memory before they are written to the store
+PAYLOAD_BUFFER_SIZE = 1000
+
+HEADER_FILE = "header.json"
+ROWS_FILE = "rows.jsonl"
+INDEX_FILE = "index.bin"
+
+
+def decode_payload(header, row, defaults=None):
+    """Builds the API request payload of a stored row.
+
+    The messages are rendered from the message templates of the header with
+    the `fields` of the row, and the other keys of the row (e.g. the ground
+    truth) are added on top of the default request fields.
+    """
+    fields = row.get("fields", {})
+    payload = {
+        "id": row["id"],
+        "messages": [
+            {
+                "role": message["role"],
+                "content": message["content"] if "content" in message else message["template"].format(**fields),
+            }
+            for message in header["messages"]
+        ],
+    }
+    payload.update(header["defaults"] if defaults is None else defaults)
+    payload.update((key, value) for key, value in row.items() if key not in ("id", "fields"))
+    return payload
+
+
+def get_payload_map(input_payloads):
+    """Returns the payloads keyed by id.
+
+    A payload store is returned as is, since its payload ids are its row
+    indices: payloads are then decoded one at a time on lookup.
+    """
+    if isinstance(input_payloads, PayloadStore):
+        return input_payloads
+    return {payload["id"]: payload for payload in input_payloads}
+
+
+def remove_payload_store(store_path):
+    if os.path.isdir(store_path):
+        shutil.rmtree(store_path)
+
+
+def _read_header(store_path):
+    header_path = os.path.join(store_path, HEADER_FILE)
+    if not os.path.exists(header_path):
+        return None
+    with open(header_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_header(store_path, header):
+    header_path = os.path.join(store_path, HEADER_FILE)
+    with open(f"{header_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(header, f, ensure_ascii=False)
+    os.replace(f"{header_path}.tmp", header_path)
+
+
+def _get_row_config(header):
+    """Returns the header fields the stored rows depend on (the default request fields are applied on decode)."""
+    return {key: value for key, value in header.items() if key != "defaults"}
+
+
+def _read_offsets(store_path):
+    """Returns the row offsets of a store, up to the last row fully written to the rows file.
+
+    The index holds the start offset of each row followed by the end offset
+    of the last one, so there is one more offset than rows.
+    """
+    offsets = array("Q")
+    index_path = os.path.join(store_path, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path, "rb") as f:
+            data = f.read()
+        offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+    if not offsets:
+        return array("Q", [0])
+
+    # Rows indexed after an interrupted write of the rows file are dropped
+    rows_path = os.path.join(store_path, ROWS_FILE)
+    rows_size = os.path.getsize(rows_path) if os.path.exists(rows_path) else 0
+    num_offsets = len(offsets)
+    while num_offsets > 1 and offsets[num_offsets - 1] > rows_size:
+        num_offsets -= 1
+    return offsets[:num_offsets]
+
+
+class PayloadStore:
+    """
+    A read-only, memory-mapped view of a payload store.
+
+    A payload store is a directory of three files:
+    - `header.json`: the message templates (with the system prompt) and the
+      default request fields, shared by every payload
+    - `rows.jsonl`: the fields of each payload, one JSON object per line
+    - `index.bin`: the byte offset of each row, as uint64
+
+    The store behaves like a read-only list of payloads: payload i is decoded
+    from its row in O(1), and iterating only decodes one row at a time.
+    """
+    def __init__(self, store_path, defaults=None, num_rows=None):
+        self.store_path = store_path
+        self.header = _read_header(store_path)
+        if self.header is None:
+            raise FileNotFoundError(f"No payload store found at '{store_path}'.")
+        self.defaults = {**self.header["defaults"], **(defaults or {})}
+        self.offsets = _read_offsets(store_path)
+        self.num_rows = len(self.offsets) - 1 if num_rows is None else min(num_rows, len(self.offsets) - 1)
+        self._rows = None
+
+    @property
+    def rows(self):
+        if self._rows is None:
+            if self.offsets[-1] == 0:
+                self._rows = b""
+            else:
+                with open(os.path.join(self.store_path, ROWS_FILE), "rb") as f:
+                    self._rows = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._rows
+
+    def get_row(self, index):
+        return json.loads(self.rows[self.offsets[index]:self.offsets[index + 1]])
+
+    def iter_range(self, start=0, stop=None):
+        """Yields the payloads of the rows in [start, stop)."""
+        stop = self.num_rows if stop is None else min(stop, self.num_rows)
+        for index in range(start, stop):
+            yield decode_payload(self.header, self.get_row(index), self.defaults)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.iter_range(*index.indices(self.num_rows)[:2]))
+        if index < 0:
+            index += self.num_rows
+        if not 0 <= index < self.num_rows:
+            raise IndexError(f"Payload index {index} is out of range.")
+        return decode_payload(self.header, self.get_row(index), self.defaults)
+
+    def __iter__(self):
+        return self.iter_range()
+
+    def __getstate__(self):
+        # The memory map is re-opened on first access after unpickling
+        return {**self.__dict__, "_rows": None}
+
+    def close(self):
+        if isinstance(self._rows, mmap.mmap):
+            self._rows.close()
+        self._rows = None
+
+
+class PayloadStoreWriter:
+    """
+    Appends rows to a payload store in buffered batches.
+
+    The rows of an existing store are kept if its message templates, token
+    budget and dataset fingerprint are unchanged, and dropped otherwise (e.g.
+    after the system prompt was edited, or another shard was loaded). Each flush appends the rows and then their offsets, so an
+    interrupted write at most loses the rows of the last buffer.
+    """
+    def __init__(self, store_path, header, buffer_size=PAYLOAD_BUFFER_SIZE):
+        self.store_path = store_path
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+        cached_header = _read_header(store_path)
+        if cached_header is not None and _get_row_config(cached_header) != _get_row_config(header):
+            print(f"The message templates, token budget or dataset changed since the payloads at '{store_path}' were created.")
+            remove_payload_store(store_path)
+            cached_header = None
+        os.makedirs(store_path, exist_ok=True)
+        if cached_header != header:
+            _write_header(store_path, header)
+
+        self.offsets = _read_offsets(store_path) if cached_header is not None else array("Q", [0])
+        self.num_rows = len(self.offsets) - 1
+        self.rows_file = open(os.path.join(store_path, ROWS_FILE), "ab")
+        self.rows_file.truncate(self.offsets[-1])
+        self.index_file = open(os.path.join(store_path, INDEX_FILE), "ab")
+        if self.num_rows > 0:
+            self.index_file.truncate(len(self.offsets) * self.offsets.itemsize)
+        else:
+            self.index_file.truncate(0)
+            self.index_file.write(self.offsets.tobytes())
+
+    def write(self, row):
+        self.write_encoded([json.dumps(row, ensure_ascii=False)])
+
+    def write_encoded(self, encoded_rows):
+        """Appends rows already encoded as JSON strings."""
+        self.buffer.extend(encoded_row.encode("utf-8") + b"\n" for encoded_row in encoded_rows)
+        self.num_rows += len(encoded_rows)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        new_offsets = array("Q")
+        offset = self.offsets[-1]
+        for line in self.buffer:
+            offset += len(line)
+            new_offsets.append(offset)
+        self.rows_file.write(b"".join(self.buffer))
+        self.rows_file.flush()
+        self.index_file.write(new_offsets.tobytes())
+        self.index_file.flush()
+        self.offsets.extend(new_offsets)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.rows_file.close()
+        self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
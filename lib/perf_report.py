@@ -0,0 +1,158 @@
+import json
+import time
+import argparse
+from contextlib import contextmanager
+
+from lib.utils import load_keyed_records
+
+PERCENTILES = (50, 95, 99)
+
+
+class StageTimer:
+    """
+    Records the wall time of the stages of a run, in the order they ran.
+    """
+    def __init__(self):
+        self.stage_times = {}
+        self.current_stage = None
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        self.current_stage = name
+        try:
+            yield
+        finally:
+            self.current_stage = None
+            self.stage_times[name] = round(self.stage_times.get(name, 0.0) + time.perf_counter() - start_time, 3)
+
+
+def get_percentiles(values):
+    """Returns the p50/p95/p99 (linearly interpolated), mean and max of the values, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    summary = {}
+    for percentile in PERCENTILES:
+        rank = (len(values) - 1) * percentile / 100
+        lower = int(rank)
+        upper = min(lower + 1, len(values) - 1)
+        summary[f"p{percentile}"] = round(values[lower] + (values[upper] - values[lower]) * (rank - lower), 4)
+    summary["mean"] = round(sum(values) / len(values), 4)
+    summary["max"] = round(values[-1], 4)
+    return summary
+
+
+def get_perf_report(responses, stage_times=None, api_executor=None, input_token_price=None, output_token_price=None):
+    """Builds the performance report of the responses of a run.
+
+    Args:
+        responses (iterable): The output records. Only the records fetched
+            from the API carry request metrics; cached ones are skipped.
+        stage_times (dict): The wall time of each stage of the run, in seconds.
+        api_executor (OpenaiAPIExecutor): The API executor of the run, for the
+            throughput of the requests it sent.
+        input_token_price (float): The price of 1M input tokens, for the cost estimate.
+        output_token_price (float): The price of 1M output tokens, for the cost estimate.
+
+    Returns:
+        dict: The latency percentiles, token usage and throughput, and cost estimate.
+    """
+    metrics = [response["metrics"] for response in responses if "metrics" in response]
+    latencies = [metric["latency"] for metric in metrics if "latency" in metric]
+    prompt_tokens = sum(metric.get("prompt_tokens", 0) for metric in metrics)
+    completion_tokens = sum(metric.get("completion_tokens", 0) for metric in metrics)
+
+    report = {
+        "num_requests": len(metrics),
+        "latency": get_percentiles(latencies),
+        "total_time": get_percentiles([metric["total_time"] for metric in metrics if "total_time" in metric]),
+        "ttft": get_percentiles([metric["ttft"] for metric in metrics if "ttft" in metric]),
+        "inter_token_latency": get_percentiles([metric["inter_token_latency"] for metric in metrics if "inter_token_latency" in metric]),
+        "tokens_per_sec": get_percentiles([
+            metric["completion_tokens"] / metric["latency"]
+            for metric in metrics if metric.get("latency") and "completion_tokens" in metric
+        ]),
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+        "num_retries": sum(metric.get("num_retries", 0) for metric in metrics),
+        "num_stopped_early": sum(1 for metric in metrics if "stopped_early" in metric),
+    }
+
+    endpoints = {}
+    for metric in metrics:
+        if "endpoint" in metric and "latency" in metric:
+            endpoints.setdefault(metric["endpoint"], []).append(metric["latency"])
+    if len(endpoints) > 1:
+        report["endpoints"] = {
+            endpoint: {"num_requests": len(latencies), "latency": get_percentiles(latencies)}
+            for endpoint, latencies in endpoints.items()
+        }
+
+    if stage_times:
+        report["stage_times"] = stage_times
+    # The throughput only counts the requests sent by this run, over the wall time of
+    # the fetch stage (or of the whole pipeline, whose stages are interleaved when streaming)
+    fetch_time = (stage_times or {}).get("fetch", (stage_times or {}).get("pipeline"))
+    if api_executor is not None and api_executor.num_completions > 0 and fetch_time:
+        report["throughput"] = {
+            "requests_per_sec": round(api_executor.num_completions / fetch_time, 3),
+            "tokens_per_sec": round(api_executor.num_completion_tokens / fetch_time, 3),
+        }
+    if input_token_price is not None and output_token_price is not None:
+        report["cost"] = round((prompt_tokens * input_token_price + completion_tokens * output_token_price) / 1e6, 4)
+    return report
+
+
+def save_perf_report(report, report_path):
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def print_perf_report(report):
+    print(f"[[Performance Report]]")
+    print(f"- Num of requests: {report['num_requests']} ({report['num_retries']} retries)")
+    for key, name, unit in (
+        ("latency", "Latency", "s"),
+        ("total_time", "Total time (with throttling and retries)", "s"),
+        ("ttft", "Time to first token", "s"),
+        ("inter_token_latency", "Inter-token latency", "ms"),
+        ("tokens_per_sec", "Tokens/sec per request", ""),
+    ):
+        if report[key] is not None:
+            scale = 1000 if unit == "ms" else 1
+            percentiles = ", ".join(f"p{percentile} {report[key][f'p{percentile}'] * scale:.2f}{unit}" for percentile in PERCENTILES)
+            print(f"- {name}: {percentiles} (max {report[key]['max'] * scale:.2f}{unit})")
+    print(f"- Usage: {report['usage']['prompt_tokens']} prompt tokens, {report['usage']['completion_tokens']} completion tokens")
+    if report["num_stopped_early"] > 0:
+        print(f"- Stopped early by the client-side budget: {report['num_stopped_early']} completions")
+    for endpoint, endpoint_report in report.get("endpoints", {}).items():
+        print(f"  - {endpoint}: {endpoint_report['num_requests']} requests, p50 {endpoint_report['latency']['p50']:.2f}s, "
+              f"p95 {endpoint_report['latency']['p95']:.2f}s")
+    if "throughput" in report:
+        print(f"- Throughput: {report['throughput']['requests_per_sec']:.2f} requests/sec, "
+              f"{report['throughput']['tokens_per_sec']:.2f} tokens/sec")
+    if "stage_times" in report:
+        print(f"- Stage times: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in report["stage_times"].items()))
+    if "cost" in report:
+        print(f"- Estimated cost: ${report['cost']:.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the request latency and token usage of `.output.jsonl` files.")
+    parser.add_argument("response_paths", type=str, nargs="+", help="The `.output.jsonl` files to report (e.g. of two Ollama versions)")
+    parser.add_argument("--input_token_price", type=float, help="Price of 1M input tokens", default=None)
+    parser.add_argument("--output_token_price", type=float, help="Price of 1M output tokens", default=None)
+    args = parser.parse_args()
+
+    for response_path in args.response_paths:
+        responses, _ = load_keyed_records(response_path)
+        print(f"'{response_path}'")
+        print_perf_report(get_perf_report(
+            responses.values(),
+            input_token_price=args.input_token_price,
+            output_token_price=args.output_token_price,
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import re
+import time
+import random
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# Status codes worth retrying besides 429 and 5xx
+_RETRYABLE_STATUS_CODES = {408, 409}
+
+
+def parse_duration(value):
+    """Returns the seconds of a rate-limit reset header value (e.g. '6m0s', '20ms'), or None."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION_RE.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def get_retry_after(error):
+    """Returns the delay in seconds requested by the `retry-after` headers of an API error (or by an open circuit), or None."""
+    if isinstance(error, CircuitOpenError):
+        return error.retry_after
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    if response.headers.get("retry-after-ms") is not None:
+        return parse_duration(response.headers["retry-after-ms"]) / 1000
+    return parse_duration(response.headers.get("retry-after"))
+
+
+def is_rate_limit_error(error):
+    import openai
+    
+    return isinstance(error, openai.RateLimitError)
+
+
+def is_retryable_error(error):
+    """Returns True if the request may succeed when sent again (rate limits, timeouts, connection and server errors, open circuits)."""
+    import openai
+    
+    if isinstance(error, CircuitOpenError):
+        # The circuit lets a probe request through once its reset timeout has passed
+        return True
+    if isinstance(error, openai.RateLimitError):
+        # An exhausted quota does not recover by waiting
+        return error.code != "insufficient_quota"
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code in _RETRYABLE_STATUS_CODES
+    return False
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously up to its per-minute limit.
+
+    Amounts are reserved up front, so the level may go negative: the deficit
+    is the wait time of the next reservations, which keeps concurrent
+    requests queued in order instead of bursting.
+    """
+    def __init__(self, limit_per_minute):
+        self.limit = limit_per_minute
+        self.level = float(limit_per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.limit, self.level + (now - self.updated_at) * self.limit / 60)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        """Takes the amount from the bucket and returns the seconds to wait before using it."""
+        self._refill()
+        self.level -= amount
+        return max(0.0, -self.level * 60 / self.limit)
+
+    def refund(self, amount):
+        self._refill()
+        self.level = min(self.limit, self.level + amount)
+
+    def sync(self, limit, remaining):
+        """Aligns the bucket with the limit and remaining amount reported by the server."""
+        self._refill()
+        if limit is not None and limit < self.limit:
+            self.level -= self.limit - limit
+            self.limit = limit
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """
+    Throttles the requests to the requests-per-minute and tokens-per-minute limits of a provider.
+
+    The limits may be given up front. Otherwise they are learned from the
+    `x-ratelimit-*` response headers, which also correct the bucket levels
+    as the run goes. A 429 pauses every request until its `retry-after`.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+
+    def reserve(self, num_tokens):
+        """Reserves a request of `num_tokens` tokens and returns the seconds to wait before sending it."""
+        delay = max(0.0, self.paused_until - time.monotonic())
+        if self.request_bucket is not None:
+            delay = max(delay, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            delay = max(delay, self.token_bucket.reserve(num_tokens))
+        return delay
+
+    def correct_tokens(self, num_tokens):
+        """Corrects a token reservation by the difference between the actual and the estimated tokens."""
+        if self.token_bucket is None or num_tokens == 0:
+            return
+        if num_tokens > 0:
+            self.token_bucket.reserve(num_tokens)
+        else:
+            self.token_bucket.refund(-num_tokens)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        for name, bucket_attr in (("requests", "request_bucket"), ("tokens", "token_bucket")):
+            limit = headers.get(f"x-ratelimit-limit-{name}")
+            remaining = headers.get(f"x-ratelimit-remaining-{name}")
+            if limit is None:
+                continue
+            limit, remaining = int(limit), int(remaining) if remaining is not None else None
+            bucket = getattr(self, bucket_attr)
+            if bucket is None:
+                bucket = TokenBucket(limit)
+                setattr(self, bucket_attr, bucket)
+            bucket.sync(limit, remaining)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, bounded by `max_delay`.
+
+    A `retry-after` delay sent by the server takes precedence when longer.
+    """
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while the circuit breaker is open.
+
+    `retry_after` is the number of seconds until the circuit lets a probe
+    request through, so that the request is retried then.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint after `failure_threshold` consecutive failures.
+
+    Once `reset_timeout` seconds have passed, a single probe request is let
+    through: its success closes the circuit again, its failure re-opens it.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.num_failures = 0
+        self.opened_at = None
+        self.is_probing = False
+
+    @property
+    def is_open(self):
+        """Whether requests are currently refused (the probe request of a half-open circuit is in flight, if any)."""
+        if self.opened_at is None:
+            return False
+        return self.is_probing or time.monotonic() - self.opened_at < self.reset_timeout
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        if self.is_open:
+            raise CircuitOpenError(
+                f"Circuit breaker is open after {self.num_failures} consecutive failures.",
+                retry_after=self.get_retry_after()
+            )
+        self.is_probing = True
+
+    def get_retry_after(self):
+        """Returns the seconds until a probe request is let through (0 while a probe is in flight)."""
+        if self.opened_at is None or self.is_probing:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        self.num_failures = 0
+        self.opened_at = None
+        self.is_probing = False
+
+    def cancel_probe(self):
+        """Lets another probe request through, after a probe whose outcome says nothing of the endpoint."""
+        self.is_probing = False
+
+    def record_failure(self):
+        self.num_failures += 1
+        if self.is_probing or self.num_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.is_probing = False
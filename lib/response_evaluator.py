@@ -1,7 +1,33 @@
 import os
+import math
+import time
+import hashlib
 import jsonlines
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from tqdm import tqdm
-from evaluate import load
+
+from lib.cache import get_cache_key
+from lib.metrics import compute_scores
+from lib.payload_store import get_payload_map
+from lib.result_store import (
+    ResultsParquetWriter,
+    get_parquet_path,
+    get_text_hash,
+    read_results_parquet,
+    write_results_parquet,
+)
+from lib.utils import (
+    EvalSummaryAccumulator,
+    load_keyed_records,
+    index_keyed_records,
+    read_record,
+    save_records,
+    ensure_trailing_newline,
+)
+
+# Number of responses per task sent to an evaluation worker in per-row mode
+EVAL_SHARD_SIZE = 100
 
 
 class AbstractResponseEvaluator:
@@ -20,80 +46,472 @@ class AbstractResponseEvaluator:
 
 
 class ReferenceBasedResponseEvaluator(AbstractResponseEvaluator):
-    def __init__(self):
+    METRIC_COLUMNS = ["bleu_4_score", "cer_score", "rouge_l_score"]
+    
+    def __init__(self, batch_size=1, num_workers=1, metric_cache=None, results_format="jsonl", metric_backend="builtin"):
         super().__init__(0)
         self.bleu_n = 1
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.metric_cache = metric_cache
+        self.results_format = results_format
+        self.metric_backend = metric_backend
+        self.worker_pool = None
+        self.bleu_scorer = None
+        # Running means of the results of the current call, read by the run monitor
+        self.score_summary = EvalSummaryAccumulator()
+    
+    def _load_scorers(self):
+        """Loads the `evaluate` scorers, which resolve their metric scripts through the Hugging Face Hub."""
+        from evaluate import load
+        
+        start_time = time.perf_counter()
         self.bleu_scorer = load("bleu")
         self.rouge_scorer = load("rouge")
         self.cer_scorer = load("cer")
+        print(f"- Loaded the `evaluate` scorers in {time.perf_counter() - start_time:.1f}s")
+    
+    def start_workers(self):
+        """Starts a process pool of `num_workers` workers shared by the following calls, until `close()`.
+
+        Without it, each call starts (and loads the scorers of) its own pool.
+        """
+        if self.num_workers > 1 and self.worker_pool is None:
+            self.worker_pool = self._create_worker_pool()
+    
+    def close(self):
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown(cancel_futures=True)
+            self.worker_pool = None
+    
+    def _create_worker_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            initializer=_init_eval_worker,
+            initargs=(self.batch_size, self.bleu_n, self.metric_backend),
+        )
+    
+    @property
+    def metric_configs(self):
+        """The (metric name, metric config) that each score column is computed with."""
+        return {
+            "bleu_4_score": ("bleu", {"max_order": self.bleu_n}),
+            "cer_score": ("cer", {}),
+            "rouge_l_score": ("rouge", {"rouge_type": "rougeL"}),
+        }
+    
+    @property
+    def metric_keys(self):
+        """A short hash of the metric config of each score column, stored with every result."""
+        return {column: get_cache_key(*config)[:16] for column, config in self.metric_configs.items()}
         
     def evaluate_response(self, **kwargs):
         input_payloads = kwargs['input_payloads']
         response_list = kwargs['response_list']
         self.num_responses = len(response_list)
+        self.score_summary = EvalSummaryAccumulator()
         
         print(f"[[Evaluating responses]]")
         
         # Step 1: Check to cached evaluation results
-        eval_results = []
-        if kwargs['reset'] is True:         # TODO: Fix this
-            pass
+        result_map = {}
+        if kwargs['reset'] is True:
+            self._remove_results(kwargs['results_path'])
         else:
-            eval_results = self.load_cached_results(kwargs['results_path'])
-            self.num_results = len(eval_results)
+            result_map = self.load_cached_results(kwargs['results_path'], input_payloads, response_list)
+            for result in result_map.values():
+                if not self._get_stale_columns(result):
+                    self.score_summary.update(result)
+            self.num_results = self.score_summary.num_responses
             
             print(f"- Num of responses: {self.num_responses}")
             print(f"- Num of evaluation results: {self.num_results}")
             
-            if self.num_results == self.num_responses:
+            # A complete jsonl checkpoint still needs to be compacted into the Parquet file
+            if self.num_results == self.num_responses and (self.results_format == "jsonl" or not os.path.exists(kwargs['results_path'])):
                 print(f"Successfully loaded the cached evaluation results!")
-                return eval_results
+                return [result_map[response["id"]] for response in response_list]
+            elif len(result_map) > self.num_results:
+                print(f"Re-scoring the stale metrics of {len(result_map) - self.num_results} cached evaluation results...")
             elif self.num_results > 0:
                 print(f"Continuing from {self.num_results} cached evaluation results...")
         
-        # Step 2: Evaluate the responses
-        for input, output in tqdm(
-            zip(kwargs['input_payloads'][self.num_results:], response_list[self.num_results:]),
-            desc="Evaluating responses",
-        ):
-            ground_truth = input["ground_truth"]
-            generated_response = output["generated_response"]
+        # Step 2: Evaluate the responses that have no valid cached result or stale metrics
+        payload_map = get_payload_map(input_payloads)
+        rows = []
+        for response in response_list:
+            cached_result = result_map.get(response["id"])
+            if cached_result is None or self._get_stale_columns(cached_result):
+                rows.append((response, payload_map[response["id"]]["ground_truth"], cached_result))
+        
+        if self.num_workers > 1:
+            chunk_size = self.batch_size if self.batch_size > 1 else EVAL_SHARD_SIZE
+            chunk_size = max(1, min(chunk_size, math.ceil(len(rows) / (self.num_workers * 4))))
+            desc = f"Evaluating responses (workers={self.num_workers})"
+        else:
+            chunk_size = max(self.batch_size, 1)
+            desc = f"Evaluating responses (batch_size={chunk_size})"
+        chunks = (rows[start:start + chunk_size] for start in range(0, len(rows), chunk_size))
+        
+        with tqdm(total=len(rows), desc=desc) as pbar:
+            for chunk_results, updated_results in self._score_chunks(chunks):
+                self.save_results_batch(updated_results, kwargs['results_path'])
+                
+                for result in chunk_results:
+                    result_map[result["id"]] = result
+                    self.score_summary.update(result)
+                pbar.update(len(chunk_results))
+        self._report_metric_cache()
+        
+        # Step 3: Compact the results file in response order
+        eval_results = [result_map[response["id"]] for response in response_list]
+        if self.results_format == "parquet":
+            write_results_parquet(eval_results, get_parquet_path(kwargs['results_path']), self.metric_keys)
+            os.remove(kwargs['results_path'])
+        else:
+            save_records(eval_results, kwargs['results_path'])
             
-            bleu_score = self.bleu_scorer.compute(predictions=[generated_response], references=[[ground_truth]], max_order=self.bleu_n)
-            cer_score = self.cer_scorer.compute(predictions=[generated_response], references=[ground_truth])
-            rouge_scores = self.rouge_scorer.compute(predictions=[generated_response], references=[ground_truth])
-
-            result = {
-                "generated_response": generated_response,
-                "ground_truth": ground_truth,
-                "bleu_4_score": bleu_score['bleu'],
-                "cer_score": cer_score,
-                "rouge_l_score": rouge_scores['rougeL'],
-            }
-            self.save_results(result, kwargs['results_path'])
+        return eval_results
             
-            eval_results.append(result)
+    def iter_result(self, **kwargs):
+        """Yields the evaluation result of each (payload, response) pair, in order.
+
+        Unlike `evaluate_response`, the pairs may be any iterable (e.g. the output
+        of `APIExecutor.iter_response`) and nothing is kept in memory beyond the
+        batches being scored. Failed responses are skipped, cached results are
+        read back through a byte-offset index of the results file, and new
+        results are appended to it as they are yielded.
+        """
+        results_path = kwargs['results_path']
+        self.score_summary = EvalSummaryAccumulator()
+        
+        print(f"[[Evaluating responses (streaming)]]")
+        
+        # Step 1: Index the cached evaluation results
+        offsets = {}
+        parquet_results = {}
+        if kwargs['reset'] is True:
+            self._remove_results(results_path)
+        else:
+            if os.path.exists(results_path):
+                print(f"Indexing cached evaluation results at '{results_path}'...")
+                offsets, _ = index_keyed_records(results_path)
+                ensure_trailing_newline(results_path)
+                print(f"- Num of cached evaluation records: {len(offsets)}")
+            if self.results_format == "parquet" and os.path.exists(get_parquet_path(results_path)):
+                parquet_results = read_results_parquet(get_parquet_path(results_path))
+                print(f"- Num of cached evaluation records (parquet): {len(parquet_results)}")
+        
+        cached_file = open(results_path, "rb") if offsets else None
+        
+        def get_cached_result(payload, response):
+            if response["id"] in offsets:
+                result = read_record(cached_file, offsets[response["id"]])
+            elif response["id"] in parquet_results:
+                result = parquet_results[response["id"]]
+            else:
+                return None
+            return self._attach_texts(result, payload, response)
+        
+        # Step 2: Score the pending responses chunk by chunk
+        if self.batch_size > 1:
+            chunk_size = self.batch_size
+        else:
+            chunk_size = EVAL_SHARD_SIZE if self.num_workers > 1 else 1
+        
+        def iter_chunks():
+            chunk = []
+            for payload, response in kwargs['response_pairs']:
+                if "error" in response:
+                    continue
+                chunk.append((response, payload["ground_truth"], get_cached_result(payload, response)))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        
+        # The Parquet file is rewritten in full alongside the jsonlines checkpoint
+        parquet_writer = ResultsParquetWriter(
+            get_parquet_path(results_path), self.metric_keys
+        ) if self.results_format == "parquet" else None
+        is_completed = False
+        try:
+            for chunk_results, updated_results in self._score_chunks(iter_chunks()):
+                self.save_results_batch(updated_results, results_path)
+                if parquet_writer is not None:
+                    parquet_writer.write_batch(chunk_results)
+                for result in chunk_results:
+                    self.score_summary.update(result)
+                    yield result
+            is_completed = True
+        finally:
+            if cached_file is not None:
+                cached_file.close()
+            if parquet_writer is not None:
+                parquet_writer.close(commit=is_completed)
+                if is_completed and os.path.exists(results_path):
+                    os.remove(results_path)
+            self._report_metric_cache()
+    
+    def _score_chunks(self, chunks):
+        """Yields the results of each chunk of rows, in order, along with the ones that changed.
+
+        Each row is a (response, ground truth, cached result or None) triple.
+        Only the stale metric columns of a cached result are computed, and
+        scores found in the metric cache are reused. The remaining scores are
+        computed in the current process or, with `num_workers` > 1, by a
+        process pool in which each worker builds its own evaluator (and loads
+        its scorers) once. Up to `2 * num_workers` chunks are in flight.
+        """
+        executor = self.worker_pool
+        if executor is None and self.num_workers > 1:
+            executor = self._create_worker_pool()
+        max_window_size = self.num_workers * 2 if executor is not None else 0
+        window = deque()
+        
+        try:
+            for chunk in chunks:
+                prepared_chunk, shard = self._prepare_chunk(chunk)
+                if executor is not None and shard[0]:
+                    future = executor.submit(_evaluate_eval_shard, shard)
+                else:
+                    future = Future()
+                    future.set_result(self._evaluate_batch(*shard))
+                window.append((prepared_chunk, future))
+                
+                while len(window) > max_window_size:
+                    prepared_chunk, future = window.popleft()
+                    yield self._finish_chunk(prepared_chunk, future.result())
             
-        return eval_results
+            while window:
+                prepared_chunk, future = window.popleft()
+                yield self._finish_chunk(prepared_chunk, future.result())
+        finally:
+            for _, future in window:
+                future.cancel()
+            if executor is not None and executor is not self.worker_pool:
+                executor.shutdown(cancel_futures=True)
+    
+    def _prepare_chunk(self, chunk):
+        """Looks up the stale scores of a chunk in the metric cache and returns the shard left to score."""
+        results = []
+        stale_columns = []
+        for response, ground_truth, cached_result in chunk:
+            if cached_result is None:
+                results.append({
+                    "id": response["id"],
+                    "generated_response": response["generated_response"],
+                    "ground_truth": ground_truth,
+                })
+                stale_columns.append(list(self.METRIC_COLUMNS))
+            else:
+                results.append(dict(cached_result))
+                stale_columns.append(self._get_stale_columns(cached_result))
+        updated_indices = [index for index, columns in enumerate(stale_columns) if columns]
+        
+        # Reuse the scores of identical (metric, prediction, reference) triples
+        cache_keys = {}
+        if self.metric_cache is not None:
+            for index in updated_indices:
+                for column in stale_columns[index]:
+                    cache_keys[index, column] = self._get_metric_cache_key(column, results[index])
+            cached_scores = self.metric_cache.get_many(list(cache_keys.values()))
+            for (index, column), cache_key in cache_keys.items():
+                if cache_key in cached_scores:
+                    results[index][column] = cached_scores[cache_key]
+                    stale_columns[index].remove(column)
+        
+        scored_indices = [index for index, columns in enumerate(stale_columns) if columns]
+        columns = [column for column in self.METRIC_COLUMNS if any(column in stale_columns[index] for index in scored_indices)]
+        shard = (
+            [chunk[index][0] for index in scored_indices],
+            [chunk[index][1] for index in scored_indices],
+            columns,
+        )
+        return (results, updated_indices, scored_indices, columns, cache_keys), shard
+    
+    def _finish_chunk(self, prepared_chunk, scores):
+        """Merges the computed scores into the results of a chunk and stores them in the metric cache."""
+        results, updated_indices, scored_indices, columns, cache_keys = prepared_chunk
+        
+        new_scores = []
+        for index, row_scores in zip(scored_indices, scores):
+            for column in columns:
+                results[index][column] = row_scores[column]
+                if (index, column) in cache_keys:
+                    new_scores.append((cache_keys[index, column], row_scores[column]))
+        if new_scores:
+            self.metric_cache.put_many(new_scores)
+        
+        for index in updated_indices:
+            results[index] = self._build_result(results[index])
+        return results, [results[index] for index in updated_indices]
+    
+    def _build_result(self, result):
+        """Returns the result with its fields in canonical order and the current metric keys."""
+        return {
+            "id": result["id"],
+            "generated_response": result["generated_response"],
+            "ground_truth": result["ground_truth"],
+            **{column: result[column] for column in self.METRIC_COLUMNS},
+            **{key: value for key, value in result.items() if key not in self.METRIC_COLUMNS},
+            "metric_keys": self.metric_keys,
+        }
+    
+    def _get_stale_columns(self, result):
+        """Returns the score columns of a cached result that are missing or were computed with another config.
+
+        Results written before metric keys were recorded are assumed to match
+        the current config.
+        """
+        metric_keys = result.get("metric_keys", self.metric_keys)
+        return [
+            column for column, metric_key in self.metric_keys.items()
+            if column not in result or metric_keys.get(column) != metric_key
+        ]
+    
+    def _get_metric_cache_key(self, column, result):
+        metric_name, metric_config = self.metric_configs[column]
+        return get_cache_key(
+            metric_name,
+            metric_config,
+            hashlib.sha1(result["generated_response"].encode("utf-8")).hexdigest(),
+            hashlib.sha1(result["ground_truth"].encode("utf-8")).hexdigest(),
+        )
+    
+    def _report_metric_cache(self):
+        if self.metric_cache is not None:
+            print(f"- Metric cache: {self.metric_cache.num_hits} hits, {self.metric_cache.num_misses} misses")
+    
+    def _evaluate_batch(self, responses, ground_truths, columns):
+        """Computes the requested score columns of a batch of responses.
+
+        The `builtin` metric backend scores the batch with the kernels of
+        `lib.metrics`, whose per-row scores are identical to those of the
+        `evaluate` scorers. The `evaluate` backend scores each row with the
+        `evaluate` scorers, loaded on first use.
+
+        Returns:
+            list: The dict of scores of each response, keyed by column.
+        """
+        generated_responses = [response["generated_response"] for response in responses]
+        if self.metric_backend == "builtin":
+            scores = compute_scores(generated_responses, ground_truths, self.bleu_n, columns)
+        else:
+            if self.bleu_scorer is None:
+                self._load_scorers()
+            scores = {column: [] for column in columns}
+            for generated_response, ground_truth in zip(generated_responses, ground_truths):
+                if "bleu_4_score" in scores:
+                    bleu_score = self.bleu_scorer.compute(predictions=[generated_response], references=[[ground_truth]], max_order=self.bleu_n)
+                    scores["bleu_4_score"].append(bleu_score['bleu'])
+                if "cer_score" in scores:
+                    cer_score = self.cer_scorer.compute(predictions=[generated_response], references=[ground_truth])
+                    scores["cer_score"].append(cer_score)
+                if "rouge_l_score" in scores:
+                    rouge_scores = self.rouge_scorer.compute(predictions=[generated_response], references=[ground_truth])
+                    scores["rouge_l_score"].append(rouge_scores['rougeL'])
+        
+        return [
+            {column: scores[column][index] for column in columns}
+            for index in range(len(responses))
+        ]
             
     def save_results(self, eval_result, results_path):
         os.makedirs(os.path.dirname(results_path), exist_ok=True)
         with jsonlines.open(results_path, mode="a") as writer:
             writer.write(eval_result)
+    
+    def save_results_batch(self, eval_results, results_path):
+        if not eval_results:
+            return
+        os.makedirs(os.path.dirname(results_path), exist_ok=True)
+        with jsonlines.open(results_path, mode="a") as writer:
+            writer.write_all(eval_results)
             
-    def load_cached_results(self, results_path):
+    def load_cached_results(self, results_path, input_payloads, response_list):
+        """Returns the cached evaluation results that are still valid, keyed by payload id.
+
+        A cached result is dropped if its response or ground truth no longer
+        matches the one it was scored against. Results with stale metric
+        columns are kept, so that only those columns are re-scored.
+        """
         print(f"Checking for cached evaluation results...")
         
-        if os.path.exists(results_path):
-            print(f"Evaluation results already exists at '{results_path}'.")
-            eval_results = []
-            with jsonlines.open(results_path, mode="r") as reader:
-                for result in reader:
-                    eval_results.append(result)
-            return eval_results
+        parquet_path = get_parquet_path(results_path)
+        has_parquet = self.results_format == "parquet" and os.path.exists(parquet_path)
+        if os.path.exists(results_path) or has_parquet:
+            # The jsonlines checkpoint holds the results newer than the Parquet file
+            cached_results = {}
+            if has_parquet:
+                print(f"Evaluation results already exists at '{parquet_path}'.")
+                cached_results.update(read_results_parquet(parquet_path))
+            jsonl_results, num_lines = {}, 0
+            if os.path.exists(results_path):
+                print(f"Evaluation results already exists at '{results_path}'.")
+                jsonl_results, num_lines = load_keyed_records(results_path)
+                cached_results.update(jsonl_results)
+            
+            payload_map = get_payload_map(input_payloads)
+            result_map = {}
+            for response in response_list:
+                result = cached_results.get(response["id"])
+                if result is not None:
+                    result = self._attach_texts(result, payload_map[response["id"]], response)
+                if result is not None:
+                    result_map[response["id"]] = result
+            
+            # Drop stale or truncated lines before appending new results
+            checkpoint_results = [result for id, result in result_map.items() if id in jsonl_results]
+            if num_lines != len(checkpoint_results):
+                save_records(checkpoint_results, results_path)
+            return result_map
         else:
             print(f"No cached evaluation results found.")
-            return []
+            return {}
+    
+    def _attach_texts(self, result, payload, response):
+        """Returns the cached result with its texts if it was scored against this response and ground truth, else None.
+
+        Results read from Parquet only store a hash of their texts, which are
+        restored from the response and payload.
+        """
+        if "text_hash" in result:
+            if result["text_hash"] != get_text_hash(response["generated_response"], payload["ground_truth"]):
+                return None
+            result = {key: value for key, value in result.items() if key != "text_hash"}
+            result["generated_response"] = response["generated_response"]
+            result["ground_truth"] = payload["ground_truth"]
+            return result
+        
+        if result["generated_response"] != response["generated_response"]:
+            return None
+        if result["ground_truth"] != payload["ground_truth"]:
+            return None
+        return result
+    
+    def _remove_results(self, results_path):
+        for path in (results_path, get_parquet_path(results_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+_eval_worker = None
+
+
+def _init_eval_worker(batch_size, bleu_n, metric_backend):
+    """Builds the evaluator of an evaluation worker process, once per process."""
+    global _eval_worker
+    _eval_worker = ReferenceBasedResponseEvaluator(batch_size, metric_backend=metric_backend)
+    _eval_worker.bleu_n = bleu_n
+    if metric_backend == "evaluate":
+        _eval_worker._load_scorers()
+
+
+def _evaluate_eval_shard(shard):
+    responses, ground_truths, columns = shard
+    return _eval_worker._evaluate_batch(responses, ground_truths, columns)
 
 
 class ResponseEvaluatorFactory:
@@ -101,11 +519,11 @@ class ResponseEvaluatorFactory:
     A factory class to specify evaluator based on the type of evaluation.
     """
     @staticmethod
-    def get_evaluator(eval_type):
+    def get_evaluator(eval_type, batch_size=1, num_workers=1, metric_cache=None, results_format="jsonl", metric_backend="builtin"):
         """
         Return an evaluator based on the specified evaluation type.
         """
         if eval_type == "reference_based":
-            return ReferenceBasedResponseEvaluator()
+            return ReferenceBasedResponseEvaluator(batch_size, num_workers, metric_cache, results_format, metric_backend)
         else:
             raise ValueError(f"Unsupported evaluation type: {eval_type}.")
\ No newline at end of file
@@ -0,0 +1,207 @@
+import os
+import json
+import hashlib
+import argparse
+
+from lib.utils import load_keyed_records, save_records
+from lib.payload_store import PayloadStore
+
+SCORE_COLUMNS = ["bleu_4_score", "cer_score", "rouge_l_score"]
+
+
+def get_result_schema():
+    """Returns the Arrow schema of the results files.
+
+    The texts are not stored: they are referenced by payload id and checked
+    through their hash. `pyarrow` is imported here, so that runs storing
+    their results as jsonl do not load it.
+    """
+    import pyarrow as pa
+    
+    return pa.schema(
+        [("id", pa.int64()), ("text_hash", pa.string())]
+        + [(column, pa.float32()) for column in SCORE_COLUMNS]
+    )
+
+
+def get_parquet_path(results_path):
+    """Returns the Parquet counterpart of a `.eval_results.jsonl` file path."""
+    return os.path.splitext(results_path)[0] + ".parquet"
+
+
+def get_text_hash(generated_response, ground_truth):
+    """Returns the hash of the (response, ground truth) pair an evaluation result was scored against."""
+    content = json.dumps([generated_response, ground_truth], ensure_ascii=False)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class ResultsParquetWriter:
+    """
+    Writes evaluation results to a Parquet file in batches, with float32 score columns.
+
+    The rows are written to a temporary file that replaces the target on
+    `close()`, so an interrupted run never leaves a partial results file.
+    """
+    def __init__(self, parquet_path, metric_keys=None):
+        self.parquet_path = parquet_path
+        self.tmp_path = f"{parquet_path}.tmp"
+        metadata = {"metric_keys": json.dumps(metric_keys)} if metric_keys else None
+        import pyarrow.parquet as pq
+        
+        os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+        self.writer = pq.ParquetWriter(self.tmp_path, get_result_schema().with_metadata(metadata))
+
+    def write_batch(self, eval_results):
+        import pyarrow as pa
+        
+        if not eval_results:
+            return
+        columns = {
+            "id": [result["id"] for result in eval_results],
+            "text_hash": [
+                result.get("text_hash") or get_text_hash(result["generated_response"], result["ground_truth"])
+                for result in eval_results
+            ],
+        }
+        for column in SCORE_COLUMNS:
+            columns[column] = [result[column] for result in eval_results]
+        self.writer.write_table(pa.Table.from_pydict(columns, schema=self.writer.schema))
+
+    def close(self, commit=True):
+        self.writer.close()
+        if commit:
+            os.replace(self.tmp_path, self.parquet_path)
+        else:
+            os.remove(self.tmp_path)
+
+
+def write_results_parquet(eval_results, parquet_path, metric_keys=None):
+    writer = ResultsParquetWriter(parquet_path, metric_keys)
+    writer.write_batch(eval_results)
+    writer.close()
+
+
+def read_results_parquet(parquet_path):
+    """Reads the evaluation results of a Parquet file, keyed by payload id.
+
+    Returns:
+        dict: The results keyed by id. Each has a `text_hash` instead of the
+        texts, and the `metric_keys` stored in the file metadata, if any.
+    """
+    import pyarrow.parquet as pq
+    
+    table = pq.read_table(parquet_path)
+    metadata = table.schema.metadata or {}
+    metric_keys = json.loads(metadata[b"metric_keys"]) if b"metric_keys" in metadata else None
+
+    results = {}
+    for result in table.to_pylist():
+        if metric_keys is not None:
+            result["metric_keys"] = metric_keys
+        results[result["id"]] = result
+    return results
+
+
+def convert_jsonl_to_parquet(jsonl_path, parquet_path, batch_size=10000):
+    """Converts a `.eval_results.jsonl` file to Parquet, streaming it in batches."""
+    metric_keys = None
+    writer = None
+    batch = []
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f):
+            result = json.loads(line)
+            result.setdefault("id", line_number)
+            if writer is None:
+                writer = ResultsParquetWriter(parquet_path, result.get("metric_keys"))
+            batch.append(result)
+            if len(batch) == batch_size:
+                writer.write_batch(batch)
+                batch = []
+    if writer is None:
+        writer = ResultsParquetWriter(parquet_path, metric_keys)
+    writer.write_batch(batch)
+    writer.close()
+
+
+def convert_parquet_to_jsonl(parquet_path, jsonl_path, payload_path, response_path):
+    """Converts a Parquet results file back to `.eval_results.jsonl`.
+
+    The texts are restored from the payload store and response file by payload id.
+    """
+    payloads = PayloadStore(payload_path)
+    responses, _ = load_keyed_records(response_path)
+
+    eval_results = []
+    for result in read_results_parquet(parquet_path).values():
+        generated_response = responses[result["id"]]["generated_response"]
+        ground_truth = payloads[result["id"]]["ground_truth"]
+        if get_text_hash(generated_response, ground_truth) != result.pop("text_hash"):
+            raise ValueError(f"The texts of payload {result['id']} no longer match the evaluation result.")
+        eval_results.append({
+            "id": result["id"],
+            "generated_response": generated_response,
+            "ground_truth": ground_truth,
+            **{key: value for key, value in result.items() if key != "id"},
+        })
+    save_records(eval_results, jsonl_path)
+
+
+def get_parquet_eval_summary(parquet_path, results_path=None):
+    """Computes the evaluation summary of a Parquet results file with vectorized aggregates.
+
+    Only the score columns are read from disk.
+    """
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    
+    table = pq.read_table(parquet_path, columns=SCORE_COLUMNS)
+    eval_summary = {
+        "num_responses": table.num_rows,
+        "avg_bleu": round(pc.mean(table["bleu_4_score"]).as_py(), 4),
+        "avg_cer": round(pc.mean(table["cer_score"]).as_py(), 4),
+        "avg_rouge": round(pc.mean(table["rouge_l_score"]).as_py(), 4),
+    }
+
+    if results_path is not None:
+        with open(results_path, "w") as f:
+            json.dump(eval_summary, f)
+
+    return eval_summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert and summarize evaluation results files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    to_parquet = subparsers.add_parser("to_parquet", help="Convert .eval_results.jsonl files to Parquet")
+    to_parquet.add_argument("results_paths", nargs="+")
+
+    to_jsonl = subparsers.add_parser("to_jsonl", help="Convert a Parquet results file back to .eval_results.jsonl")
+    to_jsonl.add_argument("parquet_path")
+    to_jsonl.add_argument("--payload_path", required=True)
+    to_jsonl.add_argument("--response_path", required=True)
+
+    summarize = subparsers.add_parser("summarize", help="Compare the summaries of Parquet results files")
+    summarize.add_argument("parquet_paths", nargs="+")
+
+    args = parser.parse_args()
+    if args.command == "to_parquet":
+        for results_path in args.results_paths:
+            convert_jsonl_to_parquet(results_path, get_parquet_path(results_path))
+            print(f"Converted '{results_path}' to '{get_parquet_path(results_path)}'.")
+    elif args.command == "to_jsonl":
+        jsonl_path = os.path.splitext(args.parquet_path)[0] + ".jsonl"
+        convert_parquet_to_jsonl(args.parquet_path, jsonl_path, args.payload_path, args.response_path)
+        print(f"Converted '{args.parquet_path}' to '{jsonl_path}'.")
+    else:
+        print(f"| {'Run':<48} | {'N':>6} | {'BLEU':>6} | {'CER':>6} | {'ROUGE':>6} |")
+        print(f"| {'-' * 48} | {'-' * 6} | {'-' * 6} | {'-' * 6} | {'-' * 6} |")
+        for parquet_path in args.parquet_paths:
+            eval_summary = get_parquet_eval_summary(parquet_path)
+            run_name = os.path.basename(parquet_path).replace(".eval_results.parquet", "")
+            print(f"| {run_name:<48} | {eval_summary['num_responses']:>6} | {eval_summary['avg_bleu']:>6.4f} "
+                  f"| {eval_summary['avg_cer']:>6.4f} | {eval_summary['avg_rouge']:>6.4f} |")
+
+
+if __name__ == "__main__":
+    main()
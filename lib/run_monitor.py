@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds of the window of the recent completion rate
+RATE_WINDOW_SECONDS = 60
+
+# Seconds between two checks of the current stage, to log stage changes soon after they happen
+STAGE_POLL_INTERVAL = 0.5
+
+SCORE_NAMES = {"bleu": "avg_bleu", "cer": "avg_cer", "rouge": "avg_rouge"}
+
+# Prometheus metrics of a snapshot: (metric name, type, help, snapshot key)
+PROMETHEUS_METRICS = [
+    ("eval_elapsed_seconds", "gauge", "Seconds since the run started", "elapsed"),
+    ("eval_stage_done", "gauge", "Rows done in the current stage", "done"),
+    ("eval_stage_total", "gauge", "Rows of the current stage", "total"),
+    ("eval_eta_seconds", "gauge", "Estimated seconds left in the current stage", "eta_seconds"),
+    ("eval_requests_in_flight", "gauge", "API requests waiting for a response", "in_flight"),
+    ("eval_completion_rate", "gauge", "Completed responses per second over the last minute", "completion_rate"),
+    ("eval_completed_responses_total", "counter", "Responses fetched by this run", "num_completed"),
+    ("eval_failed_responses_total", "counter", "Responses that failed after their retries", "num_failed"),
+    ("eval_requests_total", "counter", "API requests sent, including retries", "num_requests"),
+    ("eval_retries_total", "counter", "Retried API requests", "num_retries"),
+    ("eval_rate_limited_total", "counter", "API requests rejected by a rate limit", "num_rate_limited"),
+    ("eval_throttled_total", "counter", "API requests delayed by the client-side rate limiter", "num_throttled"),
+]
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_prometheus(snapshot):
+    """Returns a snapshot in the Prometheus text exposition format, labeled with its run (and stage)."""
+    labels = f'run="{_escape_label(snapshot["run"])}"'
+    lines = []
+    for name, metric_type, description, key in PROMETHEUS_METRICS:
+        if snapshot.get(key) is None:
+            continue
+        metric_labels = labels
+        if key in ("done", "total"):
+            metric_labels += f',stage="{_escape_label(snapshot["stage"])}"'
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name}{{{metric_labels}}} {snapshot[key]}")
+    if snapshot.get("scores"):
+        lines.append(f"# HELP eval_score_mean Running mean of each metric over the scored responses")
+        lines.append(f"# TYPE eval_score_mean gauge")
+        for metric, value in snapshot["scores"].items():
+            lines.append(f'eval_score_mean{{{labels},metric="{metric}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+class RunMonitor:
+    """
+    Publishes the progress of a run while it runs, as a JSON-lines event log and/or a Prometheus `/metrics` endpoint.
+
+    The monitor polls the objects it watches, so the stages need no
+    callbacks: the current stage of the stage timer, the request counters of
+    the API executor and the running score means of the evaluator. A
+    `progress` snapshot is appended to the event log every `interval` seconds,
+    along with a `stage` event on each stage change and `start`/`end` events,
+    and the endpoint serves a fresh snapshot on each scrape.
+    """
+    def __init__(self, run_name, event_log_path=None, metrics_port=None, interval=10, config=None):
+        self.run_name = run_name
+        self.event_log_path = event_log_path
+        self.metrics_port = metrics_port
+        self.interval = interval
+        self.config = config or {}
+        self.stage_timer = None
+        self.api_executor = None
+        self.evaluator = None
+        self.num_rows = None
+
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._stage = None
+        self._stage_start = (self.start_time, None)
+        self._completion_samples = deque()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._server = None
+        self._event_log = None
+
+    def watch(self, stage_timer=None, api_executor=None, evaluator=None, num_rows=None):
+        """Sets the objects of the run to poll, as they are created."""
+        if stage_timer is not None:
+            self.stage_timer = stage_timer
+        if api_executor is not None:
+            self.api_executor = api_executor
+        if evaluator is not None:
+            self.evaluator = evaluator
+        if num_rows is not None:
+            self.num_rows = num_rows
+
+    def start(self):
+        print(f"[[Run Monitor]]")
+        if self.event_log_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.event_log_path)), exist_ok=True)
+            self._event_log = open(self.event_log_path, "a", encoding="utf-8")
+            self._write_event({"event": "start", "pid": os.getpid(), "config": self.config})
+            print(f"- Event log: '{self.event_log_path}' (every {self.interval:g}s)")
+        if self.metrics_port is not None:
+            self._server = ThreadingHTTPServer(("127.0.0.1", self.metrics_port), _get_metrics_handler(self))
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            print(f"- Metrics endpoint: http://127.0.0.1:{self._server.server_address[1]}/metrics")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self, eval_summary=None):
+        """Stops the monitor and logs the `end` event, with the evaluation summary of a completed run."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._event_log is not None:
+            self._write_event(self.get_snapshot())
+            self._write_event({
+                "event": "end",
+                "status": "completed" if eval_summary is not None else "failed",
+                "summary": eval_summary,
+            })
+            self._event_log.close()
+            self._event_log = None
+
+    def get_snapshot(self):
+        """Returns the current progress of the run."""
+        with self._lock:
+            now = time.time()
+            stage = self.stage_timer.current_stage if self.stage_timer is not None else None
+            done, total = self._get_progress(stage)
+            if stage != self._stage:
+                self._stage = stage
+                self._stage_start = (now, done)
+
+            snapshot = {
+                "event": "progress",
+                "stage": stage,
+                "done": done,
+                "total": total,
+                "eta_seconds": self._get_eta(now, done, total),
+            }
+            if self.api_executor is not None:
+                request_stats = self.api_executor.request_stats
+                num_completed = self.api_executor.num_saved_responses - self.api_executor.num_failed_responses
+                snapshot.update(
+                    in_flight=self.api_executor.num_in_flight,
+                    completion_rate=self._get_completion_rate(now, num_completed),
+                    num_completed=num_completed,
+                    num_failed=self.api_executor.num_failed_responses,
+                    num_requests=request_stats["num_requests"],
+                    num_retries=request_stats["num_retries"],
+                    num_rate_limited=request_stats["num_rate_limited"],
+                    num_throttled=request_stats["num_throttled"],
+                )
+            if self.evaluator is not None and self.evaluator.score_summary.num_responses > 0:
+                eval_summary = self.evaluator.score_summary.get_summary()
+                snapshot["scores"] = {name: eval_summary[key] for name, key in SCORE_NAMES.items()}
+            return {"time": round(now, 3), "run": self.run_name, "elapsed": round(now - self.start_time, 1), **snapshot}
+
+    def _get_progress(self, stage):
+        """Returns the (done, total) rows of the stage, or (None, None) for a stage without progress."""
+        if stage == "fetch" and self.api_executor is not None:
+            return self.api_executor.num_responses + self.api_executor.num_saved_responses, self.api_executor.num_payloads
+        if stage == "evaluate" and self.evaluator is not None:
+            return self.evaluator.score_summary.num_responses, self.evaluator.num_responses
+        if stage == "pipeline" and self.evaluator is not None:
+            # Failed responses go through the pipeline without a score
+            num_failed = self.api_executor.num_failed_responses if self.api_executor is not None else 0
+            return self.evaluator.score_summary.num_responses + num_failed, self.num_rows
+        return None, None
+
+    def _get_eta(self, now, done, total):
+        """Extrapolates the rate of the stage since it started (cached rows, done at once, are not counted)."""
+        start_time, start_done = self._stage_start
+        if done is None or not total or start_done is None or done <= start_done or now <= start_time:
+            return None
+        return round((total - done) * (now - start_time) / (done - start_done), 1)
+
+    def _get_completion_rate(self, now, num_completed):
+        self._completion_samples.append((now, num_completed))
+        while len(self._completion_samples) > 2 and self._completion_samples[1][0] <= now - RATE_WINDOW_SECONDS:
+            self._completion_samples.popleft()
+        start_time, start_completed = self._completion_samples[0]
+        if now <= start_time:
+            return 0.0
+        return round((num_completed - start_completed) / (now - start_time), 3)
+
+    def _run(self):
+        next_time = time.time() + self.interval
+        # Scrapes of the endpoint also take snapshots, so the stage changes are tracked apart from them
+        logged_stage = None
+        while not self._stop_event.wait(min(STAGE_POLL_INTERVAL, self.interval)):
+            stage = self.stage_timer.current_stage if self.stage_timer is not None else None
+            if stage != logged_stage:
+                logged_stage = stage
+                # Starts the ETA of the new stage from its first rows, unless a scrape already did
+                snapshot = self.get_snapshot()
+                if self._event_log is not None and stage is not None:
+                    self._write_event({"time": snapshot["time"], "run": self.run_name, "event": "stage", "stage": stage})
+            if time.time() >= next_time:
+                next_time += self.interval
+                if self._event_log is not None:
+                    self._write_event(self.get_snapshot())
+
+    def _write_event(self, event):
+        if "time" not in event:
+            event = {"time": round(time.time(), 3), "run": self.run_name, **event}
+        self._event_log.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self._event_log.flush()
+
+
+def _get_metrics_handler(monitor):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = format_prometheus(monitor.get_snapshot()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
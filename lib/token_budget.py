@@ -0,0 +1,151 @@
+import math
+
+# Characters per token of the approximate tokenizer (the usual rule of thumb for English BPE vocabularies)
+APPROX_CHARS_PER_TOKEN = 4
+
+# Tokens added by the chat format around each message (role and separators)
+TOKENS_PER_MESSAGE = 4
+
+
+class ApproximateTokenizer:
+    """
+    Counts one token per 4 characters, for any model and without a tokenizer download.
+    """
+    name = "approx"
+
+    def count(self, texts):
+        return [math.ceil(len(text) / APPROX_CHARS_PER_TOKEN) for text in texts]
+
+    def truncate(self, text, max_tokens):
+        max_length = max_tokens * APPROX_CHARS_PER_TOKEN
+        if len(text) <= max_length:
+            return text
+        # Cut at the last whitespace so that the last word is not split
+        text = text[:max_length]
+        space = text.rfind(" ")
+        return text[:space] if space > max_length // 2 else text
+
+
+class TiktokenTokenizer:
+    """
+    Counts the tokens of a `tiktoken` encoding (e.g. `o200k_base` for the GPT-4o models).
+    """
+    def __init__(self, encoding_name):
+        try:
+            import tiktoken
+        except ImportError:
+            raise ImportError("The `tiktoken` tokenizers require `pip install tiktoken`.")
+        self.name = f"tiktoken:{encoding_name}"
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, texts):
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts)]
+
+    def truncate(self, text, max_tokens):
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) <= max_tokens:
+            return text
+        # A cut in the middle of a multi-byte character drops the partial character
+        return self.encoding.decode_bytes(tokens[:max_tokens]).decode("utf-8", errors="ignore")
+
+
+class HuggingFaceTokenizer:
+    """
+    Counts the tokens of a Hugging Face tokenizer (e.g. the tokenizer of the model served by Ollama).
+    """
+    def __init__(self, tokenizer_name):
+        from transformers import AutoTokenizer
+
+        self.name = tokenizer_name
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+
+    def count(self, texts):
+        return [len(input_ids) for input_ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def truncate(self, text, max_tokens):
+        encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        if len(encoding["input_ids"]) <= max_tokens:
+            return text
+        if max_tokens == 0:
+            return ""
+        return text[:encoding["offset_mapping"][max_tokens - 1][1]]
+
+
+def get_tokenizer(tokenizer_name="approx"):
+    """Returns a tokenizer by name: `approx`, `tiktoken:<encoding>` or a Hugging Face tokenizer name."""
+    if tokenizer_name == "approx":
+        return ApproximateTokenizer()
+    if tokenizer_name.startswith("tiktoken:"):
+        return TiktokenTokenizer(tokenizer_name.split(":", 1)[1])
+    return HuggingFaceTokenizer(tokenizer_name)
+
+
+class PromptBudget:
+    """
+    Counts the input tokens of the payloads of a message template, and fits them into a budget.
+
+    The system prompt and the fixed text of the template are counted once.
+    Each payload then only counts its template fields, and a payload over
+    `max_input_tokens` has its longest fields truncated until it fits the
+    budget, starting with the longest one.
+    """
+    def __init__(self, tokenizer, messages, max_input_tokens=None):
+        self.tokenizer = tokenizer
+        self.max_input_tokens = max_input_tokens
+        fixed_texts = [
+            message["content"] if "content" in message else message["template"].format_map(_EmptyFields())
+            for message in messages
+        ]
+        self.num_fixed_tokens = sum(tokenizer.count(fixed_texts)) + TOKENS_PER_MESSAGE * len(messages)
+        if max_input_tokens is not None and self.num_fixed_tokens >= max_input_tokens:
+            raise ValueError(
+                f"The system prompt and template alone take {self.num_fixed_tokens} tokens, "
+                f"over the budget of {max_input_tokens} input tokens."
+            )
+
+    def fit(self, field_columns):
+        """Fits a batch of payloads into the budget.
+
+        Args:
+            field_columns (dict): The template field columns of the batch.
+
+        Returns:
+            tuple: The (possibly truncated) field columns, and the input
+            tokens and truncated tokens of each payload.
+        """
+        field_columns = {field: list(column) for field, column in field_columns.items()}
+        token_columns = {field: self.tokenizer.count(column) for field, column in field_columns.items()}
+        num_rows = len(next(iter(field_columns.values()), []))
+        num_input_tokens = [self.num_fixed_tokens] * num_rows
+        num_truncated_tokens = [0] * num_rows
+        for index in range(num_rows):
+            num_input_tokens[index] += sum(tokens[index] for tokens in token_columns.values())
+            if self.max_input_tokens is None or num_input_tokens[index] <= self.max_input_tokens:
+                continue
+
+            # The next longest field is truncated too when the overflow is longer than a field
+            for field in sorted(token_columns, key=lambda field: token_columns[field][index], reverse=True):
+                num_overflow_tokens = num_input_tokens[index] - self.max_input_tokens
+                if num_overflow_tokens <= 0:
+                    break
+                num_field_tokens = token_columns[field][index]
+                text, num_tokens = self._truncate(field_columns[field][index], max(0, num_field_tokens - num_overflow_tokens))
+                field_columns[field][index] = text
+                num_input_tokens[index] -= num_field_tokens - num_tokens
+                num_truncated_tokens[index] += num_field_tokens - num_tokens
+        return field_columns, num_input_tokens, num_truncated_tokens
+
+    def _truncate(self, text, max_tokens):
+        """Returns the text truncated to `max_tokens` tokens, and its number of tokens."""
+        while True:
+            truncated_text = self.tokenizer.truncate(text, max_tokens)
+            num_tokens = self.tokenizer.count([truncated_text])[0]
+            if num_tokens <= max_tokens:
+                return truncated_text, num_tokens
+            # Tokens merged across the cut may count more tokens than the cut, so cut them off too
+            max_tokens = max(0, max_tokens - (num_tokens - max_tokens))
+
+
+class _EmptyFields(dict):
+    def __missing__(self, key):
+        return ""
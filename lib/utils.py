@@ -1,4 +1,166 @@
+import os
 import json
+import hashlib
+import argparse
+
+
+def str2bool(value):
+    """Parses a boolean command-line value such as 'True', 'false', '1' or 'no'."""
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ("true", "t", "yes", "y", "1"):
+        return True
+    if value.lower() in ("false", "f", "no", "n", "0"):
+        return False
+    raise argparse.ArgumentTypeError(f"Boolean value expected, got '{value}'.")
+
+
+def parse_shard(value):
+    """Parses a shard such as '0/4' (the first of 4 shards) into a (shard index, number of shards) tuple."""
+    try:
+        index, num_shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard expected as 'index/num_shards', got '{value}'.")
+    if not 0 <= index < num_shards:
+        raise argparse.ArgumentTypeError(f"Shard index must be in [0, {num_shards}), got {index}.")
+    return index, num_shards
+
+
+def get_payload_hash(payload):
+    """Returns a content hash of the fields that determine the API response.
+
+    Args:
+        payload (dict): The API request payload.
+
+    Returns:
+        str: The SHA-1 hex digest of the messages and temperature.
+    """
+    content = json.dumps(
+        {"messages": payload["messages"], "temperature": payload["temperature"]},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def load_keyed_records(records_path):
+    """Loads the jsonlines records keyed by their payload id.
+
+    Records appended later override earlier ones with the same id, so retried
+    payloads simply append a new line. Records written before payload ids were
+    introduced are keyed by their line number. A truncated line left behind by
+    an interrupted write is skipped.
+
+    Args:
+        records_path (str): The file path to the jsonlines records.
+
+    Returns:
+        tuple: The dict of records keyed by id and the number of lines read.
+    """
+    records = {}
+    num_lines = 0
+    with open(records_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f):
+            num_lines += 1
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed record at line {line_number + 1} of '{records_path}'.")
+                continue
+            record.setdefault("id", line_number)
+            records[record["id"]] = record
+    return records, num_lines
+
+
+def index_keyed_records(records_path):
+    """Indexes the jsonlines records by payload id without keeping them in memory.
+
+    Follows the same rules as `load_keyed_records`, but only the byte offset
+    of the latest line of each id is kept. Use `read_record` to fetch it.
+
+    Args:
+        records_path (str): The file path to the jsonlines records.
+
+    Returns:
+        tuple: The dict of byte offsets keyed by id and the number of lines read.
+    """
+    offsets = {}
+    num_lines = 0
+    with open(records_path, "rb") as f:
+        offset = f.tell()
+        for line_number, line in enumerate(iter(f.readline, b"")):
+            num_lines += 1
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed record at line {line_number + 1} of '{records_path}'.")
+            else:
+                offsets[record.get("id", line_number)] = offset
+            offset = f.tell()
+    return offsets, num_lines
+
+
+def read_record(records_file, offset):
+    """Reads the record at the specified byte offset of an open jsonlines file."""
+    records_file.seek(offset)
+    return json.loads(records_file.readline())
+
+
+def ensure_trailing_newline(records_path):
+    """Terminates a truncated last line so that new records start on their own line."""
+    with open(records_path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def save_records(records, records_path):
+    """Atomically rewrites the jsonlines records to the specified file path.
+
+    Args:
+        records (list): The records to write, in order.
+        records_path (str): The file path to the jsonlines records.
+    """
+    os.makedirs(os.path.dirname(records_path), exist_ok=True)
+    tmp_path = f"{records_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, records_path)
+
+
+class EvalSummaryAccumulator:
+    """
+    Accumulates the evaluation summary one result at a time.
+    """
+    def __init__(self):
+        self.num_responses = 0
+        self.sum_bleu = 0.0
+        self.sum_cer = 0.0
+        self.sum_rouge = 0.0
+    
+    def update(self, result):
+        self.num_responses += 1
+        self.sum_bleu += result['bleu_4_score']
+        self.sum_cer += result['cer_score']
+        self.sum_rouge += result['rouge_l_score']
+    
+    def get_summary(self):
+        return {
+            "num_responses": self.num_responses,
+            "avg_bleu": round(self.sum_bleu / self.num_responses, 4),
+            "avg_cer": round(self.sum_cer / self.num_responses, 4),
+            "avg_rouge": round(self.sum_rouge / self.num_responses, 4),
+        }
+    
+    def save_summary(self, results_path):
+        eval_summary = self.get_summary()
+        with open(results_path, "w") as f:
+            json.dump(eval_summary, f)
+        return eval_summary
 
 
 def get_eval_summary(eval_results, results_path):
@@ -17,4 +179,16 @@ def get_eval_summary(eval_results, results_path):
         json.dump(eval_summary, f)
     
     return eval_summary
-    
\ No newline at end of file
+
+
+def update_eval_summary(results_path, **fields):
+    """Adds the given fields to a saved evaluation summary and returns it."""
+    with open(results_path, "r") as f:
+        eval_summary = json.load(f)
+    
+    eval_summary.update(fields)
+    
+    with open(results_path, "w") as f:
+        json.dump(eval_summary, f)
+    
+    return eval_summary
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import sqlite3
+import socket
+from contextlib import contextmanager
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# Rows written per statement batch when enqueueing
+ENQUEUE_BATCH_SIZE = 1000
+
+
+def get_worker_id():
+    """Returns an id of the current process that is unique across hosts."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    A queue of payloads shared by a coordinator and its workers through a SQLite file.
+
+    The coordinator enqueues the stored row of each payload (see
+    `lib.payload_store`) under its payload id, along with the store header, so
+    a worker only needs the queue file. Workers lease a few tasks at a time;
+    a lease that is not committed within `lease_seconds` (e.g. its worker
+    died) expires and the tasks are leased again. Results are committed
+    idempotently: the first commit of a task wins, and commits for a payload
+    that was re-enqueued with another payload hash are dropped. A task that
+    fails `max_attempts` times is marked as failed until it is re-enqueued.
+
+    The file may be on a shared filesystem, as long as it supports file
+    locks: the rollback journal is used instead of WAL, which needs shared
+    memory between the processes.
+    """
+    def __init__(self, queue_path, lease_seconds=600, max_attempts=3):
+        self.queue_path = queue_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.num_reclaimed = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(queue_path)), exist_ok=True)
+        # Transactions are opened explicitly, so that leases take the write lock up front
+        self.connection = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        with self._transaction():
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "id INTEGER PRIMARY KEY, payload_hash TEXT NOT NULL, row TEXT NOT NULL, status TEXT NOT NULL, "
+                "worker_id TEXT, lease_expires_at REAL, num_attempts INTEGER NOT NULL DEFAULT 0, error TEXT)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires_at)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "id INTEGER PRIMARY KEY, payload_hash TEXT NOT NULL, response TEXT NOT NULL, eval_result TEXT NOT NULL, "
+                "worker_id TEXT NOT NULL, committed_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                "worker_id TEXT PRIMARY KEY, started_at REAL NOT NULL, last_seen REAL NOT NULL, stats TEXT NOT NULL)"
+            )
+
+    @contextmanager
+    def _transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def set_meta(self, **fields):
+        with self._transaction():
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in fields.items()],
+            )
+
+    def get_meta(self):
+        return {key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM meta")}
+
+    def enqueue(self, tasks, num_tasks=None):
+        """Adds the tasks to the queue, keeping the results of the ones whose payload is unchanged.
+
+        A task whose payload hash changed, or that failed, is queued again.
+
+        Args:
+            tasks (iterable): The (payload id, payload hash, stored row) of each payload.
+            num_tasks (int): The number of payloads; tasks of higher ids are removed.
+
+        Returns:
+            int: The number of tasks queued (again).
+        """
+        num_queued = 0
+        with self._transaction():
+            if num_tasks is not None:
+                self.connection.execute("DELETE FROM tasks WHERE id >= ?", (num_tasks,))
+                self.connection.execute("DELETE FROM results WHERE id >= ?", (num_tasks,))
+            batch = []
+            for task in tasks:
+                batch.append(task)
+                if len(batch) == ENQUEUE_BATCH_SIZE:
+                    num_queued += self._enqueue_batch(batch)
+                    batch = []
+            num_queued += self._enqueue_batch(batch)
+        return num_queued
+
+    def _enqueue_batch(self, batch):
+        if not batch:
+            return 0
+        placeholders = ",".join("?" * len(batch))
+        queued_tasks = {
+            task_id: (payload_hash, status) for task_id, payload_hash, status in self.connection.execute(
+                f"SELECT id, payload_hash, status FROM tasks WHERE id IN ({placeholders})",
+                [task_id for task_id, _, _ in batch],
+            )
+        }
+        num_queued = sum(
+            1 for task_id, payload_hash, _ in batch
+            if task_id not in queued_tasks or queued_tasks[task_id][0] != payload_hash or queued_tasks[task_id][1] == FAILED
+        )
+        self.connection.executemany(
+            "DELETE FROM results WHERE id = ? AND payload_hash != ?",
+            [(task_id, payload_hash) for task_id, payload_hash, _ in batch],
+        )
+        self.connection.executemany(
+            "INSERT INTO tasks (id, payload_hash, row, status) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET payload_hash = excluded.payload_hash, row = excluded.row, "
+            "status = excluded.status, worker_id = NULL, lease_expires_at = NULL, num_attempts = 0, error = NULL "
+            "WHERE tasks.payload_hash != excluded.payload_hash OR tasks.status = ?",
+            [(task_id, payload_hash, json.dumps(row, ensure_ascii=False), PENDING, FAILED) for task_id, payload_hash, row in batch],
+        )
+        return num_queued
+
+    def lease(self, worker_id, num_tasks):
+        """Leases up to `num_tasks` pending tasks (or tasks of expired leases) to a worker.
+
+        Returns:
+            list: The (payload id, payload hash, stored row) of each leased task.
+        """
+        with self._transaction():
+            now = time.time()
+            rows = self.connection.execute(
+                "SELECT id, payload_hash, row, status FROM tasks "
+                "WHERE status = ? OR (status = ? AND lease_expires_at < ?) ORDER BY id LIMIT ?",
+                (PENDING, LEASED, now, num_tasks),
+            ).fetchall()
+            self.num_reclaimed += sum(1 for row in rows if row[3] == LEASED)
+            self.connection.executemany(
+                "UPDATE tasks SET status = ?, worker_id = ?, lease_expires_at = ?, num_attempts = num_attempts + 1 WHERE id = ?",
+                [(LEASED, worker_id, now + self.lease_seconds, row[0]) for row in rows],
+            )
+        return [(task_id, payload_hash, json.loads(row)) for task_id, payload_hash, row, _ in rows]
+
+    def renew(self, worker_id, task_ids):
+        """Extends the leases of a worker on the tasks it is still working on."""
+        with self._transaction():
+            self.connection.executemany(
+                "UPDATE tasks SET lease_expires_at = ? WHERE id = ? AND worker_id = ? AND status = ?",
+                [(time.time() + self.lease_seconds, task_id, worker_id, LEASED) for task_id in task_ids],
+            )
+
+    def commit(self, worker_id, results):
+        """Commits the results of tasks, ignoring tasks already committed or re-enqueued since they were leased.
+
+        Args:
+            worker_id (str): The worker that computed the results.
+            results (list): The dicts of `id`, `payload_hash`, `response` and `eval_result` of each task.
+
+        Returns:
+            int: The number of results committed.
+        """
+        num_committed = 0
+        with self._transaction():
+            now = time.time()
+            for result in results:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO results (id, payload_hash, response, eval_result, worker_id, committed_at) "
+                    "SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM tasks WHERE id = ? AND payload_hash = ?)",
+                    (
+                        result["id"],
+                        result["payload_hash"],
+                        json.dumps(result["response"], ensure_ascii=False),
+                        json.dumps(result["eval_result"], ensure_ascii=False),
+                        worker_id,
+                        now,
+                        result["id"],
+                        result["payload_hash"],
+                    ),
+                )
+                num_committed += cursor.rowcount
+                self.connection.execute(
+                    "UPDATE tasks SET status = ?, lease_expires_at = NULL, error = NULL WHERE id = ? AND payload_hash = ?",
+                    (DONE, result["id"], result["payload_hash"]),
+                )
+        return num_committed
+
+    def fail(self, worker_id, failures):
+        """Returns the failed tasks of a worker to the queue, or marks them as failed after `max_attempts`.
+
+        Args:
+            failures (list): The (payload id, error message) of each failed task.
+        """
+        with self._transaction():
+            self.connection.executemany(
+                "UPDATE tasks SET status = CASE WHEN num_attempts >= ? THEN ? ELSE ? END, "
+                "worker_id = NULL, lease_expires_at = NULL, error = ? WHERE id = ? AND worker_id = ? AND status = ?",
+                [(self.max_attempts, FAILED, PENDING, error, task_id, worker_id, LEASED) for task_id, error in failures],
+            )
+
+    def release(self, worker_id):
+        """Returns the tasks still leased by a worker to the queue, without counting an attempt."""
+        with self._transaction():
+            cursor = self.connection.execute(
+                "UPDATE tasks SET status = ?, worker_id = NULL, lease_expires_at = NULL, num_attempts = num_attempts - 1 "
+                "WHERE worker_id = ? AND status = ?",
+                (PENDING, worker_id, LEASED),
+            )
+        return cursor.rowcount
+
+    def reclaim_expired(self):
+        """Returns the tasks of expired leases to the queue, and returns their number."""
+        with self._transaction():
+            cursor = self.connection.execute(
+                "UPDATE tasks SET status = ?, worker_id = NULL, lease_expires_at = NULL WHERE status = ? AND lease_expires_at < ?",
+                (PENDING, LEASED, time.time()),
+            )
+        self.num_reclaimed += cursor.rowcount
+        return cursor.rowcount
+
+    def get_counts(self):
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(self.connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return counts
+
+    def is_finished(self, counts=None):
+        """Returns whether every task is done or failed, from the `get_counts` result if given."""
+        counts = counts or self.get_counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+    def update_worker(self, worker_id, stats):
+        with self._transaction():
+            now = time.time()
+            self.connection.execute(
+                "INSERT INTO workers (worker_id, started_at, last_seen, stats) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (worker_id) DO UPDATE SET last_seen = excluded.last_seen, stats = excluded.stats",
+                (worker_id, now, now, json.dumps(stats)),
+            )
+
+    def get_workers(self):
+        return [
+            {"worker_id": worker_id, "started_at": started_at, "last_seen": last_seen, **json.loads(stats)}
+            for worker_id, started_at, last_seen, stats in self.connection.execute(
+                "SELECT worker_id, started_at, last_seen, stats FROM workers ORDER BY started_at"
+            )
+        ]
+
+    def iter_results(self):
+        """Yields the committed (response, evaluation result) of each task, in payload id order."""
+        for response, eval_result in self.connection.execute(
+            "SELECT results.response, results.eval_result FROM results "
+            "JOIN tasks ON tasks.id = results.id AND tasks.payload_hash = results.payload_hash ORDER BY results.id"
+        ):
+            yield json.loads(response), json.loads(eval_result)
+
+    def get_failed_tasks(self):
+        return self.connection.execute("SELECT id, error FROM tasks WHERE status = ? ORDER BY id", (FAILED,)).fetchall()
+
+    def close(self):
+        self.connection.close()
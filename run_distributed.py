@@ -0,0 +1,324 @@
+import os
+import time
+from tqdm import tqdm
+
+from lib.payload_creator import PayloadCreatorFactory
+from lib.payload_store import decode_payload
+from lib.api_executor import APIExecutorFactory
+from lib.response_evaluator import ResponseEvaluatorFactory
+from lib.rate_limiter import RateLimiter
+from lib.cache import SqliteCache
+from lib.result_store import get_parquet_path, write_results_parquet
+from lib.eval_stats import get_score_matrix
+from lib.perf_report import StageTimer, get_perf_report, save_perf_report, print_perf_report
+from lib.work_queue import WorkQueue, get_worker_id, DONE, FAILED
+from lib.utils import get_payload_hash, get_eval_summary, update_eval_summary, save_records
+from run_evaluation import get_parser, get_args, load_input_dataset, get_summary_stats, print_eval_summary
+
+# Fields of the run that every worker takes from the coordinator, instead of its own arguments
+RUN_FIELDS = ["model", "api_type", "stream_completions", "max_completion_tokens", "stop", "metric_backend"]
+
+
+def get_distributed_args():
+    parser = get_parser()
+    parser.add_argument("role", type=str, choices=["coordinator", "worker"], help="coordinator: queue the payloads and merge the results, worker: evaluate queued payloads")
+    parser.add_argument("--queue_path", type=str, help="Work queue shared by the coordinator and workers (default: results/{domain_type}-{task_type}-{model}.queue.sqlite)", default=None)
+    parser.add_argument("--lease_seconds", type=float, help="Time a worker has to commit its leased payloads before they are leased again", default=600)
+    parser.add_argument("--lease_size", type=int, help="Number of payloads a worker leases at a time", default=32)
+    parser.add_argument("--max_attempts", type=int, help="Max number of leases of a payload that gets no response", default=3)
+    parser.add_argument("--poll_interval", type=float, help="Seconds between two checks of the work queue", default=5)
+    parser.add_argument("--worker_id", type=str, help="Id of the worker (default: hostname-pid)", default=None)
+    return get_args(parser)
+
+
+def sum_request_stats(workers):
+    """Sums the request stats of the workers (ratios, which do not add up, are left out)."""
+    request_stats = {}
+    for worker in workers:
+        for key, value in worker["request_stats"].items():
+            if not key.endswith("_ratio"):
+                request_stats[key] = round(request_stats.get(key, 0) + value, 3)
+    return request_stats
+
+
+def run_coordinator(args, repo_path, queue_path):
+    TEST_PREFIX = f"{args.domain_type}-{args.task_type}"
+
+    input_dataset_path = f'{repo_path}/data/raw/{TEST_PREFIX}'
+    input_payload_path = f'{repo_path}/data/processed/{TEST_PREFIX}'
+    system_prompt_path = f'{repo_path}/prompts/{TEST_PREFIX}.txt'
+    output_path = f'{repo_path}/results/{TEST_PREFIX}-{args.model}.output.jsonl'
+    eval_results_path = f'{repo_path}/results/{TEST_PREFIX}-{args.model}.eval_results.jsonl'
+    eval_summary_path = f'{repo_path}/results/{TEST_PREFIX}-{args.model}.eval_summary.json'
+    perf_report_path = f'{repo_path}/results/{TEST_PREFIX}-{args.model}.perf_report.json'
+
+    # ----------------------------------------------------------------------
+    # Load the dataset and create the payloads
+    # ----------------------------------------------------------------------
+    stage_timer = StageTimer()
+    with stage_timer.stage("load"):
+        input_dataset = load_input_dataset(args, input_dataset_path)
+    with stage_timer.stage("payload"):
+        input_payloads = PayloadCreatorFactory.get_payload_creator(
+            task_type=args.task_type,
+            temperature=args.temperature,
+            system_prompt_path=system_prompt_path,
+            user_template=args.user_template,
+            ground_truth_field=args.ground_truth_field,
+            num_proc=args.payload_workers,
+            tokenizer_name=args.tokenizer,
+            max_input_tokens=args.max_input_tokens
+        ).create_payload(
+            input_dataset=input_dataset,
+            payload_path=input_payload_path,
+            reset=args.reset_payloads
+        )
+
+    # ----------------------------------------------------------------------
+    # Queue the payloads
+    # ----------------------------------------------------------------------
+    print(f"[[Queueing payloads]]")
+    # The responses are fetched and scored together, so either reset starts the queue over
+    if (args.reset_responses or args.reset_results) and os.path.exists(queue_path):
+        print(f"Removing the work queue...")
+        os.remove(queue_path)
+    header = {**input_payloads.header, "defaults": input_payloads.defaults}
+    work_queue = WorkQueue(queue_path, args.lease_seconds, args.max_attempts)
+    try:
+        # Workers only start on a queue whose run fields are set, so they are set last
+        work_queue.set_meta(ready=False)
+        num_queued = work_queue.enqueue(
+            (
+                (index, get_payload_hash(input_payloads[index]), input_payloads.get_row(index))
+                for index in range(len(input_payloads))
+            ),
+            num_tasks=len(input_payloads)
+        )
+        work_queue.set_meta(header=header, **{field: getattr(args, field) for field in RUN_FIELDS})
+        work_queue.set_meta(ready=True)
+
+        counts = work_queue.get_counts()
+        print(f"- Queue: '{queue_path}'")
+        print(f"- Num of payloads: {len(input_payloads)}")
+        print(f"- Num of queued payloads: {num_queued}")
+        print(f"- Num of committed results: {counts[DONE]}")
+
+        # ----------------------------------------------------------------------
+        # Wait for the workers, and reclaim the leases of workers that died
+        # ----------------------------------------------------------------------
+        with stage_timer.stage("distributed"):
+            with tqdm(total=len(input_payloads), initial=counts[DONE] + counts[FAILED], desc="Waiting for workers") as pbar:
+                while not work_queue.is_finished(counts):
+                    time.sleep(args.poll_interval)
+                    num_reclaimed = work_queue.reclaim_expired()
+                    if num_reclaimed > 0:
+                        tqdm.write(f"Reclaimed {num_reclaimed} payloads of expired leases.")
+                    counts = work_queue.get_counts()
+                    pbar.update(counts[DONE] + counts[FAILED] - pbar.n)
+
+        # ----------------------------------------------------------------------
+        # Merge the committed results into the files of a single-node run
+        # ----------------------------------------------------------------------
+        with stage_timer.stage("merge"):
+            print(f"[[Merging results]]")
+            response_list, eval_results = [], []
+            for response, eval_result in work_queue.iter_results():
+                response_list.append(response)
+                eval_results.append(eval_result)
+            workers = work_queue.get_workers()
+            failed_tasks = work_queue.get_failed_tasks()
+
+            print(f"- Num of workers: {len(workers)}")
+            print(f"- Num of reclaimed leases: {work_queue.num_reclaimed}")
+            if failed_tasks:
+                print(f"- Num of failed payloads: {len(failed_tasks)} (re-run the coordinator to queue them again)")
+            if not eval_results:
+                print(f"No results were committed.")
+                return
+
+            save_records(response_list, output_path)
+            if args.results_format == "parquet":
+                metric_keys = eval_results[0].get("metric_keys")
+                write_results_parquet(eval_results, get_parquet_path(eval_results_path), metric_keys)
+                if os.path.exists(eval_results_path):
+                    os.remove(eval_results_path)
+            else:
+                save_records(eval_results, eval_results_path)
+            get_eval_summary(eval_results, eval_summary_path)
+            _, scores = get_score_matrix(eval_results)
+            eval_summary = update_eval_summary(
+                eval_summary_path,
+                request_stats=sum_request_stats(workers),
+                num_workers=len(workers),
+                **get_summary_stats(args, scores)
+            )
+            print(f"Saved the merged results to '{output_path}'.")
+    finally:
+        work_queue.close()
+
+    # The throughput is that of all workers together, over the wall time of the distributed stage
+    perf_report = get_perf_report(
+        response_list,
+        stage_times=stage_timer.stage_times,
+        input_token_price=args.input_token_price,
+        output_token_price=args.output_token_price
+    )
+    num_completions = sum(worker["num_completions"] for worker in workers)
+    distributed_time = stage_timer.stage_times["distributed"]
+    if num_completions > 0 and distributed_time > 0:
+        perf_report["throughput"] = {
+            "requests_per_sec": round(num_completions / distributed_time, 3),
+            "tokens_per_sec": round(sum(worker["num_completion_tokens"] for worker in workers) / distributed_time, 3),
+        }
+    save_perf_report(perf_report, perf_report_path)
+
+    print_eval_summary(eval_summary)
+    print_perf_report(perf_report)
+
+
+def wait_for_queue(work_queue, poll_interval):
+    """Returns the run fields of the queue once the coordinator has queued the payloads."""
+    meta = work_queue.get_meta()
+    if not meta.get("ready"):
+        print(f"Waiting for the coordinator to queue the payloads...")
+        while not meta.get("ready"):
+            time.sleep(poll_interval)
+            meta = work_queue.get_meta()
+    return meta
+
+
+def run_worker(args, repo_path, queue_path):
+    worker_id = args.worker_id or get_worker_id()
+    queue_name = os.path.splitext(queue_path)[0]
+    # Scratch files of the leased batch, so that a retried batch keeps its fetched responses
+    output_path = f'{queue_name}.{worker_id}.output.jsonl'
+    eval_results_path = f'{queue_name}.{worker_id}.eval_results.jsonl'
+    response_cache_path = f'{repo_path}/results/response_cache.sqlite'
+    metric_cache_path = f'{repo_path}/results/metric_cache.sqlite'
+
+    work_queue = WorkQueue(queue_path, args.lease_seconds, args.max_attempts)
+    meta = wait_for_queue(work_queue, args.poll_interval)
+    print(f"[[Worker]]")
+    print(f"- Worker: {worker_id}")
+    print(f"- Queue: '{queue_path}'")
+    print(f"- Model: {meta['api_type']}/{meta['model']}")
+
+    response_cache = SqliteCache(
+        response_cache_path,
+        table_name="responses",
+        max_entries=args.response_cache_max_entries,
+        max_age_days=args.response_cache_max_age_days
+    ) if args.response_cache else None
+    metric_cache = SqliteCache(
+        metric_cache_path,
+        table_name="metric_scores"
+    ) if args.metric_cache else None
+
+    # The model and request fields come from the coordinator; the endpoint and its limits are local
+    api_executor = APIExecutorFactory.get_api_executor(
+        model=meta["model"],
+        api_type=meta["api_type"],
+        api_key=args.api_key,
+        concurrency=args.concurrency,
+        response_cache=response_cache,
+        rate_limiter=RateLimiter(args.requests_per_minute, args.tokens_per_minute),
+        max_retries=args.max_retries,
+        base_url=args.base_url,
+        stream=meta["stream_completions"],
+        max_completion_tokens=meta["max_completion_tokens"],
+        stop=meta["stop"],
+        dedup_payloads=args.dedup_payloads,
+        prefix_order=args.prefix_order
+    )
+    evaluator = ResponseEvaluatorFactory.get_evaluator(
+        eval_type="reference_based",
+        batch_size=args.eval_batch_size,
+        num_workers=args.eval_workers,
+        metric_cache=metric_cache,
+        metric_backend=meta["metric_backend"]
+    )
+    evaluator.start_workers()
+
+    num_committed = 0
+    try:
+        while True:
+            # Step 1: Lease a batch of payloads, or stop once every payload is committed or failed
+            tasks = work_queue.lease(worker_id, args.lease_size)
+            if not tasks:
+                if work_queue.is_finished():
+                    break
+                # The leases of other workers may still expire
+                time.sleep(args.poll_interval)
+                continue
+
+            # Step 2: Fetch and score the responses of the batch
+            payload_hashes = {task_id: payload_hash for task_id, payload_hash, _ in tasks}
+            input_payloads = []
+            stale_tasks = []
+            for task_id, payload_hash, row in tasks:
+                payload = decode_payload(meta["header"], row)
+                if get_payload_hash(payload) != payload_hash:
+                    # The coordinator may have queued the payloads again with another header
+                    meta = work_queue.get_meta()
+                    payload = decode_payload(meta["header"], row)
+                if get_payload_hash(payload) == payload_hash:
+                    input_payloads.append(payload)
+                else:
+                    stale_tasks.append((task_id, "The payload does not match the header of the queue."))
+            response_list = api_executor.fetch_response(
+                input_payloads=input_payloads,
+                response_path=output_path,
+                reset=False
+            )
+            work_queue.renew(worker_id, [response["id"] for response in response_list])
+            eval_results = evaluator.evaluate_response(
+                input_payloads=input_payloads,
+                response_list=response_list,
+                results_path=eval_results_path,
+                reset=True
+            ) if response_list else []
+
+            # Step 3: Commit the results, and give the payloads without a response back to the queue
+            num_committed += work_queue.commit(worker_id, [
+                {"id": response["id"], "payload_hash": payload_hashes[response["id"]], "response": response, "eval_result": eval_result}
+                for response, eval_result in zip(response_list, eval_results)
+            ])
+            fetched_ids = {response["id"] for response in response_list}
+            work_queue.fail(worker_id, stale_tasks + [
+                (payload["id"], "No response was fetched.") for payload in input_payloads if payload["id"] not in fetched_ids
+            ])
+            work_queue.update_worker(worker_id, {
+                "request_stats": api_executor.request_stats,
+                "num_completions": api_executor.num_completions,
+                "num_completion_tokens": api_executor.num_completion_tokens,
+                "num_committed": num_committed,
+            })
+    finally:
+        work_queue.release(worker_id)
+        work_queue.close()
+        evaluator.close()
+        for cache in (response_cache, metric_cache):
+            if cache is not None:
+                cache.close()
+
+    for path in (output_path, eval_results_path):
+        if os.path.exists(path):
+            os.remove(path)
+    print(f"[[Worker Summary]]")
+    print(f"- Num of committed results: {num_committed}")
+
+
+def main(args):
+    REPO_PATH = os.path.abspath(os.getcwd())
+    TEST_PREFIX = f"{args.domain_type}-{args.task_type}"
+    queue_path = args.queue_path or f'{REPO_PATH}/results/{TEST_PREFIX}-{args.model}.queue.sqlite'
+
+    if args.role == "coordinator":
+        run_coordinator(args, REPO_PATH, queue_path)
+    else:
+        run_worker(args, REPO_PATH, queue_path)
+
+
+if __name__ == "__main__":
+    args = get_distributed_args()
+    main(args)
@@ -1,104 +1,414 @@
 import os
 import argparse
+from itertools import chain
+from tqdm import tqdm
 
 from lib.data_loader import DataLoaderFactory
 from lib.payload_creator import PayloadCreatorFactory
 from lib.api_executor import APIExecutorFactory
 from lib.response_evaluator import ResponseEvaluatorFactory
-from lib.utils import get_eval_summary
+from lib.cache import SqliteCache
+from lib.result_store import get_parquet_path, get_parquet_eval_summary
+from lib.rate_limiter import RateLimiter
+from lib.eval_stats import get_score_matrix, load_scores, get_confidence_intervals
+from lib.perf_report import StageTimer, get_perf_report, save_perf_report, print_perf_report
+from lib.run_monitor import RunMonitor
+from lib.utils import get_eval_summary, update_eval_summary, load_keyed_records, EvalSummaryAccumulator, str2bool, parse_shard
 
 
-def get_args():
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--domain_type", type=str, help="", default="DT", choices=['DT', 'DP'])
-    parser.add_argument("--task_type", type=str, help="", default="QG", choices=['QG'])
+    parser.add_argument("--task_type", type=str, help="QG, SUM, or any task type with --user_template", default="QG")
+    parser.add_argument("--user_template", type=str, help="User message template with {column} placeholders (default: the template of the task type)", default=None)
+    parser.add_argument("--ground_truth_field", type=str, help="Ground truth column, required with --user_template", default=None)
+    parser.add_argument("--payload_workers", type=int, help="Number of processes that build the payloads", default=1)
+    parser.add_argument("--tokenizer", type=str, help="Tokenizer that counts the input tokens: approx (4 characters per token), tiktoken:<encoding> or a Hugging Face tokenizer name", default="approx")
+    parser.add_argument("--max_input_tokens", type=int, help="Input token budget of each payload; longer inputs are truncated (default: no budget)", default=None)
     
     parser.add_argument("--datasource", type=str, help="", default="huggingface")
     parser.add_argument("--dataset_name", type=str, help="", default="lmqg/qg_squad")
+    parser.add_argument("--stream_dataset", action="store_true", help="Stream the dataset split and store only the selected rows, instead of downloading the whole split")
+    parser.add_argument("--limit", type=int, help="Number of rows to evaluate (default: every row of the shard)", default=None)
+    parser.add_argument("--shard", type=parse_shard, help="Shard of the dataset split to evaluate, as index/num_shards (e.g. 0/4)", default=None)
+    parser.add_argument("--sample_seed", type=int, help="Sample the --limit rows with this seed instead of taking the first ones", default=None)
     
     parser.add_argument("--temperature", type=float, help="", default=0.1)
     parser.add_argument("--model", type=str, help="", default="gpt-4o-mini")
-    parser.add_argument("--api_type", type=str, help="", default="openai", choices=["openai", "ollama"])
+    parser.add_argument("--api_type", type=str, help="", default="openai", choices=["openai", "openai_batch", "ollama"])
     parser.add_argument("--api_key", type=str, help="", default=os.getenv("OPENAI_API_KEY"))
+    parser.add_argument("--base_url", type=str, help="Base URL of the API (default: the endpoint of the API type)", default=None)
+    parser.add_argument("--concurrency", type=int, help="Number of API requests in flight", default=1)
+    parser.add_argument("--response_cache", action="store_true", help="Share LLM responses across runs through results/response_cache.sqlite")
+    parser.add_argument("--response_cache_max_entries", type=int, help="Max number of cached responses (least recently used are evicted)", default=None)
+    parser.add_argument("--response_cache_max_age_days", type=float, help="Max age of cached responses in days", default=None)
+    parser.add_argument("--requests_per_minute", type=int, help="Requests-per-minute limit (default: learned from the rate-limit headers)", default=None)
+    parser.add_argument("--tokens_per_minute", type=int, help="Tokens-per-minute limit (default: learned from the rate-limit headers)", default=None)
+    parser.add_argument("--max_retries", type=int, help="Max number of retries of a request on rate limits and transient errors", default=5)
+    parser.add_argument("--stream_completions", action="store_true", help="Stream each completion to time its first token and inter-token latency, and score it as soon as it finishes (implies --streaming)")
+    parser.add_argument("--max_completion_tokens", type=int, help="Completion token budget of a streamed completion, enforced client-side", default=None)
+    parser.add_argument("--stop", type=str, nargs="+", help="Stop sequences of a streamed completion, enforced client-side", default=None)
+    parser.add_argument("--dedup_payloads", action="store_true", help="Fetch exact-duplicate payloads once and copy the response to each of them")
+    parser.add_argument("--prefix_order", action="store_true", help="Send the payloads in prompt prefix order, so that the server reuses its prompt cache")
+    parser.add_argument("--input_token_price", type=float, help="Price of 1M input tokens, for the cost estimate of the performance report", default=None)
+    parser.add_argument("--output_token_price", type=float, help="Price of 1M output tokens, for the cost estimate of the performance report", default=None)
     
     parser.add_argument("--eval_type", type=str, help="", default="reference_based")
+    parser.add_argument("--eval_batch_size", type=int, help="Number of responses scored per batch", default=1)
+    parser.add_argument("--eval_workers", type=int, help="Number of processes that score responses in parallel", default=1)
     
-    parser.add_argument("--reset", type=bool, help="", default=False)
+    parser.add_argument("--metric_cache", action="store_true", help="Share metric scores across runs through results/metric_cache.sqlite")
+    parser.add_argument("--results_format", type=str, help="Storage format of the evaluation results", default="jsonl", choices=["jsonl", "parquet"])
+    parser.add_argument("--metric_backend", type=str, help="Implementation of the metrics (builtin: `lib.metrics`, evaluate: Hugging Face `evaluate`)", default="builtin", choices=["builtin", "evaluate"])
+    parser.add_argument("--num_resamples", type=int, help="Bootstrap resamples of the confidence intervals of the summary (0: no intervals)", default=10000)
+    parser.add_argument("--confidence", type=float, help="Confidence level of the intervals of the summary", default=0.95)
     
-    return parser.parse_args()
+    parser.add_argument("--streaming", action="store_true", help="Stream each record through all stages with constant memory")
+    parser.add_argument("--reset", type=str2bool, help="Invalidate the cached outputs of every stage", default=False)
+    parser.add_argument("--reset_dataset", action="store_true", help="Re-download the dataset")
+    parser.add_argument("--reset_payloads", action="store_true", help="Re-create the payloads")
+    parser.add_argument("--reset_responses", action="store_true", help="Re-fetch the responses")
+    parser.add_argument("--reset_results", action="store_true", help="Re-score the responses")
+    
+    parser.add_argument("--event_log", type=str, help="JSON-lines file that the run appends its progress events to", default=None)
+    parser.add_argument("--metrics_port", type=int, help="Serve the progress of the run as Prometheus metrics at http://127.0.0.1:<port>/metrics", default=None)
+    parser.add_argument("--monitor_interval", type=float, help="Seconds between two progress events of the event log", default=10)
+    return parser
 
 
-def main(args):
-    REPO_PATH = os.path.abspath(os.getcwd())
-    TEST_PREFIX = f"{args.domain_type}-{args.task_type}"
-    
-    input_dataset_path = f'{REPO_PATH}/data/raw/{TEST_PREFIX}'
-    input_payload_path = f'{REPO_PATH}/data/processed/{TEST_PREFIX}.jsonl'
-    system_prompt_path = f'{REPO_PATH}/prompts/{TEST_PREFIX}.txt'
-    output_path = f'{REPO_PATH}/results/{TEST_PREFIX}-{args.model}.output.jsonl'
-    eval_results_path = f'{REPO_PATH}/results/{TEST_PREFIX}-{args.model}.eval_results.jsonl'
-    eval_summary_path = f'{REPO_PATH}/results/{TEST_PREFIX}-{args.model}.eval_summary.json'
+def get_args(parser=None):
+    parser = parser or get_parser()
+    args = parser.parse_args()
+    if (args.max_completion_tokens is not None or args.stop) and not args.stream_completions:
+        parser.error("--max_completion_tokens and --stop are enforced on streamed completions (pass --stream_completions).")
+    for stage in ("dataset", "payloads", "responses", "results"):
+        setattr(args, f"reset_{stage}", args.reset or getattr(args, f"reset_{stage}"))
+    return args
+
+
+def get_input_columns(args):
+    """Returns the dataset columns the payloads of the task type or user template are built from."""
+    return PayloadCreatorFactory.get_payload_creator(
+        task_type=args.task_type,
+        temperature=args.temperature,
+        system_prompt_path=None,
+        user_template=args.user_template,
+        ground_truth_field=args.ground_truth_field
+    ).input_columns
+
+
+def run_pipeline(args, input_dataset, input_payload_path, system_prompt_path, output_path, eval_results_path, eval_summary_path, response_cache, metric_cache, stage_timer, monitor=None):
+    # ----------------------------------------------------------------------
+    # Create the payloads
+    # ----------------------------------------------------------------------
+    with stage_timer.stage("payload"):
+        input_payloads = PayloadCreatorFactory.get_payload_creator(
+            task_type=args.task_type,
+            temperature=args.temperature,
+            system_prompt_path=system_prompt_path,
+            user_template=args.user_template,
+            ground_truth_field=args.ground_truth_field,
+            num_proc=args.payload_workers,
+            tokenizer_name=args.tokenizer,
+            max_input_tokens=args.max_input_tokens
+        ).create_payload(
+            input_dataset=input_dataset,
+            payload_path=input_payload_path,
+            reset=args.reset_payloads
+        )
     
     # ----------------------------------------------------------------------
-    # Load the dataset
+    # Execute the API
     # ----------------------------------------------------------------------
-    input_dataset = DataLoaderFactory.get_data_loader(
-        source=args.datasource,
-        dataset_name=args.dataset_name
-    ).load_dataset(
-        dataset_path=input_dataset_path,
-        split='test',
-        reset=args.reset
+    api_executor = APIExecutorFactory.get_api_executor(
+        model=args.model,
+        api_type=args.api_type,
+        api_key=args.api_key,
+        concurrency=args.concurrency,
+        response_cache=response_cache,
+        rate_limiter=RateLimiter(args.requests_per_minute, args.tokens_per_minute),
+        max_retries=args.max_retries,
+        base_url=args.base_url,
+        stream=args.stream_completions,
+        max_completion_tokens=args.max_completion_tokens,
+        stop=args.stop,
+        dedup_payloads=args.dedup_payloads,
+        prefix_order=args.prefix_order
     )
+    if monitor is not None:
+        monitor.watch(api_executor=api_executor)
+    with stage_timer.stage("fetch"):
+        response_list = api_executor.fetch_response(
+            input_payloads=input_payloads,
+            response_path=output_path,
+            reset=args.reset_responses
+        )
     
     # ----------------------------------------------------------------------
-    # Create the payloads
+    # Evaluate the responses
     # ----------------------------------------------------------------------
-    input_payloads = PayloadCreatorFactory.get_payload_creator(
+    evaluator = ResponseEvaluatorFactory.get_evaluator(
+        eval_type="reference_based",
+        batch_size=args.eval_batch_size,
+        num_workers=args.eval_workers,
+        metric_cache=metric_cache,
+        results_format=args.results_format,
+        metric_backend=args.metric_backend
+    )
+    if monitor is not None:
+        monitor.watch(evaluator=evaluator)
+    with stage_timer.stage("evaluate"):
+        eval_results = evaluator.evaluate_response(
+            input_payloads=input_payloads,
+            response_list=response_list,
+            results_path=eval_results_path,
+            reset=args.reset_results
+        )
+    
+    with stage_timer.stage("summarize"):
+        eval_summary = save_eval_summary(args, eval_results, eval_results_path, eval_summary_path, api_executor)
+    return eval_summary, api_executor
+
+
+def save_eval_summary(args, eval_results, eval_results_path, eval_summary_path, api_executor):
+    if args.results_format == "parquet":
+        get_parquet_eval_summary(get_parquet_path(eval_results_path), eval_summary_path)
+    else:
+        get_eval_summary(eval_results, eval_summary_path)
+    _, scores = get_score_matrix(eval_results)
+    return update_eval_summary(
+        eval_summary_path,
+        request_stats=api_executor.request_stats,
+        **get_summary_stats(args, scores)
+    )
+
+
+def get_summary_stats(args, scores):
+    """Returns the bootstrap confidence intervals of the mean scores, to add to the evaluation summary."""
+    if args.num_resamples <= 0:
+        return {}
+    return {"confidence_intervals": get_confidence_intervals(scores, args.num_resamples, args.confidence)}
+
+
+def start_stream(iterator):
+    """Runs a streamed stage up to its first record, and returns an iterator over all its records.
+
+    The generators of the stages only start when the next stage pulls from
+    them, so the last stage would start (and print its header) first.
+    Starting each stage in turn keeps the logs in pipeline order.
+    """
+    iterator = iter(iterator)
+    for first_record in iterator:
+        return chain([first_record], iterator)
+    return iterator
+
+
+def run_streaming_pipeline(args, input_dataset, input_payload_path, system_prompt_path, output_path, eval_results_path, eval_summary_path, response_cache, metric_cache, stage_timer, monitor=None):
+    """Runs the payload, API and evaluation stages as chained generators.
+
+    Each record flows through all three stages and is written to its file as
+    it goes, and the summary is accumulated on the fly, so memory stays flat
+    regardless of the dataset size. The interleaved stages are timed together
+    as the `pipeline` stage.
+    """
+    payload_creator = PayloadCreatorFactory.get_payload_creator(
         task_type=args.task_type,
         temperature=args.temperature,
-        system_prompt_path=system_prompt_path
-    ).create_payload(
-        input_dataset=input_dataset,
-        payload_path=input_payload_path,
-        reset=args.reset
+        system_prompt_path=system_prompt_path,
+        user_template=args.user_template,
+        ground_truth_field=args.ground_truth_field,
+        num_proc=args.payload_workers,
+        tokenizer_name=args.tokenizer,
+        max_input_tokens=args.max_input_tokens
     )
     
-    # ----------------------------------------------------------------------
-    # Execute the API
-    # ----------------------------------------------------------------------
-    response_list = APIExecutorFactory.get_api_executor(
+    api_executor = APIExecutorFactory.get_api_executor(
         model=args.model,
         api_type=args.api_type,
-        api_key=args.api_key
-    ).fetch_response(
-        input_payloads=input_payloads,
-        response_path=output_path,
-        reset=args.reset
+        api_key=args.api_key,
+        concurrency=args.concurrency,
+        response_cache=response_cache,
+        rate_limiter=RateLimiter(args.requests_per_minute, args.tokens_per_minute),
+        max_retries=args.max_retries,
+        base_url=args.base_url,
+        stream=args.stream_completions,
+        max_completion_tokens=args.max_completion_tokens,
+        stop=args.stop,
+        dedup_payloads=args.dedup_payloads,
+        prefix_order=args.prefix_order
     )
+    if monitor is not None:
+        monitor.watch(api_executor=api_executor)
     
-    # ----------------------------------------------------------------------
-    # Evaluate the responses
-    # ----------------------------------------------------------------------
-    eval_results = ResponseEvaluatorFactory.get_evaluator(
-        eval_type="reference_based"
-    ).evaluate_response(
-        input_payloads=input_payloads,
-        response_list=response_list,
-        results_path=eval_results_path,
-        reset=args.reset
+    evaluator = ResponseEvaluatorFactory.get_evaluator(
+        eval_type="reference_based",
+        batch_size=args.eval_batch_size,
+        num_workers=args.eval_workers,
+        metric_cache=metric_cache,
+        results_format=args.results_format,
+        metric_backend=args.metric_backend
     )
+    if monitor is not None:
+        monitor.watch(evaluator=evaluator)
     
-    # Check the evaluation summary
-    eval_summary = get_eval_summary(eval_results, eval_summary_path)
+    eval_summary = EvalSummaryAccumulator()
+    with stage_timer.stage("pipeline"):
+        payload_iter = start_stream(payload_creator.iter_payload(
+            input_dataset=input_dataset,
+            payload_path=input_payload_path,
+            reset=args.reset_payloads
+        ))
+        response_iter = start_stream(api_executor.iter_response(
+            input_payloads=payload_iter,
+            response_path=output_path,
+            reset=args.reset_responses
+        ))
+        result_iter = start_stream(evaluator.iter_result(
+            response_pairs=response_iter,
+            results_path=eval_results_path,
+            reset=args.reset_results
+        ))
+        for eval_result in tqdm(result_iter, total=len(input_dataset), desc="Running pipeline"):
+            eval_summary.update(eval_result)
     
+    with stage_timer.stage("summarize"):
+        eval_summary.save_summary(eval_summary_path)
+        # The scores are read back from the results file, so that the pipeline keeps none in memory
+        results_path = get_parquet_path(eval_results_path) if args.results_format == "parquet" else eval_results_path
+        _, scores = load_scores(results_path) if os.path.exists(results_path) else get_score_matrix([])
+        eval_summary = update_eval_summary(
+            eval_summary_path,
+            request_stats=api_executor.request_stats,
+            **get_summary_stats(args, scores)
+        )
+    return eval_summary, api_executor
+
+
+def save_run_perf_report(args, output_path, perf_report_path, stage_times, api_executor):
+    """Saves the performance report of the responses in the output file, including those fetched by earlier runs."""
+    responses, _ = load_keyed_records(output_path) if os.path.exists(output_path) else ({}, 0)
+    perf_report = get_perf_report(
+        responses.values(),
+        stage_times=stage_times,
+        api_executor=api_executor,
+        input_token_price=args.input_token_price,
+        output_token_price=args.output_token_price
+    )
+    save_perf_report(perf_report, perf_report_path)
+    return perf_report
+
+
+def load_input_dataset(args, dataset_path):
+    return DataLoaderFactory.get_data_loader(
+        source=args.datasource,
+        dataset_name=args.dataset_name,
+        streaming=args.stream_dataset,
+        limit=args.limit,
+        shard=args.shard,
+        columns=get_input_columns(args),
+        sample_seed=args.sample_seed
+    ).load_dataset(
+        dataset_path=dataset_path,
+        split='test',
+        reset=args.reset_dataset
+    )
+
+
+def print_eval_summary(eval_summary):
     print(f"[[Evaluation Summary]]")
     print(f"- Num of responses: {eval_summary['num_responses']}")
-    print(f"- Avg BLEU: {eval_summary['avg_bleu']:.4f}")
-    print(f"- Avg CER: {eval_summary['avg_cer']:.4f}")
-    print(f"- Avg ROUGE: {eval_summary['avg_rouge']:.4f}")
+    confidence_intervals = eval_summary.get("confidence_intervals", {})
+    for name, label in (("bleu", "BLEU"), ("cer", "CER"), ("rouge", "ROUGE")):
+        interval = f" ({confidence_intervals['confidence']:.0%} CI: {confidence_intervals[name][0]:.4f}-{confidence_intervals[name][1]:.4f})" if name in confidence_intervals else ""
+        print(f"- Avg {label}: {eval_summary[f'avg_{name}']:.4f}{interval}")
+    print(f"- Retried requests: {eval_summary['request_stats']['num_retries']} "
+          f"({eval_summary['request_stats']['num_rate_limited']} rate limited)")
+    print(f"- Throttled requests: {eval_summary['request_stats']['num_throttled']} "
+          f"({eval_summary['request_stats']['throttle_time']:.1f}s)")
+
+
+def main(args):
+    REPO_PATH = os.path.abspath(os.getcwd())
+    TEST_PREFIX = f"{args.domain_type}-{args.task_type}"
+    
+    input_dataset_path = f'{REPO_PATH}/data/raw/{TEST_PREFIX}'
+    input_payload_path = f'{REPO_PATH}/data/processed/{TEST_PREFIX}'
+    system_prompt_path = f'{REPO_PATH}/prompts/{TEST_PREFIX}.txt'
+    output_path = f'{REPO_PATH}/results/{TEST_PREFIX}-{args.model}.output.jsonl'
+    eval_results_path = f'{REPO_PATH}/results/{TEST_PREFIX}-{args.model}.eval_results.jsonl'
+    eval_summary_path = f'{REPO_PATH}/results/{TEST_PREFIX}-{args.model}.eval_summary.json'
+    perf_report_path = f'{REPO_PATH}/results/{TEST_PREFIX}-{args.model}.perf_report.json'
+    response_cache_path = f'{REPO_PATH}/results/response_cache.sqlite'
+    metric_cache_path = f'{REPO_PATH}/results/metric_cache.sqlite'
+    
+    # ----------------------------------------------------------------------
+    # Load the dataset
+    # ----------------------------------------------------------------------
+    stage_timer = StageTimer()
+    monitor = None
+    if args.event_log is not None or args.metrics_port is not None:
+        monitor = RunMonitor(
+            run_name=f"{TEST_PREFIX}-{args.model}",
+            event_log_path=args.event_log,
+            metrics_port=args.metrics_port,
+            interval=args.monitor_interval,
+            config={key: value for key, value in vars(args).items() if key != "api_key"}
+        )
+        monitor.watch(stage_timer=stage_timer)
+        monitor.start()
+    with stage_timer.stage("load"):
+        input_dataset = load_input_dataset(args, input_dataset_path)
+    if monitor is not None:
+        monitor.watch(num_rows=len(input_dataset))
+    
+    # ----------------------------------------------------------------------
+    # Create the payloads, execute the API and evaluate the responses
+    # ----------------------------------------------------------------------
+    response_cache = SqliteCache(
+        response_cache_path,
+        table_name="responses",
+        max_entries=args.response_cache_max_entries,
+        max_age_days=args.response_cache_max_age_days
+    ) if args.response_cache else None
+    metric_cache = SqliteCache(
+        metric_cache_path,
+        table_name="metric_scores"
+    ) if args.metric_cache else None
+    
+    # Streamed completions are scored as they finish, instead of after the whole fetch stage
+    run = run_streaming_pipeline if args.streaming or args.stream_completions else run_pipeline
+    eval_summary = None
+    try:
+        eval_summary, api_executor = run(
+            args,
+            input_dataset,
+            input_payload_path,
+            system_prompt_path,
+            output_path,
+            eval_results_path,
+            eval_summary_path,
+            response_cache,
+            metric_cache,
+            stage_timer,
+            monitor
+        )
+    finally:
+        for cache in (response_cache, metric_cache):
+            if cache is not None:
+                cache.close()
+        if monitor is not None:
+            monitor.close(eval_summary)
+    
+    perf_report = save_run_perf_report(args, output_path, perf_report_path, stage_timer.stage_times, api_executor)
+    
+    print_eval_summary(eval_summary)
+    print_perf_report(perf_report)
 
 
 if __name__ == "__main__":
-    args = get_args()
+    parser = get_parser()
+    args = get_args(parser)
+    # The streaming pipeline sends the payloads in dataset order (the sweep and distributed runners fetch in stages and may reorder them)
+    if args.prefix_order and (args.streaming or args.stream_completions):
+        parser.error("--prefix_order needs the whole payload file, and is not supported with --streaming or --stream_completions.")
     main(args)
\ No newline at end of file
@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import queue
+import argparse
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.payload_creator import PayloadCreatorFactory
+from lib.payload_store import PayloadStore
+from lib.api_executor import APIExecutorFactory
+from lib.response_evaluator import ResponseEvaluatorFactory
+from lib.rate_limiter import RateLimiter
+from lib.cache import SqliteCache
+from run_evaluation import get_parser, get_args, load_input_dataset, save_eval_summary, save_run_perf_report
+
+
+def get_sweep_args():
+    parser = get_parser()
+    parser.add_argument("--models", type=str, nargs="+", required=True, help="Models to compare, as `api_type/model` (e.g. openai/gpt-4o-mini ollama/llama3.1:70b)")
+    parser.add_argument("--temperatures", type=float, nargs="+", help="Temperatures to compare (default: --temperature)", default=None)
+    parser.add_argument("--domain_types", type=str, nargs="+", help="Domain types to compare (default: --domain_type)", default=None, choices=['DT', 'DP'])
+    parser.add_argument("--task_types", type=str, nargs="+", help="Task types to compare (default: --task_type)", default=None)
+    parser.add_argument("--prompt_paths", type=str, nargs="+", help="System prompt files to compare (default: prompts/{domain_type}-{task_type}.txt)", default=None)
+    parser.add_argument("--dataset_names", type=str, nargs="+", help="Dataset of each of --task_types, in the same order (default: --dataset_name)", default=None)
+    args = get_args(parser)
+    # The runs are fetched and scored in stages, without the streaming pipeline or the run monitor of run_evaluation.py
+    for flag in ("streaming", "event_log", "metrics_port"):
+        if getattr(args, flag):
+            parser.error(f"--{flag} is not supported by a sweep (use run_evaluation.py).")
+    task_types = args.task_types or [args.task_type]
+    if args.dataset_names is None and len(task_types) > 1:
+        parser.error("--dataset_names is required with several --task_types, since each task type needs its own dataset.")
+    if args.dataset_names is not None and len(args.dataset_names) != len(task_types):
+        parser.error(f"--dataset_names needs one dataset per task type ({len(task_types)}).")
+    return args
+
+
+def get_sweep_runs(args, repo_path):
+    """Returns the runs of the sweep grid, in grid order.
+
+    Each run holds the arguments of a single `run_evaluation.py` run and its
+    file paths. The temperature and prompt are added to the output file names
+    only when they vary across the grid, so a sweep over models alone reuses
+    (and produces) the same files as `run_evaluation.py`.
+    """
+    temperatures = args.temperatures or [args.temperature]
+    domain_types = args.domain_types or [args.domain_type]
+    task_types = args.task_types or [args.task_type]
+    prompt_paths = args.prompt_paths or [None]
+    dataset_names = dict(zip(task_types, args.dataset_names or [args.dataset_name]))
+
+    runs = []
+    for domain_type, task_type, prompt_path, temperature, model_spec in product(
+        domain_types, task_types, prompt_paths, temperatures, args.models
+    ):
+        api_type, model = model_spec.split("/", 1)
+        test_prefix = f"{domain_type}-{task_type}"
+
+        run_name = model
+        payload_path = f'{repo_path}/data/processed/{test_prefix}'
+        if prompt_path is not None:
+            prompt_name = os.path.splitext(os.path.basename(prompt_path))[0]
+            run_name += f"-{prompt_name}"
+            payload_path = f'{repo_path}/data/processed/{test_prefix}-{prompt_name}'
+        if len(temperatures) > 1:
+            run_name += f"-t{temperature}"
+
+        run_args = argparse.Namespace(**vars(args))
+        run_args.domain_type = domain_type
+        run_args.task_type = task_type
+        run_args.dataset_name = dataset_names[task_type]
+        run_args.temperature = temperature
+        run_args.model = model
+        run_args.api_type = api_type
+        runs.append({
+            "args": run_args,
+            "prompt_path": prompt_path or f'{repo_path}/prompts/{test_prefix}.txt',
+            "dataset_path": f'{repo_path}/data/raw/{test_prefix}',
+            "payload_path": payload_path,
+            "output_path": f'{repo_path}/results/{test_prefix}-{run_name}.output.jsonl',
+            "eval_results_path": f'{repo_path}/results/{test_prefix}-{run_name}.eval_results.jsonl',
+            "eval_summary_path": f'{repo_path}/results/{test_prefix}-{run_name}.eval_summary.json',
+            "perf_report_path": f'{repo_path}/results/{test_prefix}-{run_name}.perf_report.json',
+        })
+    return runs
+
+
+def fetch_backend_responses(backend_runs, response_cache, fetched_runs):
+    """Fetches the responses of the runs of one backend, one run after another.
+
+    The runs of a backend share its rate limiter, and do not compete for the
+    same server (e.g. by swapping models in and out of an Ollama server).
+    Each fetched run is put in `fetched_runs` to be scored.
+    """
+    rate_limiter = RateLimiter(backend_runs[0]["args"].requests_per_minute, backend_runs[0]["args"].tokens_per_minute)
+    for run in backend_runs:
+        run_args = run["args"]
+        start_time = time.perf_counter()
+        try:
+            api_executor = APIExecutorFactory.get_api_executor(
+                model=run_args.model,
+                api_type=run_args.api_type,
+                api_key=run_args.api_key,
+                concurrency=run_args.concurrency,
+                response_cache=response_cache,
+                rate_limiter=rate_limiter,
+                max_retries=run_args.max_retries,
+                base_url=run_args.base_url,
+                stream=run_args.stream_completions,
+                max_completion_tokens=run_args.max_completion_tokens,
+                stop=run_args.stop,
+                dedup_payloads=run_args.dedup_payloads,
+                prefix_order=run_args.prefix_order
+            )
+            response_list = api_executor.fetch_response(
+                input_payloads=run["input_payloads"],
+                response_path=run["output_path"],
+                reset=run_args.reset_responses
+            )
+            fetched_runs.put((run, api_executor, response_list, None, time.perf_counter() - start_time))
+        except Exception as e:
+            fetched_runs.put((run, None, None, e, time.perf_counter() - start_time))
+
+
+def print_comparison_table(rows):
+    print(f"| {'Domain':<6} | {'Task':<4} | {'Model':<32} | {'Temp':>4} | {'Prompt':<16} | {'N':>6} "
+          f"| {'BLEU':>6} | {'CER':>6} | {'ROUGE':>6} | {'Time':>7} |")
+    print(f"| {'-' * 6} | {'-' * 4} | {'-' * 32} | {'-' * 4} | {'-' * 16} | {'-' * 6} "
+          f"| {'-' * 6} | {'-' * 6} | {'-' * 6} | {'-' * 7} |")
+    for row in rows:
+        if "error" in row:
+            scores = f"| {'-':>6} | {'failed':>6} | {'-':>6} | {'-':>6} "
+        else:
+            scores = (f"| {row['num_responses']:>6} | {row['avg_bleu']:>6.4f} "
+                      f"| {row['avg_cer']:>6.4f} | {row['avg_rouge']:>6.4f} ")
+        print(f"| {row['domain_type']:<6} | {row['task_type']:<4} | {row['model']:<32} "
+              f"| {row['temperature']:>4} | {row['prompt']:<16} {scores}| {row['elapsed_time']:>6.1f}s |")
+
+
+def main(args):
+    REPO_PATH = os.path.abspath(os.getcwd())
+    sweep_summary_path = f'{REPO_PATH}/results/sweep_summary.json'
+    response_cache_path = f'{REPO_PATH}/results/response_cache.sqlite'
+    metric_cache_path = f'{REPO_PATH}/results/metric_cache.sqlite'
+    start_time = time.perf_counter()
+
+    runs = get_sweep_runs(args, REPO_PATH)
+    print(f"[[Sweep]]")
+    print(f"- Num of runs: {len(runs)}")
+
+    # ----------------------------------------------------------------------
+    # Load each dataset and create each payload file once
+    # ----------------------------------------------------------------------
+    input_datasets = {}
+    input_payloads = {}
+    for run in runs:
+        run_args = run["args"]
+        if run["dataset_path"] not in input_datasets:
+            input_datasets[run["dataset_path"]] = load_input_dataset(run_args, run["dataset_path"])
+        if run["payload_path"] not in input_payloads:
+            input_payloads[run["payload_path"]] = PayloadCreatorFactory.get_payload_creator(
+                task_type=run_args.task_type,
+                temperature=run_args.temperature,
+                system_prompt_path=run["prompt_path"],
+                user_template=run_args.user_template,
+                ground_truth_field=run_args.ground_truth_field,
+                num_proc=run_args.payload_workers,
+                tokenizer_name=run_args.tokenizer,
+                max_input_tokens=run_args.max_input_tokens
+            ).create_payload(
+                input_dataset=input_datasets[run["dataset_path"]],
+                payload_path=run["payload_path"],
+                reset=run_args.reset_payloads
+            )
+        # The runs of each temperature share the payload store of their prompt
+        run["input_payloads"] = PayloadStore(
+            run["payload_path"],
+            defaults={"temperature": run_args.temperature},
+            num_rows=len(input_payloads[run["payload_path"]])
+        )
+
+    # ----------------------------------------------------------------------
+    # Fetch the responses of each backend concurrently, and score each run
+    # with a shared evaluator as soon as its responses are fetched
+    # ----------------------------------------------------------------------
+    response_cache = SqliteCache(
+        response_cache_path,
+        table_name="responses",
+        max_entries=args.response_cache_max_entries,
+        max_age_days=args.response_cache_max_age_days
+    ) if args.response_cache else None
+    metric_cache = SqliteCache(
+        metric_cache_path,
+        table_name="metric_scores"
+    ) if args.metric_cache else None
+    evaluator = ResponseEvaluatorFactory.get_evaluator(
+        eval_type="reference_based",
+        batch_size=args.eval_batch_size,
+        num_workers=args.eval_workers,
+        metric_cache=metric_cache,
+        results_format=args.results_format,
+        metric_backend=args.metric_backend
+    )
+    evaluator.start_workers()
+
+    backends = {}
+    for run in runs:
+        backends.setdefault((run["args"].api_type, run["args"].base_url), []).append(run)
+
+    fetched_runs = queue.Queue()
+    rows = {}
+    try:
+        with ThreadPoolExecutor(max_workers=len(backends)) as thread_pool:
+            for backend_runs in backends.values():
+                thread_pool.submit(fetch_backend_responses, backend_runs, response_cache, fetched_runs)
+
+            for _ in range(len(runs)):
+                run, api_executor, response_list, error, elapsed_time = fetched_runs.get()
+                run_args = run["args"]
+                row = {
+                    "domain_type": run_args.domain_type,
+                    "task_type": run_args.task_type,
+                    "model": f"{run_args.api_type}/{run_args.model}",
+                    "temperature": run_args.temperature,
+                    "prompt": os.path.splitext(os.path.basename(run["prompt_path"]))[0],
+                }
+                rows[id(run)] = row
+                if error is None and not response_list:
+                    error = "No responses were fetched."
+                if error is not None:
+                    print(f"Error during run '{row['model']}': {error}")
+                    row.update(error=str(error), elapsed_time=elapsed_time)
+                    continue
+
+                eval_start_time = time.perf_counter()
+                try:
+                    eval_results = evaluator.evaluate_response(
+                        input_payloads=run["input_payloads"],
+                        response_list=response_list,
+                        results_path=run["eval_results_path"],
+                        reset=run_args.reset_results
+                    )
+                    eval_summary = save_eval_summary(
+                        run_args, eval_results, run["eval_results_path"], run["eval_summary_path"], api_executor
+                    )
+                    eval_time = time.perf_counter() - eval_start_time
+                    save_run_perf_report(
+                        run_args, run["output_path"], run["perf_report_path"],
+                        {"fetch": round(elapsed_time, 3), "evaluate": round(eval_time, 3)}, api_executor
+                    )
+                except Exception as e:
+                    print(f"Error during run '{row['model']}': {e}")
+                    row.update(error=str(e), elapsed_time=elapsed_time + time.perf_counter() - eval_start_time)
+                    continue
+                row.update(eval_summary, elapsed_time=elapsed_time + eval_time)
+    finally:
+        evaluator.close()
+        for cache in (response_cache, metric_cache):
+            if cache is not None:
+                cache.close()
+        # The summary keeps the runs finished so far (with their scores or error), even if the sweep is interrupted
+        rows = [rows[id(run)] for run in runs if "elapsed_time" in rows.get(id(run), {})]
+        with open(sweep_summary_path, "w") as f:
+            json.dump(rows, f, indent=2)
+
+    print(f"[[Sweep Summary]]")
+    print_comparison_table(rows)
+    print(f"- Total time: {time.perf_counter() - start_time:.1f}s")
+    print(f"Saved the sweep summary to '{sweep_summary_path}'.")
+
+
+if __name__ == "__main__":
+    args = get_sweep_args()
+    main(args)